@@ -4,8 +4,11 @@ Telegram бот для сканирования документов
 import asyncio
 import logging
 import html
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime, timedelta
+from typing import AsyncIterator
+import httpx
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
 from telegram.ext import (
     Application, 
@@ -16,21 +19,182 @@ from telegram.ext import (
     filters
 )
 import config
-from scanner import scanner, ScannerError
+from scanner import scanner, ScannerError, ScanCancelled, area_presets
 from printer import printer, PrinterError
 
 logger = logging.getLogger(__name__)
 
+class ScanQueueFull(Exception):
+    """Пользователь превысил лимит ожидающих заданий сканирования"""
+    pass
+
+class ScanJobQueue:
+    """
+    Очередь заданий сканирования с круговым обходом пользователей.
+    
+    Задания выполняются строго по одному; следующее берётся у следующего
+    по кругу пользователя, поэтому серия нажатий одного человека не
+    задерживает остальных. Ожидающим сообщается место в очереди и
+    примерное время ожидания по скользящему среднему длительности заданий.
+    """
+    def __init__(self, max_per_user: int, initial_estimate: float):
+        self.max_per_user = max_per_user
+        self._avg_duration = float(initial_estimate)
+        self._queues = OrderedDict()
+        self._served = {}
+        self._serial = 0
+        self._current = None
+        self._current_started = None
+        self._wakeup = None
+        self._dispatcher = None
+    
+    @property
+    def waiting(self) -> int:
+        return sum(1 for jobs in self._queues.values() for job in jobs if not job["future"].done())
+    
+    def pending_for(self, user_id: int) -> int:
+        """Сколько заданий пользователя ждут или выполняются"""
+        count = sum(1 for job in self._queues.get(user_id, ()) if not job["future"].done())
+        if self._current is not None and self._current["user_id"] == user_id:
+            count += 1
+        return count
+    
+    async def run(self, user_id: int, factory, on_wait=None, on_start=None):
+        """
+        Поставить задание в очередь и дождаться результата.
+        
+        factory — функция без аргументов, возвращающая корутину сканирования;
+        on_wait(position, eta_seconds) и on_start() — корутины уведомлений.
+        """
+        if self.pending_for(user_id) >= self.max_per_user:
+            raise ScanQueueFull(
+                f"Лимит заданий в очереди сканирования: {self.max_per_user}. Дождитесь завершения предыдущих."
+            )
+        loop = asyncio.get_event_loop()
+        job = {
+            "user_id": user_id,
+            "factory": factory,
+            "on_wait": on_wait,
+            "on_start": on_start,
+            "future": loop.create_future(),
+            "position": None,
+        }
+        self._queues.setdefault(user_id, deque()).append(job)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._wakeup.set()
+        if self._current is not None:
+            # Если сканер свободен, диспетчер сразу возьмёт задание и сам разошлёт позиции
+            await self._notify_waiting()
+        return await job["future"]
+    
+    @staticmethod
+    def _pick_user(lanes: dict, served: dict):
+        """Пользователь, которого обслуживали давнее всех (при равенстве — кто раньше встал в очередь)"""
+        candidates = [user_id for user_id, jobs in lanes.items() if jobs]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda user_id: served.get(user_id, -1))
+    
+    def _next_job(self):
+        """Первое живое задание у следующего по кругу пользователя"""
+        for user_id in list(self._queues):
+            jobs = self._queues[user_id]
+            while jobs and jobs[0]["future"].done():
+                # Ожидающий отменил задание
+                jobs.popleft()
+            if not jobs:
+                del self._queues[user_id]
+        user_id = self._pick_user(self._queues, self._served)
+        if user_id is None:
+            return None
+        job = self._queues[user_id].popleft()
+        if not self._queues[user_id]:
+            del self._queues[user_id]
+        self._serial += 1
+        self._served[user_id] = self._serial
+        return job
+    
+    def _projected_order(self) -> list:
+        """Порядок, в котором будут выполнены ожидающие задания"""
+        lanes = OrderedDict(
+            (user_id, [job for job in jobs if not job["future"].done()])
+            for user_id, jobs in self._queues.items()
+        )
+        served = dict(self._served)
+        serial = self._serial
+        order = []
+        while True:
+            user_id = self._pick_user(lanes, served)
+            if user_id is None:
+                return order
+            order.append(lanes[user_id].pop(0))
+            serial += 1
+            served[user_id] = serial
+    
+    def _eta(self, position: int) -> float:
+        remaining = 0.0
+        if self._current is not None:
+            elapsed = asyncio.get_event_loop().time() - self._current_started
+            remaining = max(self._avg_duration - elapsed, 5.0)
+        return remaining + (position - 1) * self._avg_duration
+    
+    async def _safe_call(self, callback, *args):
+        if callback is None:
+            return
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.debug("Не удалось уведомить об очереди сканирования: %s", e)
+    
+    async def _notify_waiting(self):
+        for position, job in enumerate(self._projected_order(), 1):
+            if job["position"] != position:
+                job["position"] = position
+                await self._safe_call(job["on_wait"], position, self._eta(position))
+    
+    async def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._current = job
+            self._current_started = loop.time()
+            await self._notify_waiting()
+            try:
+                await self._safe_call(job["on_start"])
+                result = await job["factory"]()
+                if not job["future"].done():
+                    job["future"].set_result(result)
+            except Exception as e:
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+            finally:
+                duration = loop.time() - self._current_started
+                self._avg_duration = 0.7 * self._avg_duration + 0.3 * duration
+                self._current = None
+
 class ScanBot:
     def __init__(self):
         self.application = None
         self.bot = None
+        self.scan_queue = ScanJobQueue(config.SCAN_QUEUE_MAX_PER_USER, config.SCAN_JOB_ESTIMATE_SECONDS)
+        # Сканирования с предпросмотром, которые можно отменить кнопкой: id -> состояние
+        self._preview_jobs = {}
+        self._preview_serial = 0
         
     async def initialize(self):
         """Инициализация бота"""
         try:
             # Создание приложения
-            self.application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+            # Обновления обрабатываются параллельно: иначе нажатие второго пользователя не дошло бы
+            # до очереди сканирования, пока идёт скан (печать, /status и /cleanup тоже не ждут друг друга)
+            self.application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
             self.bot = self.application.bot
             
             # Регистрация обработчиков команд
@@ -128,6 +292,12 @@ class ScanBot:
             await self._handle_scan_source_choice(query, context)
         elif query.data and query.data.startswith("scan_source:"):
             await self._handle_scan_source_selected(query, context)
+        elif query.data and query.data.startswith("scan_batch:"):
+            await self._handle_scan_source_selected(query, context, batch=True)
+        elif query.data and query.data.startswith("scan_area:"):
+            await self._handle_scan_area_selected(query, context)
+        elif query.data and query.data.startswith("scan_cancel:"):
+            await self._handle_scan_cancel(query)
         elif query.data == "status":
             await self._handle_status_callback(query)
         elif query.data == "print":
@@ -144,6 +314,8 @@ class ScanBot:
         buttons = []
         for i, (sane_value, label) in enumerate(sources):
             buttons.append([InlineKeyboardButton(label, callback_data=f"scan_source:{i}")])
+            if scanner.is_feeder_source(sane_value):
+                buttons.append([InlineKeyboardButton("📚 Все страницы из фидера в PDF", callback_data=f"scan_batch:{i}")])
         buttons.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")])
         return InlineKeyboardMarkup(buttons)
 
@@ -165,8 +337,8 @@ class ScanBot:
         )
         logger.info("Пользователь %s выбрал сканирование, показан выбор источника", user_id)
 
-    async def _handle_scan_source_selected(self, query, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка выбора источника: scan_source:0, scan_source:1, ..."""
+    async def _handle_scan_source_selected(self, query, context: ContextTypes.DEFAULT_TYPE, batch: bool = False):
+        """Обработка выбора источника: scan_source:0, scan_source:1, ... (scan_batch:N — пакетное сканирование)"""
         try:
             idx = int(query.data.split(":", 1)[1])
         except (ValueError, IndexError):
@@ -183,33 +355,267 @@ class ScanBot:
             )
             return
         sane_value = sources[idx][0]
-        await self._do_scan_and_send(query, context, source=sane_value)
+        if batch:
+            await self._do_batch_scan_and_send(query, context, source=sane_value)
+        elif area_presets() and not scanner.is_feeder_source(sane_value):
+            await query.edit_message_text(
+                "Выберите область сканирования:",
+                reply_markup=self._get_scan_area_keyboard(idx)
+            )
+        else:
+            await self._do_scan_and_send(query, context, source=sane_value)
+    
+    def _get_scan_area_keyboard(self, source_idx: int):
+        """Клавиатура пресетов области: scan_area:<индекс источника>:<пресет>"""
+        buttons = [[InlineKeyboardButton("🖼️ Весь планшет", callback_data=f"scan_area:{source_idx}:full")]]
+        row = []
+        for key, label in area_presets():
+            row.append(InlineKeyboardButton(label, callback_data=f"scan_area:{source_idx}:{key}"))
+            if len(row) == 2:
+                buttons.append(row)
+                row = []
+        if row:
+            buttons.append(row)
+        buttons.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")])
+        return InlineKeyboardMarkup(buttons)
+    
+    async def _handle_scan_area_selected(self, query, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка выбора области: scan_area:<индекс источника>:<пресет>"""
+        try:
+            _, idx, area = query.data.split(":", 2)
+            idx = int(idx)
+        except ValueError:
+            idx, area = -1, None
+        sources = context.user_data.get("scan_sources") or []
+        if idx < 0 or idx >= len(sources):
+            await query.edit_message_text(
+                "❌ Неверный выбор. Выберите действие:",
+                reply_markup=self._get_main_keyboard()
+            )
+            return
+        await self._do_scan_and_send(query, context, source=sources[idx][0], area=None if area == "full" else area)
 
-    async def _do_scan_and_send(self, query, context: ContextTypes.DEFAULT_TYPE, source=None):
+    def _format_eta(self, seconds: float) -> str:
+        """Примерное время ожидания в читаемом виде"""
+        seconds = int(round(seconds))
+        if seconds < 60:
+            return f"~{max(seconds, 5)} с"
+        return f"~{(seconds + 59) // 60} мин"
+    
+    def _scan_queue_callbacks(self, edit, start_text: str):
+        """Уведомления очереди сканирования через функцию редактирования сообщения"""
+        async def on_wait(position: int, eta: float):
+            await edit(
+                f"⏳ Сканер занят другими заданиями.\n\n"
+                f"Ваше место в очереди: {position}\n"
+                f"Примерное ожидание: {self._format_eta(eta)}"
+            )
+        
+        async def on_start():
+            await edit(start_text)
+        
+        return on_wait, on_start
+    
+    async def _scan_for_delivery(self, user_id: int, source, on_wait, on_start, preview_message=None, area=None):
+        """
+        Сканирование через очередь с учётом SCAN_DELIVERY.
+        
+        Если передан preview_message, в ответ на него сначала отправляется
+        предпросмотр с кнопкой отмены (SCAN_PREVIEW), а полный скан идёт
+        в том же задании очереди, чтобы сканер не перехватили между фазами.
+        area — пресет области сканирования, None — весь планшет.
+        Возвращает (имя файла, данные) для доставки из памяти,
+        (имя файла, Path) для доставки с диска или None, если файл не создан.
+        """
+        job = None
+        if preview_message is not None and config.SCAN_PREVIEW and not (source and scanner.is_feeder_source(source)):
+            self._preview_serial += 1
+            job = {"id": self._preview_serial, "user_id": user_id, "cancelled": False, "full": False, "message": None}
+        
+        async def run_scan():
+            if job:
+                await self._send_preview(preview_message, source, area, job)
+                if job["cancelled"]:
+                    raise ScanCancelled("Сканирование отменено")
+                job["full"] = True
+            try:
+                if config.SCAN_DELIVERY == 'memory':
+                    return await scanner.scan_to_memory(source=source, area=area)
+                return await scanner.scan_document(source=source, area=area)
+            except ScannerError:
+                if job and job["cancelled"]:
+                    raise ScanCancelled("Сканирование отменено")
+                raise
+        
+        if job:
+            self._preview_jobs[job["id"]] = job
+        try:
+            result = await self.scan_queue.run(user_id, run_scan, on_wait, on_start)
+        finally:
+            if job:
+                self._preview_jobs.pop(job["id"], None)
+                await self._close_preview(job)
+        if job and job["cancelled"]:
+            # Отмена пришла, когда скан уже дочитан: результат не отправляем
+            raise ScanCancelled("Сканирование отменено")
+        if config.SCAN_DELIVERY == 'memory':
+            return result
+        if result and result.exists():
+            return result.name, result
+        return None
+    
+    async def _send_preview(self, message, source, area, job: dict):
+        """Предпросмотр в низком разрешении с кнопкой отмены полного скана"""
+        try:
+            preview = await scanner.scan_preview(source=source, area=area)
+        except ScannerError as e:
+            logger.warning("Предпросмотр не получен, продолжаю полное сканирование: %s", e)
+            return
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔ Отменить сканирование", callback_data=f"scan_cancel:{job['id']}")]
+        ])
+        try:
+            job["message"] = await message.reply_photo(
+                photo=preview,
+                caption=f"👀 Предпросмотр ({config.SCAN_PREVIEW_DPI} DPI)\n🔄 Идёт сканирование в {config.SCAN_DPI} DPI...",
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            logger.warning("Не удалось отправить предпросмотр: %s", e)
+    
+    async def _close_preview(self, job: dict):
+        """Убрать кнопку отмены с предпросмотра после завершения задания"""
+        if not job["message"]:
+            return
+        caption = "👀 Предпросмотр\n⛔ Сканирование отменено" if job["cancelled"] else "👀 Предпросмотр"
+        try:
+            await job["message"].edit_caption(caption=caption, reply_markup=None)
+        except Exception as e:
+            logger.debug("Не удалось обновить предпросмотр: %s", e)
+    
+    async def _handle_scan_cancel(self, query):
+        """Кнопка отмены на предпросмотре: scan_cancel:<id>"""
+        try:
+            job_id = int(query.data.split(":", 1)[1])
+        except (ValueError, IndexError):
+            return
+        job = self._preview_jobs.get(job_id)
+        if not job or job["cancelled"]:
+            return
+        if job["user_id"] != query.from_user.id:
+            await query.message.reply_text("❌ Отменить сканирование может только тот, кто его запустил.")
+            return
+        job["cancelled"] = True
+        logger.info("Пользователь %s отменил сканирование", query.from_user.id)
+        try:
+            await query.edit_message_caption(caption="👀 Предпросмотр\n⏳ Отменяю сканирование...", reply_markup=None)
+        except Exception as e:
+            logger.debug("Не удалось обновить предпросмотр: %s", e)
+        if job["full"]:
+            # sane_cancel прерывает идущее чтение и освобождает сканер
+            await scanner.cancel_scan()
+    
+    async def _send_scan(self, message, filename: str, payload, caption: str):
+        """Отправка скана из буфера или файла; копия в архив пишется уже после отправки"""
+        if isinstance(payload, bytes):
+            await message.reply_document(document=payload, filename=filename, caption=caption)
+            if config.SCAN_ARCHIVE:
+                scanner.archive_scan(filename, payload)
+            return
+        with open(payload, "rb") as file:
+            await message.reply_document(document=file, filename=filename, caption=caption)
+    
+    async def _do_batch_scan_and_send(self, query, context: ContextTypes.DEFAULT_TYPE, source=None):
+        """Пакетное сканирование всех страниц из фидера в один PDF с прогрессом по страницам."""
+        user_id = query.from_user.id
+        await query.edit_message_text("🔄 Сканирую страницы из фидера...\n\nПожалуйста, подождите...")
+        
+        async def progress(pages: int):
+            try:
+                await query.edit_message_text(f"🔄 Сканирую страницы из фидера...\n\n📄 Готово страниц: {pages}")
+            except Exception as e:
+                logger.debug("Не удалось обновить прогресс сканирования: %s", e)
+        
+        try:
+            logger.info("Пользователь %s запросил пакетное сканирование (источник: %s)", user_id, source)
+            on_wait, on_start = self._scan_queue_callbacks(
+                query.edit_message_text, "🔄 Сканирую страницы из фидера...\n\nПожалуйста, подождите..."
+            )
+            scan_file, pages = await self.scan_queue.run(
+                user_id, lambda: scanner.scan_batch(source=source, progress=progress), on_wait, on_start
+            )
+            await query.edit_message_text(f"📤 Отправляю PDF ({pages} стр.)...")
+            with open(scan_file, "rb") as file:
+                await query.message.reply_document(
+                    document=file,
+                    filename=scan_file.name,
+                    caption=f"📚 Отсканировано страниц: {pages}\n🕐 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
+                )
+            await query.edit_message_text(
+                f"✅ Документ из {pages} стр. отсканирован и отправлен!\n\nВыберите следующее действие:",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Файл %s (%s стр.) отправлен пользователю %s", scan_file.name, pages, user_id)
+        except ScanQueueFull as e:
+            await query.edit_message_text(
+                f"⏳ {e}",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Пользователь %s превысил лимит очереди сканирования", user_id)
+        except ScannerError as e:
+            await query.edit_message_text(
+                f"❌ Ошибка сканера: {e}\n\nПроверьте, что бумага лежит в фидере, и попробуйте еще раз.",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.error("Ошибка пакетного сканирования для пользователя %s: %s", user_id, e)
+        except Exception as e:
+            await query.edit_message_text(
+                f"❌ Неожиданная ошибка: {e}\n\nПопробуйте еще раз позже.",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.error("Неожиданная ошибка при пакетном сканировании для пользователя %s: %s", user_id, e)
+
+    async def _do_scan_and_send(self, query, context: ContextTypes.DEFAULT_TYPE, source=None, area=None):
         """Выполнить сканирование с выбранным источником и отправить файл (для callback от кнопок)."""
         user_id = query.from_user.id
         await query.edit_message_text("🔄 Начинаю сканирование...\n\nПожалуйста, подождите...")
         try:
-            logger.info("Пользователь %s запросил сканирование (источник: %s)", user_id, source or "по умолчанию")
-            scan_file = await scanner.scan_document(source=source)
-            if scan_file and scan_file.exists():
+            logger.info("Пользователь %s запросил сканирование (источник: %s, область: %s)",
+                        user_id, source or "по умолчанию", area or "весь планшет")
+            on_wait, on_start = self._scan_queue_callbacks(
+                query.edit_message_text, "🔄 Сканирую...\n\nПожалуйста, подождите..."
+            )
+            scan = await self._scan_for_delivery(user_id, source, on_wait, on_start,
+                                                 preview_message=query.message, area=area)
+            if scan:
+                filename, payload = scan
                 await query.edit_message_text("📤 Отправляю отсканированный документ...")
-                with open(scan_file, "rb") as file:
-                    await query.message.reply_document(
-                        document=file,
-                        filename=scan_file.name,
-                        caption=f"📄 Документ отсканирован\n🕐 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
-                    )
+                await self._send_scan(
+                    query.message, filename, payload,
+                    f"📄 Документ отсканирован\n🕐 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
+                )
                 await query.edit_message_text(
                     "✅ Документ успешно отсканирован и отправлен!\n\nВыберите следующее действие:",
                     reply_markup=self._get_main_keyboard()
                 )
-                logger.info("Файл %s отправлен пользователю %s", scan_file.name, user_id)
+                logger.info("Файл %s отправлен пользователю %s", filename, user_id)
             else:
                 await query.edit_message_text(
                     "❌ Ошибка: файл сканирования не создан\n\nПопробуйте еще раз или проверьте статус сканера.",
                     reply_markup=self._get_main_keyboard()
                 )
+        except ScanCancelled:
+            await query.edit_message_text(
+                "⛔ Сканирование отменено\n\nВыберите следующее действие:",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Сканирование пользователя %s отменено", user_id)
+        except ScanQueueFull as e:
+            await query.edit_message_text(
+                f"⏳ {e}",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Пользователь %s превысил лимит очереди сканирования", user_id)
         except ScannerError as e:
             await query.edit_message_text(
                 f"❌ Ошибка сканера: {e}\n\nПопробуйте еще раз или обратитесь к администратору.",
@@ -239,6 +645,7 @@ class ScanBot:
             
             scanner_emoji = {
                 "ready": "✅",
+                "busy": "🔄",
                 "not_initialized": "⚠️",
                 "error": "❌"
             }.get(scanner_status["status"], "❓")
@@ -255,6 +662,8 @@ class ScanBot:
             scanner_dpi = str(scanner_status.get("dpi", config.SCAN_DPI))
             scanner_mode = html.escape(str(scanner_status.get("mode", config.SCAN_MODE)))
             scanner_format = html.escape(str(scanner_status.get("format", config.SCAN_FORMAT)))
+            scanner_queue = str(scanner_status.get("queue_depth", 0) + self.scan_queue.waiting)
+            scanner_busy_time = str(scanner_status.get("busy_seconds", 0))
             
             printer_message = html.escape(str(printer_status.get("message", "Неизвестно")))
             printer_name = html.escape(str(printer_status.get("name", config.PRINTER_NAME)))
@@ -269,6 +678,8 @@ class ScanBot:
 <b>Разрешение:</b> {scanner_dpi} DPI
 <b>Режим:</b> {scanner_mode}
 <b>Формат:</b> {scanner_format}
+<b>Очередь сканера:</b> {scanner_queue}
+<b>Время работы сканера:</b> {scanner_busy_time} с
 
 {printer_emoji} <b>Статус принтера</b>
 
@@ -485,26 +896,40 @@ class ScanBot:
         status_message = await update.message.reply_text("🔄 Начинаю сканирование...\n\nПожалуйста, подождите...")
         try:
             logger.info("Пользователь %s запросил сканирование через команду", user_id)
-            scan_file = await scanner.scan_document()
-            if scan_file and scan_file.exists():
+            on_wait, on_start = self._scan_queue_callbacks(
+                status_message.edit_text, "🔄 Сканирую...\n\nПожалуйста, подождите..."
+            )
+            scan = await self._scan_for_delivery(user_id, None, on_wait, on_start, preview_message=update.message)
+            if scan:
+                filename, payload = scan
                 await status_message.edit_text("📤 Отправляю отсканированный документ...")
-                with open(scan_file, "rb") as file:
-                    await update.message.reply_document(
-                        document=file,
-                        filename=scan_file.name,
-                        caption=f"📄 Документ отсканирован\n🕐 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
-                    )
+                await self._send_scan(
+                    update.message, filename, payload,
+                    f"📄 Документ отсканирован\n🕐 {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"
+                )
                 await status_message.delete()
                 await update.message.reply_text(
                     "✅ Документ успешно отсканирован и отправлен!\n\nВыберите следующее действие:",
                     reply_markup=self._get_main_keyboard()
                 )
-                logger.info("Файл %s отправлен пользователю %s", scan_file.name, user_id)
+                logger.info("Файл %s отправлен пользователю %s", filename, user_id)
             else:
                 await status_message.edit_text(
                     "❌ Ошибка: файл сканирования не создан\n\nПопробуйте еще раз или проверьте статус сканера.",
                     reply_markup=self._get_main_keyboard()
                 )
+        except ScanCancelled:
+            await status_message.edit_text(
+                "⛔ Сканирование отменено\n\nВыберите следующее действие:",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Сканирование пользователя %s отменено", user_id)
+        except ScanQueueFull as e:
+            await status_message.edit_text(
+                f"⏳ {e}",
+                reply_markup=self._get_main_keyboard()
+            )
+            logger.info("Пользователь %s превысил лимит очереди сканирования", user_id)
         except ScannerError as e:
             await status_message.edit_text(
                 f"❌ Ошибка сканера: {e}\n\nПопробуйте еще раз или обратитесь к администратору.",
@@ -535,6 +960,7 @@ class ScanBot:
             
             scanner_emoji = {
                 "ready": "✅",
+                "busy": "🔄",
                 "not_initialized": "⚠️",
                 "error": "❌"
             }.get(scanner_status["status"], "❓")
@@ -551,6 +977,8 @@ class ScanBot:
             scanner_dpi = str(scanner_status.get("dpi", config.SCAN_DPI))
             scanner_mode = html.escape(str(scanner_status.get("mode", config.SCAN_MODE)))
             scanner_format = html.escape(str(scanner_status.get("format", config.SCAN_FORMAT)))
+            scanner_queue = str(scanner_status.get("queue_depth", 0) + self.scan_queue.waiting)
+            scanner_busy_time = str(scanner_status.get("busy_seconds", 0))
             
             printer_message = html.escape(str(printer_status.get("message", "Неизвестно")))
             printer_name = html.escape(str(printer_status.get("name", config.PRINTER_NAME)))
@@ -566,6 +994,8 @@ class ScanBot:
 <b>Разрешение:</b> {scanner_dpi} DPI
 <b>Режим:</b> {scanner_mode}
 <b>Формат:</b> {scanner_format}
+<b>Очередь сканера:</b> {scanner_queue}
+<b>Время работы сканера:</b> {scanner_busy_time} с
 
 {printer_emoji} <b>Статус принтера</b>
 
@@ -636,6 +1066,26 @@ class ScanBot:
             await self.handle_print_request(update, context)
         # Иначе - игнорируем (текстовые сообщения без команд)
     
+    @staticmethod
+    async def _telegram_file_chunks(url: str) -> AsyncIterator[bytes]:
+        """
+        Скачивание файла Telegram блоками по мере поступления, без записи на диск
+        
+        В URL файла есть токен бота, а текст исключений httpx содержит URL,
+        поэтому наружу уходит только код ответа или тип ошибки.
+        """
+        try:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0)) as client:
+                async with client.stream('GET', url) as response:
+                    if response.status_code != 200:
+                        logger.warning("Telegram вернул HTTP %s при скачивании файла", response.status_code)
+                        raise PrinterError(f"Telegram вернул HTTP {response.status_code} при скачивании файла")
+                    async for chunk in response.aiter_bytes(64 * 1024):
+                        yield chunk
+        except httpx.HTTPError as e:
+            logger.warning("Ошибка скачивания файла из Telegram: %s", type(e).__name__)
+            raise PrinterError(f"Не удалось скачать файл из Telegram ({type(e).__name__})")
+    
     async def handle_print_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик запросов на печать файлов"""
         logger.info(f"Обработка файла для печати от пользователя {update.effective_user.id}")
@@ -700,6 +1150,8 @@ class ScanBot:
         
         user_id = update.effective_user.id
         status_message = await update.message.reply_text("🖨️ Подготовка файла к печати...")
+        # Файл, скачанный этим обработчиком; только его и нужно удалить в конце
+        downloaded_path = None
         
         try:
             # Определяем тип файла и получаем его
@@ -721,19 +1173,38 @@ class ScanBot:
                 await status_message.edit_text("❌ Не удалось определить тип файла для печати.")
                 return
             
-            # Скачиваем файл
-            await status_message.edit_text("📥 Скачиваю файл...")
-            file = await file_to_download.get_file()
-            
-            # Сохраняем во временную директорию
-            temp_file = config.PRINT_TEMP_DIR / file_name
-            await file.download_to_drive(temp_file)
+            # Этот файл уже печатали — берём готовый к печати из кэша без скачивания
+            unique_id = file_to_download.file_unique_id
+            cached_file = printer.cache.lookup(unique_id)
+            file = None
+            if cached_file is not None:
+                logger.info(f"Файл {file_name} найден в кэше печати, скачивание не нужно")
+            else:
+                file = await file_to_download.get_file()
             
             logger.info(f"Пользователь {user_id} запросил печать файла: {file_name}")
             
-            # Отправляем на печать
-            await status_message.edit_text("🖨️ Отправляю на печать...")
-            success = await printer.print_file(temp_file)
+            streamable = (file is not None and file.file_path and printer.can_stream(file_name)
+                          and file.file_path.startswith(('http://', 'https://')))
+            if streamable:
+                # PDF и изображения уходят на принтер прямо во время скачивания
+                await status_message.edit_text("🖨️ Скачиваю и отправляю на печать...")
+                success = await printer.print_stream(
+                    file_name, self._telegram_file_chunks(file.file_path), size=file.file_size,
+                    unique_id=unique_id
+                )
+            else:
+                print_path = cached_file
+                if file is not None:
+                    # Скачиваем файл во временную директорию
+                    await status_message.edit_text("📥 Скачиваю файл...")
+                    downloaded_path = config.PRINT_TEMP_DIR / file_name
+                    await file.download_to_drive(downloaded_path)
+                    print_path = downloaded_path
+                
+                # Отправляем на печать
+                await status_message.edit_text("🖨️ Отправляю на печать...")
+                success = await printer.print_file(print_path, unique_id=unique_id)
             
             # Сбрасываем флаг ожидания файла после обработки
             context.user_data['waiting_for_print'] = False
@@ -782,12 +1253,12 @@ class ScanBot:
             )
             logger.error(f"Неожиданная ошибка при печати для пользователя {user_id}: {e}")
         finally:
-            # Очистка временного файла
-            if 'temp_file' in locals() and temp_file.exists():
+            # Очистка скачанного файла; файлы кэша печати не трогаем
+            if downloaded_path is not None and downloaded_path.exists():
                 try:
-                    temp_file.unlink()
+                    downloaded_path.unlink()
                 except Exception as e:
-                    logger.warning(f"Не удалось удалить временный файл {temp_file}: {e}")
+                    logger.warning(f"Не удалось удалить временный файл {downloaded_path}: {e}")
     
     async def unknown_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик неизвестных сообщений"""
@@ -869,6 +1340,9 @@ class ScanBot:
                     await cleanup_task
                 except asyncio.CancelledError:
                     logger.info("Задача автоочистки отменена")
+                
+                # Останавливаем LibreOffice и соединение с CUPS
+                await printer.close()
             
         except Exception as e:
             import traceback
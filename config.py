@@ -21,19 +21,103 @@ TELEGRAM_CHAT_IDS = [
 
 # Настройки сканера
 SCANNER_DEVICE = config('SCANNER_DEVICE', default='')
+# Кэш найденного устройства и ограничений его опций (ускоряет инициализацию после перезапуска)
+SCANNER_CACHE_FILE = Path(config('SCANNER_CACHE_FILE', default=str(BASE_DIR / 'scanner_cache.json')))
 SCAN_DPI = config('SCAN_DPI', default=300, cast=int)
 SCAN_FORMAT = config('SCAN_FORMAT', default='PNG')
+# Для SCAN_FORMAT=AUTO: допустимые форматы в порядке предпочтения, выбирается самый компактный
+SCAN_AUTO_FORMATS = [
+    fmt.strip().upper()
+    for fmt in config('SCAN_AUTO_FORMATS', default='TIFF,PDF').split(',')
+    if fmt.strip()
+]
 SCAN_MODE = config('SCAN_MODE', default='Color')
+# Качество JPEG (и JPEG внутри PDF) и нижняя граница при подгонке под MAX_FILE_SIZE_MB
+SCAN_JPEG_QUALITY = config('SCAN_JPEG_QUALITY', default=85, cast=int)
+SCAN_MIN_JPEG_QUALITY = config('SCAN_MIN_JPEG_QUALITY', default=40, cast=int)
+SCAN_WEBP_QUALITY = config('SCAN_WEBP_QUALITY', default=80, cast=int)
+# MRC: во сколько раз фон и цвет текста меньше разрешения маски текста
+SCAN_MRC_BG_FACTOR = config('SCAN_MRC_BG_FACTOR', default=3, cast=int)
+SCAN_MRC_FG_FACTOR = config('SCAN_MRC_FG_FACTOR', default=6, cast=int)
+# Обработка кадра перед кодированием: выравнивание наклона (до SCAN_DESKEW_MAX_ANGLE градусов)
+# и обрезка по границам документа, если он занимает меньше SCAN_CROP_MAX_AREA площади стекла
+SCAN_DESKEW = config('SCAN_DESKEW', default=True, cast=bool)
+SCAN_DESKEW_MAX_ANGLE = config('SCAN_DESKEW_MAX_ANGLE', default=5.0, cast=float)
+SCAN_AUTO_CROP = config('SCAN_AUTO_CROP', default=True, cast=bool)
+SCAN_CROP_MAX_AREA = config('SCAN_CROP_MAX_AREA', default=0.5, cast=float)
+# Понижение цветового режима по содержимому: серый или ч/б, если на странице нет цвета
+# (доля цветных пикселей < SCAN_COLOR_THRESHOLD) и полутонов (< SCAN_BW_MAX_MIDTONES от всех тёмных)
+SCAN_AUTO_COLOR = config('SCAN_AUTO_COLOR', default=True, cast=bool)
+SCAN_COLOR_THRESHOLD = config('SCAN_COLOR_THRESHOLD', default=0.002, cast=float)
+SCAN_BW_MAX_MIDTONES = config('SCAN_BW_MAX_MIDTONES', default=0.4, cast=float)
+# Бюджет памяти на рабочие буферы одной полосы при обработке кадра (обрезка, выравнивание,
+# бинаризация, масштабирование идут полосами, чтобы кадр 600 DPI в цвете не занимал память дважды)
+SCAN_TILE_MEMORY_MB = config('SCAN_TILE_MEMORY_MB', default=16, cast=int)
+# Двухфазное сканирование: сначала быстрый предпросмотр с кнопкой отмены, затем полный скан
+SCAN_PREVIEW = config('SCAN_PREVIEW', default=False, cast=bool)
+SCAN_PREVIEW_DPI = config('SCAN_PREVIEW_DPI', default=75, cast=int)
+# Пресеты области сканирования в меню (a4, a5, receipt, id_card, business_card)
+# и свой размер в мм вида '100x150'; пустой список без своего размера отключает выбор области
+SCAN_AREA_PRESETS = [
+    preset.strip()
+    for preset in config('SCAN_AREA_PRESETS', default='a4,a5,receipt,id_card,business_card').split(',')
+    if preset.strip()
+]
+SCAN_CUSTOM_AREA_MM = config('SCAN_CUSTOM_AREA_MM', default='')
+# Изоляция SANE: 'thread' — устройство в процессе бота, 'process' — в отдельном процессе со сторожем
+SCANNER_ISOLATION = config('SCANNER_ISOLATION', default='thread')
+SCANNER_OP_TIMEOUT = config('SCANNER_OP_TIMEOUT', default=30, cast=int)
+SCANNER_SCAN_TIMEOUT = config('SCANNER_SCAN_TIMEOUT', default=300, cast=int)
+# Потоковое сканирование: строки из sane_read сразу кодируются в PNG/PDF полосами
+SCAN_STREAMING = config('SCAN_STREAMING', default=False, cast=bool)
+SCAN_STREAM_STRIP_LINES = config('SCAN_STREAM_STRIP_LINES', default=64, cast=int)
+SCAN_STREAM_QUEUE = config('SCAN_STREAM_QUEUE', default=4, cast=int)
+# Пакетное сканирование из автоподатчика: сколько страниц может ждать кодирования в PDF
+SCAN_BATCH_MAX_PENDING = config('SCAN_BATCH_MAX_PENDING', default=3, cast=int)
+# Процессы для обработки и кодирования сканов (одиночных и пакетных): 0 — по числу ядер минус одно, -1 — без пула (поток)
+SCAN_ENCODE_PROCESSES = config('SCAN_ENCODE_PROCESSES', default=0, cast=int)
+# Пропуск пустых страниц при сканировании из автоподатчика: порог — доля площади с «чернилами»
+SCAN_SKIP_BLANK = config('SCAN_SKIP_BLANK', default=True, cast=bool)
+SCAN_BLANK_THRESHOLD = config('SCAN_BLANK_THRESHOLD', default=0.0005, cast=float)
+# Доставка скана: 'disk' — через файл в SCAN_DIR, 'memory' — из буфера в памяти;
+# SCAN_ARCHIVE — сохранять ли копию в SCAN_DIR в фоне после отправки (для 'memory')
+SCAN_DELIVERY = config('SCAN_DELIVERY', default='disk')
+SCAN_ARCHIVE = config('SCAN_ARCHIVE', default=True, cast=bool)
 
 # Настройки принтера
 PRINTER_NAME = config('PRINTER_NAME', default='HP_Color_LaserJet_Pro_MFP_M177fw')
 PRINT_TEMP_DIR = Path(config('PRINT_TEMP_DIR', default='/tmp/print_queue'))
+# Сервер CUPS для IPP: путь к Unix-сокету или host[:port]; пусто — /run/cups/cups.sock, если есть, иначе localhost:631
+CUPS_SERVER = config('CUPS_SERVER', default='')
+# Сколько секунд кэшируется состояние принтера для печати и /status
+PRINTER_STATUS_TTL = config('PRINTER_STATUS_TTL', default=10, cast=float)
+# Конвертация DOC/DOCX: постоянно запущенный LibreOffice (UNO через office_bridge.py,
+# нужен python3-uno у OFFICE_PYTHON) с постоянным профилем; останавливается после простоя
+OFFICE_DAEMON = config('OFFICE_DAEMON', default=True, cast=bool)
+OFFICE_BINARY = config('OFFICE_BINARY', default='/usr/bin/libreoffice')
+OFFICE_PYTHON = config('OFFICE_PYTHON', default='/usr/bin/python3')
+# Профиль постоянного офиса; по умолчанию рядом с временными файлами печати, а не в каталоге бота
+OFFICE_PROFILE_DIR = Path(config('OFFICE_PROFILE_DIR', default=str(PRINT_TEMP_DIR / 'office_profile')))
+OFFICE_IDLE_TIMEOUT = config('OFFICE_IDLE_TIMEOUT', default=600, cast=int)
+# Кэш готовых к печати файлов (по file_unique_id и хэшу содержимого) в PRINT_TEMP_DIR/cache; 0 — отключить
+PRINT_CACHE_MAX_MB = config('PRINT_CACHE_MAX_MB', default=200, cast=int)
+# PDF и изображения передаются CUPS по мере скачивания из Telegram; копия пишется попутно, только для кэша печати
+PRINT_STREAMING = config('PRINT_STREAMING', default=True, cast=bool)
+# Печать текстовых файлов: шрифт TrueType с кириллицей (пусто — DejaVu Sans Mono или другой
+# найденный моноширинный) и кегль в пунктах
+PRINT_TEXT_FONT = config('PRINT_TEXT_FONT', default='')
+PRINT_TEXT_FONT_SIZE = config('PRINT_TEXT_FONT_SIZE', default=10.0, cast=float)
 PRINTER_ALERT_USERNAMES = [
     username.strip()
     for username in config('PRINTER_ALERT_USERNAMES', default='swift2geek,valterolga86,ekittz11').split(',')
     if username.strip()
 ]
 
+# Очередь сканирования: лимит ожидающих заданий на пользователя и
+# начальная оценка длительности задания для расчёта времени ожидания
+SCAN_QUEUE_MAX_PER_USER = config('SCAN_QUEUE_MAX_PER_USER', default=2, cast=int)
+SCAN_JOB_ESTIMATE_SECONDS = config('SCAN_JOB_ESTIMATE_SECONDS', default=40, cast=int)
+
 # Системные настройки
 MAX_FILE_SIZE_MB = config('MAX_FILE_SIZE_MB', default=50, cast=int)
 CLEANUP_AFTER_HOURS = config('CLEANUP_AFTER_HOURS', default=24, cast=int)
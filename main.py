@@ -13,7 +13,6 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent))
 
 import config
-from bot import bot
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +28,11 @@ class GracefulShutdown:
 
 async def main():
     """Главная функция"""
+    # Бот импортируется здесь, а не в начале модуля: процессы пула кодирования
+    # (spawn) заново выполняют этот файл, и создавать в них бота, сканер и
+    # принтер незачем
+    from bot import bot
+    
     try:
         # Валидация конфигурации
         config.validate_config()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Мост к запущенному LibreOffice через UNO для конвертации документов в PDF
+
+Запускается системным python3 (нужен пакет python3-uno): в окружении бота
+модуля uno нет. Подключается к офису по именованному каналу, после чего
+читает из stdin строки JSON {"src": ..., "dst": ...} и на каждую отвечает
+в stdout {"ok": true} или {"ok": false, "error": ...}. Первая строка
+ответа — {"ready": true}, когда офис принял подключение.
+
+Использование: office_bridge.py <имя канала> [таймаут подключения, с]
+"""
+import json
+import sys
+import time
+
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+
+def _properties(**values) -> tuple:
+    result = []
+    for name, value in values.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        result.append(prop)
+    return tuple(result)
+
+def connect(pipe_name: str, timeout: float):
+    """Desktop запущенного офиса; ждёт, пока офис после старта откроет канал"""
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            context = resolver.resolve(f"uno:pipe,name={pipe_name};urp;StarOffice.ComponentContext")
+            return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+        except NoConnectException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+def convert(desktop, src: str, dst: str):
+    """Открытие документа без окна и экспорт в PDF"""
+    document = desktop.loadComponentFromURL(
+        uno.systemPathToFileUrl(src), "_blank", 0, _properties(Hidden=True, ReadOnly=True)
+    )
+    if document is None:
+        raise RuntimeError(f"LibreOffice не открыл документ {src}")
+    try:
+        document.storeToURL(uno.systemPathToFileUrl(dst), _properties(FilterName="writer_pdf_Export"))
+    finally:
+        document.close(True)
+
+def main():
+    timeout = float(sys.argv[2]) if len(sys.argv) > 2 else 60.0
+    desktop = connect(sys.argv[1], timeout)
+    print(json.dumps({"ready": True}), flush=True)
+    
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            convert(desktop, request["src"], request["dst"])
+            reply = {"ok": True}
+        except Exception as e:
+            reply = {"ok": False, "error": str(e)}
+        print(json.dumps(reply, ensure_ascii=False), flush=True)
+
+if __name__ == "__main__":
+    main()
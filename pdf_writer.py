@@ -0,0 +1,387 @@
+"""
+Минимальный потоковый PDF-писатель для сканов и печати
+
+Объекты пишутся в файл сразу по мере добавления, в памяти держатся
+только смещения для таблицы xref, поэтому многостраничный документ
+собирается с ограниченным расходом памяти.
+"""
+import struct
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+
+CATALOG_OBJ = 1
+PAGES_OBJ = 2
+
+def _num(value: float) -> str:
+    """Компактная запись числа для PDF"""
+    text = f"{value:.3f}".rstrip('0').rstrip('.')
+    return text if text not in ('', '-0') else '0'
+
+def _to_unicode_cmap(used: Dict[int, str]) -> bytes:
+    """CMap глиф → Юникод, чтобы текст из PDF можно было искать и копировать"""
+    lines = [
+        "/CIDInit /ProcSet findresource begin 12 dict begin begincmap",
+        "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+        "/CMapName /Adobe-Identity-UCS def /CMapType 2 def",
+        "1 begincodespacerange <0000> <FFFF> endcodespacerange",
+    ]
+    items: List[str] = [
+        f"<{gid:04X}> <{ch.encode('utf-16-be').hex().upper()}>" for gid, ch in sorted(used.items()) if gid
+    ]
+    for start in range(0, len(items), 100):
+        block = items[start:start + 100]
+        lines.append(f"{len(block)} beginbfchar")
+        lines.extend(block)
+        lines.append("endbfchar")
+    lines.append("endcmap CMapName currentdict /CMap defineresource pop end end")
+    return "\n".join(lines).encode('latin-1')
+
+class _LazyTable(dict):
+    """Словарь, значения которого вычисляются при первом обращении к ключу"""
+
+    def __init__(self, compute):
+        super().__init__()
+        self._compute = compute
+
+    def __missing__(self, key):
+        value = self[key] = self._compute(key)
+        return value
+
+class TrueTypeFont:
+    """
+    Шрифт TrueType для встраивания в PDF (Type0, Identity-H)
+    
+    Из файла читаются только таблицы, нужные для вёрстки: cmap (символ → глиф),
+    hmtx (ширины) и общие метрики. Файл встраивается целиком, текст в
+    содержимом страниц записывается номерами глифов.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.data = self.path.read_bytes()
+        if self.data[:4] not in (b"\x00\x01\x00\x00", b"true"):
+            raise ValueError(f"{self.path.name}: поддерживаются только шрифты TrueType (.ttf)")
+        num_tables = struct.unpack_from(">H", self.data, 4)[0]
+        self._tables = {}
+        for i in range(num_tables):
+            tag, _, offset, length = struct.unpack_from(">4sIII", self.data, 12 + 16 * i)
+            self._tables[tag.decode('latin-1')] = (offset, length)
+        for tag in ("head", "hhea", "hmtx", "maxp", "cmap"):
+            if tag not in self._tables:
+                raise ValueError(f"{self.path.name}: нет таблицы {tag}")
+        
+        head = self._tables["head"][0]
+        self.units_per_em = struct.unpack_from(">H", self.data, head + 18)[0]
+        self.bbox = [self._scale(v) for v in struct.unpack_from(">4h", self.data, head + 36)]
+        hhea = self._tables["hhea"][0]
+        ascender, descender = struct.unpack_from(">hh", self.data, hhea + 4)
+        self.ascent = self._scale(ascender)
+        self.descent = self._scale(descender)
+        self.cap_height = self.ascent
+        if "OS/2" in self._tables:
+            os2, length = self._tables["OS/2"]
+            if struct.unpack_from(">H", self.data, os2)[0] >= 2 and length >= 90:
+                self.cap_height = self._scale(struct.unpack_from(">h", self.data, os2 + 88)[0])
+        self.italic_angle = 0
+        self.fixed_pitch = False
+        if "post" in self._tables:
+            post = self._tables["post"][0]
+            self.italic_angle = struct.unpack_from(">i", self.data, post + 4)[0] / 65536
+            self.fixed_pitch = struct.unpack_from(">I", self.data, post + 12)[0] != 0
+        
+        num_glyphs = struct.unpack_from(">H", self.data, self._tables["maxp"][0] + 4)[0]
+        num_metrics = struct.unpack_from(">H", self.data, hhea + 34)[0]
+        advances = struct.unpack_from(f">{num_metrics * 2}h", self.data, self._tables["hmtx"][0])[::2]
+        self.widths = [self._scale(advances[min(gid, num_metrics - 1)] & 0xFFFF) for gid in range(num_glyphs)]
+        self.cmap = self._read_cmap()
+        self.name = self._postscript_name()
+        # Кэши по символам: строки кодируются и измеряются без вызова функции на каждый символ
+        self._hex = _LazyTable(lambda ch: f"{self.glyph(ch):04X}")
+        self._advance = _LazyTable(lambda ch: self.widths[self.glyph(ch)])
+
+    def _scale(self, value: int) -> int:
+        """Единицы шрифта → тысячные доли кегля"""
+        return round(value * 1000 / self.units_per_em)
+
+    def _read_cmap(self) -> Dict[int, int]:
+        """Юникодная подтаблица cmap: формат 12 (весь Юникод) или 4 (BMP)"""
+        cmap = self._tables["cmap"][0]
+        count = struct.unpack_from(">H", self.data, cmap + 2)[0]
+        subtables = {}
+        for i in range(count):
+            platform, encoding, offset = struct.unpack_from(">HHI", self.data, cmap + 4 + 8 * i)
+            subtables[(platform, encoding)] = cmap + offset
+        for key in ((3, 10), (0, 4), (0, 6), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0)):
+            if key not in subtables:
+                continue
+            offset = subtables[key]
+            fmt = struct.unpack_from(">H", self.data, offset)[0]
+            if fmt == 12:
+                return self._read_cmap12(offset)
+            if fmt == 4:
+                return self._read_cmap4(offset)
+        raise ValueError(f"{self.path.name}: нет юникодной таблицы cmap")
+
+    def _read_cmap4(self, offset: int) -> Dict[int, int]:
+        segments = struct.unpack_from(">H", self.data, offset + 6)[0] // 2
+        ends = struct.unpack_from(f">{segments}H", self.data, offset + 14)
+        starts_at = offset + 16 + segments * 2
+        starts = struct.unpack_from(f">{segments}H", self.data, starts_at)
+        deltas = struct.unpack_from(f">{segments}h", self.data, starts_at + segments * 2)
+        range_offsets_at = starts_at + segments * 4
+        range_offsets = struct.unpack_from(f">{segments}H", self.data, range_offsets_at)
+        result = {}
+        for i in range(segments):
+            for code in range(starts[i], ends[i] + 1):
+                if code == 0xFFFF:
+                    break
+                if range_offsets[i] == 0:
+                    gid = (code + deltas[i]) & 0xFFFF
+                else:
+                    at = range_offsets_at + i * 2 + range_offsets[i] + (code - starts[i]) * 2
+                    gid = struct.unpack_from(">H", self.data, at)[0]
+                    if gid:
+                        gid = (gid + deltas[i]) & 0xFFFF
+                if gid:
+                    result[code] = gid
+        return result
+
+    def _read_cmap12(self, offset: int) -> Dict[int, int]:
+        groups = struct.unpack_from(">I", self.data, offset + 12)[0]
+        result = {}
+        for i in range(groups):
+            start, end, gid = struct.unpack_from(">III", self.data, offset + 16 + 12 * i)
+            for code in range(start, end + 1):
+                result[code] = gid + code - start
+        return result
+
+    def _postscript_name(self) -> str:
+        """Имя шрифта (nameID 6) без символов, недопустимых в имени PDF"""
+        name = ""
+        if "name" in self._tables:
+            table = self._tables["name"][0]
+            count, storage = struct.unpack_from(">HH", self.data, table + 2)
+            for i in range(count):
+                platform, encoding, _, name_id, length, offset = struct.unpack_from(
+                    ">6H", self.data, table + 6 + 12 * i
+                )
+                if name_id != 6:
+                    continue
+                raw = self.data[table + storage + offset:table + storage + offset + length]
+                name = raw.decode('utf-16-be' if platform in (0, 3) else 'latin-1', errors='ignore')
+                break
+        name = "".join(ch for ch in name or self.path.stem if ch.isascii() and ch.isalnum() or ch in "-_")
+        return name or "Font"
+
+    def glyph(self, char: str) -> int:
+        """Номер глифа символа; 0 (.notdef), если в шрифте его нет"""
+        return self.cmap.get(ord(char), 0)
+
+    def char_width(self, char: str, size: float) -> float:
+        return self._advance[char] * size / 1000
+
+    def text_width(self, text: str, size: float) -> float:
+        """Ширина строки в пунктах при кегле size"""
+        return sum(map(self._advance.__getitem__, text)) * size / 1000
+
+    def encode(self, text: str) -> str:
+        """Строка как шестнадцатеричные номера глифов (кодировка Identity-H)"""
+        return "".join(map(self._hex.__getitem__, text))
+
+class PdfWriter:
+    def __init__(self, fileobj: BinaryIO):
+        self._file = fileobj
+        self._offsets = {}
+        self._next_obj = PAGES_OBJ + 1
+        self._pages = []
+        self._page = None
+        self._fonts = {}
+        self._closed = False
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+
+    def _tell(self) -> int:
+        return self._file.tell()
+
+    def _reserve(self) -> int:
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    def _write_object(self, num: int, body: bytes):
+        self._offsets[num] = self._tell()
+        self._write(f"{num} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    def add_object(self, body: str) -> int:
+        """Запись словаря или другого простого объекта"""
+        num = self._reserve()
+        self._write_object(num, body.encode('latin-1'))
+        return num
+
+    def add_stream(self, dictionary: str, data: bytes) -> int:
+        """Запись потокового объекта; dictionary — содержимое словаря без << >> и /Length"""
+        num = self._reserve()
+        head = f"<< {dictionary} /Length {len(data)} >>\nstream\n".encode('latin-1')
+        self._write_object(num, head + data + b"\nendstream")
+        return num
+
+    def add_image(self, data: bytes, width: int, height: int, colorspace: str = '/DeviceRGB',
+                  bits: int = 8, filter_name: Optional[str] = '/DCTDecode',
+                  decode_parms: Optional[str] = None, decode: Optional[str] = None,
+                  extra: str = '') -> int:
+        """Запись уже закодированного изображения как XObject"""
+        entries = [
+            "/Type /XObject /Subtype /Image",
+            f"/Width {width} /Height {height}",
+            f"/ColorSpace {colorspace} /BitsPerComponent {bits}",
+        ]
+        if filter_name:
+            entries.append(f"/Filter {filter_name}")
+        if decode_parms:
+            entries.append(f"/DecodeParms {decode_parms}")
+        if decode:
+            entries.append(f"/Decode {decode}")
+        if extra:
+            entries.append(extra)
+        return self.add_stream(" ".join(entries), data)
+
+    def add_image_mask(self, data: bytes, width: int, height: int, filter_name: Optional[str] = None,
+                       decode_parms: Optional[str] = None) -> int:
+        """
+        Запись 1-битной маски (/ImageMask); нулевые отсчёты закрашиваются.
+        
+        Используется как /Mask другого изображения (в том числе другого разрешения).
+        """
+        entries = [
+            "/Type /XObject /Subtype /Image",
+            f"/Width {width} /Height {height}",
+            "/ImageMask true /BitsPerComponent 1",
+        ]
+        if filter_name:
+            entries.append(f"/Filter {filter_name}")
+        if decode_parms:
+            entries.append(f"/DecodeParms {decode_parms}")
+        return self.add_stream(" ".join(entries), data)
+
+    def begin_page(self, width_pt: float, height_pt: float):
+        if self._page is not None:
+            raise RuntimeError("Предыдущая страница не завершена")
+        self._page = {"size": (width_pt, height_pt), "xobjects": {}, "fonts": set(), "ops": []}
+
+    def draw_image(self, image_obj: int, x: float, y: float, width: float, height: float):
+        """Размещение XObject на текущей странице (координаты в пунктах от левого нижнего угла)"""
+        name = f"Im{len(self._page['xobjects'])}"
+        self._page["xobjects"][name] = image_obj
+        self._page["ops"].append(
+            f"q {_num(width)} 0 0 {_num(height)} {_num(x)} {_num(y)} cm /{name} Do Q"
+        )
+
+    def add_font(self, font: TrueTypeFont) -> str:
+        """
+        Регистрация шрифта; возвращает имя ресурса для draw_text.
+        
+        Сам шрифт записывается в close(): к этому моменту известны все
+        использованные глифы для таблиц ширин и ToUnicode.
+        """
+        name = f"F{len(self._fonts)}"
+        self._fonts[name] = {"font": font, "obj": self._reserve(), "used": {}, "chars": set()}
+        return name
+
+    def draw_text(self, font_name: str, size: float, x: float, y: float, text: str):
+        """Строка текста на текущей странице (x, y — начало базовой линии в пунктах)"""
+        entry = self._fonts[font_name]
+        font = entry["font"]
+        new_chars = set(text) - entry["chars"]
+        if new_chars:
+            entry["chars"].update(new_chars)
+            for ch in new_chars:
+                entry["used"].setdefault(font.glyph(ch), ch)
+        self._page["fonts"].add(font_name)
+        self._page["ops"].append(
+            f"BT /{font_name} {_num(size)} Tf {_num(x)} {_num(y)} Td <{font.encode(text)}> Tj ET"
+        )
+
+    def add_content(self, operators: str):
+        """Произвольные операторы содержимого текущей страницы"""
+        self._page["ops"].append(operators)
+
+    def end_page(self) -> int:
+        page = self._page
+        content = zlib.compress("\n".join(page["ops"]).encode('latin-1'))
+        content_obj = self.add_stream("/Filter /FlateDecode", content)
+        resources = []
+        if page["xobjects"]:
+            xobjects = " ".join(f"/{name} {num} 0 R" for name, num in page["xobjects"].items())
+            resources.append(f"/XObject << {xobjects} >>")
+        if page["fonts"]:
+            fonts = " ".join(f"/{name} {self._fonts[name]['obj']} 0 R" for name in sorted(page["fonts"]))
+            resources.append(f"/Font << {fonts} >>")
+        width, height = page["size"]
+        page_obj = self.add_object(
+            f"<< /Type /Page /Parent {PAGES_OBJ} 0 R "
+            f"/MediaBox [0 0 {_num(width)} {_num(height)}] "
+            f"/Resources << {' '.join(resources)} >> /Contents {content_obj} 0 R >>"
+        )
+        self._pages.append(page_obj)
+        self._page = None
+        self._file.flush()
+        return page_obj
+
+    def _write_font(self, entry: dict):
+        """Type0-шрифт: встроенный файл, описание, ширины и ToUnicode для использованных глифов"""
+        font, used = entry["font"], entry["used"]
+        font_file = self.add_stream(
+            f"/Length1 {len(font.data)} /Filter /FlateDecode", zlib.compress(font.data)
+        )
+        flags = 32 | (1 if font.fixed_pitch else 0)
+        descriptor = self.add_object(
+            f"<< /Type /FontDescriptor /FontName /{font.name} /Flags {flags} "
+            f"/FontBBox [{' '.join(str(v) for v in font.bbox)}] /ItalicAngle {_num(font.italic_angle)} "
+            f"/Ascent {font.ascent} /Descent {font.descent} /CapHeight {font.cap_height} "
+            f"/StemV 80 /FontFile2 {font_file} 0 R >>"
+        )
+        widths = " ".join(f"{gid} [{font.widths[gid]}]" for gid in sorted(used))
+        cid_font = self.add_object(
+            f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{font.name} "
+            f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+            f"/FontDescriptor {descriptor} 0 R /W [{widths}] /CIDToGIDMap /Identity >>"
+        )
+        to_unicode = self.add_stream("/Filter /FlateDecode", zlib.compress(_to_unicode_cmap(used)))
+        self._write_object(
+            entry["obj"],
+            f"<< /Type /Font /Subtype /Type0 /BaseFont /{font.name} /Encoding /Identity-H "
+            f"/DescendantFonts [{cid_font} 0 R] /ToUnicode {to_unicode} 0 R >>".encode('latin-1')
+        )
+
+    def close(self):
+        """Шрифты, дерево страниц, каталог, xref и trailer"""
+        if self._closed:
+            return
+        if self._page is not None:
+            self.end_page()
+        for entry in self._fonts.values():
+            self._write_font(entry)
+        kids = " ".join(f"{num} 0 R" for num in self._pages)
+        self._write_object(
+            PAGES_OBJ,
+            f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>".encode('latin-1')
+        )
+        self._write_object(CATALOG_OBJ, f"<< /Type /Catalog /Pages {PAGES_OBJ} 0 R >>".encode('latin-1'))
+        xref_offset = self._tell()
+        size = self._next_obj
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(f"{self._offsets.get(num, 0):010d} 00000 n \n")
+        self._write("".join(lines).encode('latin-1'))
+        self._write(
+            f"trailer\n<< /Size {size} /Root {CATALOG_OBJ} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('latin-1')
+        )
+        self._file.flush()
+        self._closed = True
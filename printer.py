@@ -1,15 +1,27 @@
 """
 Модуль для работы с принтером HP Color LaserJet Pro MFP M177fw
 """
-import subprocess
 import logging
 import tempfile
 import os
+import getpass
+import http.client
+import socket
+import struct
+import json
+import hashlib
+import itertools
+import shutil
+import time
+import codecs
 from pathlib import Path
-from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, Optional, List, Tuple, Union
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import asyncio
 import config
+from pdf_writer import PdfWriter, TrueTypeFont
+from process_runner import ProcessRunner, ProcessTimeout, ToolNotFound
 
 logger = logging.getLogger(__name__)
 
@@ -17,19 +29,965 @@ class PrinterError(Exception):
     """Исключение для ошибок принтера"""
     pass
 
+# --- IPP-клиент CUPS ---
+
+# Сокет cupsd по умолчанию; в Docker CUPS слушает только его (Listen localhost:631 отключён)
+CUPS_DEFAULT_SOCKET = '/run/cups/cups.sock'
+
+IPP_PRINT_JOB = 0x0002
+IPP_GET_PRINTER_ATTRIBUTES = 0x000B
+IPP_RESUME_PRINTER = 0x0011
+CUPS_ACCEPT_JOBS = 0x4008
+
+IPP_TAG_OPERATION = 0x01
+IPP_TAG_JOB = 0x02
+IPP_TAG_END = 0x03
+IPP_TAG_PRINTER = 0x04
+
+IPP_INTEGER = 0x21
+IPP_BOOLEAN = 0x22
+IPP_ENUM = 0x23
+IPP_TEXT_WITH_LANGUAGE = 0x35
+IPP_NAME_WITH_LANGUAGE = 0x36
+IPP_TEXT = 0x41
+IPP_NAME = 0x42
+IPP_KEYWORD = 0x44
+IPP_URI = 0x45
+IPP_CHARSET = 0x47
+IPP_LANGUAGE = 0x48
+IPP_MIME_TYPE = 0x49
+
+# printer-state
+IPP_PRINTER_IDLE = 3
+IPP_PRINTER_PROCESSING = 4
+IPP_PRINTER_STOPPED = 5
+
+PRINTER_STATUS_ATTRIBUTES = (
+    'printer-state', 'printer-state-reasons', 'printer-state-message',
+    'printer-is-accepting-jobs', 'queued-job-count',
+)
+
+def _ipp_attribute(tag: int, name: str, value) -> bytes:
+    """Атрибут IPP; список значений кодируется дополнительными значениями с пустым именем"""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    out = bytearray()
+    for index, item in enumerate(values):
+        if tag in (IPP_INTEGER, IPP_ENUM):
+            data = struct.pack('>i', item)
+        elif tag == IPP_BOOLEAN:
+            data = b'\x01' if item else b'\x00'
+        else:
+            data = str(item).encode('utf-8')
+        key = name.encode('ascii') if index == 0 else b''
+        out += struct.pack('>BH', tag, len(key)) + key + struct.pack('>H', len(data)) + data
+    return bytes(out)
+
+def encode_ipp_request(operation: int, request_id: int, groups) -> bytes:
+    """Запрос IPP 2.0: groups — [(тег группы, [(тег значения, имя, значение), ...]), ...]"""
+    out = bytearray(struct.pack('>BBHI', 2, 0, operation, request_id))
+    for group_tag, attributes in groups:
+        out.append(group_tag)
+        for tag, name, value in attributes:
+            out += _ipp_attribute(tag, name, value)
+    out.append(IPP_TAG_END)
+    return bytes(out)
+
+def _ipp_value(tag: int, data: bytes):
+    if tag in (IPP_INTEGER, IPP_ENUM) and len(data) == 4:
+        return struct.unpack('>i', data)[0]
+    if tag == IPP_BOOLEAN:
+        return data != b'\x00'
+    if tag in (IPP_TEXT_WITH_LANGUAGE, IPP_NAME_WITH_LANGUAGE) and len(data) >= 4:
+        # Длина и код языка, затем длина и сам текст
+        language_length = struct.unpack('>H', data[:2])[0]
+        return data[4 + language_length:].decode('utf-8', 'replace')
+    if 0x40 <= tag <= 0x5F:
+        return data.decode('utf-8', 'replace')
+    if tag < 0x20:
+        # Внеполосные значения: unsupported, unknown, no-value
+        return None
+    return data
+
+class IppResponse:
+    """Ответ IPP: код статуса и группы атрибутов (имя -> список значений)"""
+    def __init__(self, status_code: int, request_id: int, groups: List[Tuple[int, dict]]):
+        self.status_code = status_code
+        self.request_id = request_id
+        self.groups = groups
+    
+    @classmethod
+    def decode(cls, data: bytes) -> 'IppResponse':
+        """Разбор ответа; обрезанный или испорченный ответ — PrinterError"""
+        if len(data) < 9:
+            raise PrinterError("Некорректный ответ IPP: слишком короткий")
+        status_code, request_id = struct.unpack('>HI', data[2:8])
+        groups = []
+        attributes, name = None, None
+        pos = 8
+        
+        def take(count: int) -> bytes:
+            nonlocal pos
+            if pos + count > len(data):
+                raise PrinterError("Некорректный ответ IPP: данные обрезаны")
+            chunk = data[pos:pos + count]
+            pos += count
+            return chunk
+        
+        while True:
+            tag = take(1)[0]
+            if tag == IPP_TAG_END:
+                break
+            if tag < 0x10:
+                attributes = {}
+                groups.append((tag, attributes))
+                continue
+            if attributes is None:
+                raise PrinterError("Некорректный ответ IPP: атрибут вне группы")
+            name_length = struct.unpack('>H', take(2))[0]
+            if name_length:
+                name = take(name_length).decode('ascii', 'replace')
+                attributes[name] = []
+            value = take(struct.unpack('>H', take(2))[0])
+            if name is not None:
+                attributes[name].append(_ipp_value(tag, value))
+        return cls(status_code, request_id, groups)
+    
+    @property
+    def ok(self) -> bool:
+        # successful-ok, successful-ok-ignored-or-substituted-attributes и т.п.
+        return self.status_code < 0x0100
+    
+    def values(self, name: str, group: Optional[int] = None) -> list:
+        for tag, attributes in self.groups:
+            if (group is None or tag == group) and name in attributes:
+                return attributes[name]
+        return []
+    
+    def get(self, name: str, default=None, group: Optional[int] = None):
+        values = self.values(name, group)
+        return values[0] if values else default
+    
+    @property
+    def message(self) -> str:
+        return self.get('status-message', group=IPP_TAG_OPERATION) or f"статус IPP 0x{self.status_code:04x}"
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP поверх Unix-сокета cupsd"""
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+    
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+# Сколько блоков документа скачивается наперёд, пока CUPS принимает предыдущие
+PRINT_STREAM_PREFETCH = 8
+# Одновременных потоковых Print-Job: каждый держит свой поток и соединение с CUPS на время скачивания
+PRINT_STREAM_THREADS = 4
+
+class DocumentStream:
+    """
+    Документ для Print-Job, который передаётся CUPS по мере скачивания, без файла на диске.
+    
+    Фоновая задача читает источник (асинхронный итератор блоков) наперёд, не больше
+    PRINT_STREAM_PREFETCH блоков; поток IPP-клиента забирает их из очереди через
+    цикл событий и отправляет телом запроса (chunked). Если данных больше
+    max_bytes или источник упал, запрос прерывается с PrinterError.
+    
+    copy_path — файл, куда тот же поток IPP попутно пишет документ (для кэша
+    печати); SHA-256 содержимого считается там же, complete — документ передан целиком.
+    """
+    def __init__(self, name: str, chunks: AsyncIterator[bytes], max_bytes: int,
+                 copy_path: Optional[Path] = None):
+        self.name = name
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.complete = False
+        self.copy_path = copy_path
+        self._chunks = chunks
+        self._max_bytes = max_bytes
+        self._loop = None
+        self._queue = None
+        self._task = None
+    
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(PRINT_STREAM_PREFETCH)
+        self._task = asyncio.ensure_future(self._pump())
+    
+    async def _pump(self):
+        try:
+            async for chunk in self._chunks:
+                self.size += len(chunk)
+                if self.size > self._max_bytes:
+                    raise PrinterError(f"Файл слишком большой (максимум {config.MAX_FILE_SIZE_MB}MB)")
+                if chunk:
+                    await self._queue.put(chunk)
+            await self._queue.put(None)
+        except Exception as e:
+            await self._queue.put(e)
+    
+    def blocks(self, timeout: float) -> Iterator[bytes]:
+        """Блоки документа для потока IPP-клиента (вызывается вне цикла событий)"""
+        copy = open(self.copy_path, 'wb') if self.copy_path else None
+        try:
+            while True:
+                future = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop)
+                try:
+                    item = future.result(timeout)
+                except FutureTimeoutError:
+                    future.cancel()
+                    raise PrinterError(f"Данные документа не поступали {timeout:.0f} с")
+                if item is None:
+                    self.complete = True
+                    return
+                if isinstance(item, PrinterError):
+                    raise item
+                if isinstance(item, Exception):
+                    # Текст исключения источника может содержать URL с токеном бота — в сообщение он не идёт
+                    logger.warning(f"Источник документа {self.name} завершился ошибкой {type(item).__name__}")
+                    raise PrinterError("Не удалось получить документ")
+                self.digest.update(item)
+                if copy is not None:
+                    copy.write(item)
+                yield item
+        finally:
+            if copy is not None:
+                copy.close()
+    
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+class IppClient:
+    """
+    IPP-клиент к CUPS с одним постоянным HTTP-соединением вместо lpstat, lp,
+    cupsenable и cupsaccept.
+    
+    http.client блокирующий, поэтому запросы выполняются по очереди в
+    собственном потоке клиента; соединение держится открытым (keep-alive) и
+    переоткрывается, если сервер его закрыл. Потоковый Print-Job идёт
+    столько же, сколько скачивание документа, поэтому выполняется в
+    отдельном потоке на своём соединении и не задерживает остальные запросы. Через Unix-сокет административные
+    операции авторизуются по PeerCred, как у утилит CUPS. server — путь к
+    сокету или host[:port]; пустой — сокет cupsd, если он есть, иначе localhost:631.
+    """
+    def __init__(self, server: Optional[str] = None):
+        self.server = config.CUPS_SERVER if server is None else server
+        self.user = getpass.getuser()
+        self._conn = None
+        self._request_ids = itertools.count(1)
+        self._peer_cred = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ipp")
+        self._stream_executor = ThreadPoolExecutor(max_workers=PRINT_STREAM_THREADS, thread_name_prefix="ipp-stream")
+    
+    def _server_address(self) -> str:
+        if self.server:
+            return self.server
+        return CUPS_DEFAULT_SOCKET if os.path.exists(CUPS_DEFAULT_SOCKET) else 'localhost:631'
+    
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        address = self._server_address()
+        logger.debug(f"IPP: соединение с CUPS ({address})")
+        if address.startswith('/'):
+            return _UnixHTTPConnection(address, timeout)
+        if ':' not in address:
+            address += ':631'
+        return http.client.HTTPConnection(address, timeout=timeout)
+    
+    def _connection(self, timeout: float) -> http.client.HTTPConnection:
+        if self._conn is None:
+            self._conn = self._new_connection(timeout)
+        self._conn.timeout = timeout
+        if self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+        return self._conn
+    
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    def printer_uri(self, printer_name: str) -> str:
+        return f"ipp://localhost/printers/{quote(printer_name)}"
+    
+    def _body(self, header: bytes, document, timeout: float):
+        """Тело запроса и его длина (None — неизвестна); документ читается блоками с диска или из потока"""
+        if document is None:
+            return header, len(header)
+        if isinstance(document, DocumentStream):
+            def stream():
+                yield header
+                yield from document.blocks(timeout)
+            
+            return stream(), None
+        
+        def chunks():
+            yield header
+            with open(document, 'rb') as f:
+                while True:
+                    block = f.read(64 * 1024)
+                    if not block:
+                        break
+                    yield block
+        
+        return chunks(), len(header) + document.stat().st_size
+    
+    def _request_sync(self, operation: int, path: str, groups, document=None,
+                      timeout: float = 30) -> IppResponse:
+        header = encode_ipp_request(operation, next(self._request_ids), groups)
+        streaming = isinstance(document, DocumentStream)
+        for attempt in range(3):
+            # Поток нельзя отправить второй раз, поэтому для него всегда новое соединение,
+            # которое закрывается после ответа; общее keep-alive соединение он не трогает
+            conn = self._new_connection(timeout) if streaming else self._connection(timeout)
+            reused = conn.sock is not None
+            
+            def drop():
+                if streaming:
+                    conn.close()
+                else:
+                    self._close_sync()
+            
+            body, length = self._body(header, document, timeout)
+            headers = {'Content-Type': 'application/ipp'}
+            if length is None:
+                headers['Transfer-Encoding'] = 'chunked'
+            else:
+                headers['Content-Length'] = str(length)
+            if self._peer_cred:
+                headers['Authorization'] = f"PeerCred {self.user}"
+            try:
+                conn.request('POST', path, body, headers, encode_chunked=length is None)
+                response = conn.getresponse()
+                data = response.read()
+            except PrinterError:
+                # Документ оборвался посреди запроса — соединение в неизвестном состоянии
+                drop()
+                raise
+            except (http.client.HTTPException, ConnectionError) as e:
+                drop()
+                # Сервер мог закрыть простаивающее keep-alive соединение — повторяем на новом
+                if reused and attempt == 0:
+                    logger.debug(f"IPP: соединение закрыто сервером ({e}), переподключаюсь")
+                    continue
+                raise PrinterError(f"CUPS недоступен: {e}")
+            except OSError as e:
+                drop()
+                raise PrinterError(f"CUPS недоступен: {e}")
+            if response.will_close or streaming:
+                drop()
+            if (response.status == 401 and isinstance(conn, _UnixHTTPConnection) and not self._peer_cred
+                    and not streaming):
+                # Административные операции: авторизация по учётным данным процесса на сокете
+                self._peer_cred = True
+                continue
+            if response.status != 200:
+                raise PrinterError(f"CUPS ответил HTTP {response.status} {response.reason}")
+            return IppResponse.decode(data)
+        raise PrinterError("CUPS отклонил авторизацию")
+    
+    async def request(self, operation: int, path: str, groups,
+                      document: Optional[Union[Path, DocumentStream]] = None,
+                      timeout: float = 30) -> IppResponse:
+        loop = asyncio.get_running_loop()
+        executor = self._stream_executor if isinstance(document, DocumentStream) else self._executor
+        return await loop.run_in_executor(
+            executor,
+            lambda: self._request_sync(operation, path, groups, document, timeout)
+        )
+    
+    def _operation_attributes(self, printer_name: str) -> list:
+        return [
+            (IPP_CHARSET, 'attributes-charset', 'utf-8'),
+            (IPP_LANGUAGE, 'attributes-natural-language', 'en'),
+            (IPP_URI, 'printer-uri', self.printer_uri(printer_name)),
+            (IPP_NAME, 'requesting-user-name', self.user),
+        ]
+    
+    async def get_printer_attributes(self, printer_name: str, attributes=PRINTER_STATUS_ATTRIBUTES,
+                                     timeout: float = 5) -> IppResponse:
+        """Get-Printer-Attributes; PrinterError, если принтера нет или CUPS недоступен"""
+        operation = self._operation_attributes(printer_name)
+        operation.append((IPP_KEYWORD, 'requested-attributes', list(attributes)))
+        response = await self.request(IPP_GET_PRINTER_ATTRIBUTES, f"/printers/{quote(printer_name)}",
+                                      [(IPP_TAG_OPERATION, operation)], timeout=timeout)
+        if not response.ok:
+            raise PrinterError(response.message)
+        return response
+    
+    async def print_job(self, printer_name: str, document: Union[Path, DocumentStream],
+                        job_name: Optional[str] = None, job_attributes: Optional[list] = None,
+                        timeout: float = 60) -> int:
+        """Print-Job с документом из файла или потока; формат определяет CUPS. Возвращает job-id"""
+        operation = self._operation_attributes(printer_name)
+        operation.append((IPP_NAME, 'job-name', job_name or document.name))
+        operation.append((IPP_MIME_TYPE, 'document-format', 'application/octet-stream'))
+        groups = [(IPP_TAG_OPERATION, operation)]
+        if job_attributes:
+            groups.append((IPP_TAG_JOB, job_attributes))
+        response = await self.request(IPP_PRINT_JOB, f"/printers/{quote(printer_name)}", groups,
+                                      document=document, timeout=timeout)
+        if not response.ok:
+            raise PrinterError(response.message)
+        return response.get('job-id', 0, group=IPP_TAG_JOB)
+    
+    async def enable_printer(self, printer_name: str, timeout: float = 5):
+        """Включение принтера и приём заданий (как cupsenable + cupsaccept)"""
+        for operation in (IPP_RESUME_PRINTER, CUPS_ACCEPT_JOBS):
+            response = await self.request(operation, '/admin/',
+                                          [(IPP_TAG_OPERATION, self._operation_attributes(printer_name))],
+                                          timeout=timeout)
+            if not response.ok:
+                raise PrinterError(response.message)
+    
+    def close(self):
+        self._executor.submit(self._close_sync)
+        self._executor.shutdown(wait=False)
+        self._stream_executor.shutdown(wait=False)
+
+def parse_printer_state(response: IppResponse) -> dict:
+    """Состояние принтера из атрибутов Get-Printer-Attributes"""
+    state = response.get('printer-state', 0, group=IPP_TAG_PRINTER)
+    reasons = [r for r in response.values('printer-state-reasons', IPP_TAG_PRINTER) if r and r != 'none']
+    return {
+        "enabled": state != IPP_PRINTER_STOPPED,
+        "accepting": bool(response.get('printer-is-accepting-jobs', True, group=IPP_TAG_PRINTER)),
+        "idle": state == IPP_PRINTER_IDLE,
+        "offline": any(r.startswith('offline') for r in reasons),
+        "jobs": response.get('queued-job-count', 0, group=IPP_TAG_PRINTER) or 0,
+        "reasons": reasons,
+        "message": response.get('printer-state-message', '', group=IPP_TAG_PRINTER) or '',
+    }
+
+# --- Конвертация документов через LibreOffice ---
+
+OFFICE_BRIDGE_SCRIPT = Path(__file__).parent / 'office_bridge.py'
+# Сколько ждать, пока только что запущенный офис примет UNO-подключение
+OFFICE_START_TIMEOUT = 90
+
+class OfficeUnavailable(PrinterError):
+    """Постоянный LibreOffice не запустился или умер"""
+    pass
+
+def _office_env() -> dict:
+    env = os.environ.copy()
+    env['PATH'] = '/usr/bin:/usr/local/bin:/bin:' + env.get('PATH', '')
+    env['HOME'] = str(config.PRINT_TEMP_DIR)
+    return env
+
+def _office_profile_arg(cli: bool = False) -> str:
+    """
+    Постоянный профиль: без него LibreOffice каждый раз создаёт профиль заново.
+    
+    Отдельный запуск (cli=True) получает свой профиль рядом: профиль
+    запущенного офиса занят, а его блокировку отдельный запуск не берёт.
+    """
+    profile = Path(config.OFFICE_PROFILE_DIR)
+    if cli:
+        profile = profile.with_name(profile.name + '_cli')
+    return f"-env:UserInstallation={profile.resolve().as_uri()}"
+
+class OfficeConverter:
+    """
+    Постоянно запущенный LibreOffice для конвертации DOC/DOCX в PDF.
+    
+    Офис стартует при первой конвертации с профилем в OFFICE_PROFILE_DIR и
+    принимает UNO-подключения по именованному каналу; документы ему передаёт
+    office_bridge.py, запущенный OFFICE_PYTHON с модулем uno. Если офис или
+    мост умерли, они перезапускаются при следующей конвертации; после
+    OFFICE_IDLE_TIMEOUT секунд простоя офис останавливается. Конвертации
+    идут по одной. Если запустить офис не удалось, попытки повторяются не
+    чаще раза в OFFICE_IDLE_TIMEOUT, а вызывающий код конвертирует по-старому.
+    """
+    def __init__(self, runner: ProcessRunner):
+        self.runner = runner
+        self.pipe_name = f"scan2telegram_office_{os.getpid()}"
+        self._office = None
+        self._bridge = None
+        self._lock = None
+        self._idle_timer = None
+        self._retry_after = 0.0
+    
+    def available(self) -> bool:
+        return (config.OFFICE_DAEMON and time.monotonic() >= self._retry_after
+                and self.runner.path(config.OFFICE_BINARY) is not None
+                and self.runner.path(config.OFFICE_PYTHON) is not None)
+    
+    def _running(self) -> bool:
+        return (self._office is not None and self._office.returncode is None
+                and self._bridge is not None and self._bridge.returncode is None)
+    
+    async def _read_reply(self) -> dict:
+        line = await self._bridge.stdout.readline()
+        if not line:
+            error = (await self._bridge.stderr.read()).decode('utf-8', 'replace').strip()
+            raise OfficeUnavailable(f"мост к LibreOffice завершился: {error[-300:] or 'без вывода'}")
+        return json.loads(line)
+    
+    async def _start(self):
+        await self._stop()
+        Path(config.OFFICE_PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+        logger.info("Запускаю LibreOffice для конвертации документов...")
+        started = time.monotonic()
+        try:
+            self._office = await self.runner.spawn(
+                [config.OFFICE_BINARY, '--headless', '--invisible', '--nologo', '--norestore',
+                 '--nodefault', '--nolockcheck', _office_profile_arg(),
+                 f"--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"],
+                env=_office_env()
+            )
+            self._bridge = await self.runner.spawn(
+                [config.OFFICE_PYTHON, str(OFFICE_BRIDGE_SCRIPT), self.pipe_name, str(OFFICE_START_TIMEOUT)],
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                env=_office_env()
+            )
+            reply = await asyncio.wait_for(self._read_reply(), OFFICE_START_TIMEOUT + 10)
+            if not reply.get("ready"):
+                raise OfficeUnavailable(f"неожиданный ответ моста: {reply}")
+        except Exception as e:
+            await self._stop()
+            self._retry_after = time.monotonic() + config.OFFICE_IDLE_TIMEOUT
+            if isinstance(e, asyncio.TimeoutError):
+                e = "офис не принял подключение"
+            raise OfficeUnavailable(f"LibreOffice не запустился: {e}")
+        logger.info(f"LibreOffice запущен за {time.monotonic() - started:.1f} с (PID {self._office.pid})")
+    
+    async def _stop(self):
+        bridge, office = self._bridge, self._office
+        self._bridge = self._office = None
+        if bridge is not None and bridge.returncode is None:
+            bridge.stdin.close()
+            try:
+                await asyncio.wait_for(bridge.wait(), 5)
+            except asyncio.TimeoutError:
+                await self.runner.terminate(bridge)
+        if office is not None:
+            # libreoffice — обёртка над soffice.bin, поэтому сигнал идёт всей группе процессов
+            await self.runner.terminate(office, grace=10)
+    
+    async def _request(self, src: Path, dst: Path) -> dict:
+        message = json.dumps({"src": str(src.resolve()), "dst": str(dst.resolve())}) + "\n"
+        self._bridge.stdin.write(message.encode('utf-8'))
+        await self._bridge.stdin.drain()
+        return await self._read_reply()
+    
+    def _schedule_idle_stop(self):
+        loop = asyncio.get_running_loop()
+        self._idle_timer = loop.call_later(config.OFFICE_IDLE_TIMEOUT,
+                                           lambda: asyncio.ensure_future(self._idle_stop()))
+    
+    def _cancel_idle_stop(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+    
+    async def _idle_stop(self):
+        if self._lock.locked() or self._office is None:
+            return
+        logger.info(f"LibreOffice простаивает {config.OFFICE_IDLE_TIMEOUT} с, останавливаю")
+        await self._stop()
+    
+    async def convert(self, src: Path, dst: Path, timeout: float = 120):
+        """Конвертация документа в PDF; OfficeUnavailable, если офис недоступен"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._cancel_idle_stop()
+            try:
+                for attempt in range(2):
+                    if not self._running():
+                        await self._start()
+                    try:
+                        reply = await asyncio.wait_for(self._request(src, dst), timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        # Завис на документе — офис перезапустится при следующей конвертации
+                        await self._stop()
+                        raise PrinterError("Таймаут при конвертации DOCX в PDF")
+                    except (OfficeUnavailable, ConnectionError) as e:
+                        logger.warning(f"LibreOffice умер во время конвертации ({e}), перезапускаю")
+                        await self._stop()
+                        if attempt:
+                            raise OfficeUnavailable(str(e))
+            finally:
+                self._schedule_idle_stop()
+        if not reply.get("ok"):
+            raise PrinterError(f"Не удалось конвертировать DOCX в PDF: {reply.get('error')}")
+    
+    async def close(self):
+        self._cancel_idle_stop()
+        await self._stop()
+
+# --- Вёрстка текста в PDF ---
+
+# Шрифты с кириллицей, если PRINT_TEXT_FONT не задан (пакеты fonts-dejavu-core, fonts-liberation, fonts-freefont-ttf)
+TEXT_FONT_CANDIDATES = (
+    '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf',
+    '/usr/share/fonts/truetype/freefont/FreeMono.ttf',
+)
+TEXT_PAGE_SIZE = (595.28, 841.89)  # A4 в пунктах
+TEXT_MARGIN = 42.52  # 15 мм
+TEXT_TAB_SIZE = 8
+# Кодировка текста, если он не в UTF-8 (файлы из Windows)
+TEXT_FALLBACK_ENCODING = 'cp1251'
+# Строки читаются кусками не длиннее этого, чтобы лог без переводов строк не попадал в память целиком
+TEXT_READ_LIMIT = 64 * 1024
+
+_text_fonts = {}
+
+def find_text_font() -> Optional[Path]:
+    """Шрифт для печати текста: PRINT_TEXT_FONT или первый найденный из TEXT_FONT_CANDIDATES"""
+    if config.PRINT_TEXT_FONT:
+        path = Path(config.PRINT_TEXT_FONT)
+        return path if path.exists() else None
+    for candidate in TEXT_FONT_CANDIDATES:
+        if Path(candidate).exists():
+            return Path(candidate)
+    return None
+
+def _load_text_font(path: Path) -> TrueTypeFont:
+    """Шрифт разбирается один раз за время работы бота"""
+    font = _text_fonts.get(path)
+    if font is None:
+        font = _text_fonts[path] = TrueTypeFont(path)
+    return font
+
+def _detect_text_encoding(path: Path) -> str:
+    """UTF-8 (с BOM или без), UTF-16 по BOM, иначе TEXT_FALLBACK_ENCODING"""
+    with open(path, 'rb') as f:
+        head = f.read(TEXT_READ_LIMIT)
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        # Инкрементальный декодер не считает ошибкой символ, обрезанный концом блока
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return TEXT_FALLBACK_ENCODING
+
+class _TextFilter(dict):
+    """
+    Таблица для str.translate: управляющие символы убираются, символы,
+    которых нет в шрифте, заменяются на ?; заполняется по мере встречи символов
+    """
+
+    def __init__(self, font: TrueTypeFont):
+        super().__init__()
+        self.font = font
+
+    def __missing__(self, code: int):
+        if code < 0x20 or 0x7F <= code < 0xA0:
+            value = None
+        elif not self.font.glyph(chr(code)):
+            value = '?'
+        else:
+            value = code
+        self[code] = value
+        return value
+
+def _wrap_text_line(line: str, font: TrueTypeFont, size: float, width: float) -> Iterator[str]:
+    """Перенос строки по ширине: по последнему пробелу, а если его нет — посимвольно"""
+    if font.text_width(line, size) <= width:
+        yield line
+        return
+    begin = 0
+    used = 0.0
+    for i, ch in enumerate(line):
+        advance = font.char_width(ch, size)
+        if used + advance > width and i > begin:
+            space = line.rfind(' ', begin, i)
+            cut = space + 1 if space > begin else i
+            yield line[begin:cut].rstrip(' ')
+            begin = cut
+            used = font.text_width(line[begin:i], size)
+        used += advance
+    yield line[begin:]
+
+def render_text_pdf(src: Path, dst: Path, font_path: Path, size: float) -> int:
+    """
+    Вёрстка текстового файла в PDF формата A4 с заголовком (имя файла, номер страницы)
+    
+    Файл читается построчно, каждая страница пишется в PDF сразу после заполнения,
+    поэтому память не зависит от размера файла. Символ перевода страницы (\\f)
+    начинает новую страницу. Возвращает число страниц.
+    """
+    font = _load_text_font(font_path)
+    encoding = _detect_text_encoding(src)
+    page_width, page_height = TEXT_PAGE_SIZE
+    text_width = page_width - 2 * TEXT_MARGIN
+    leading = size * 1.2
+    header_size = size * 0.8
+    header_y = page_height - TEXT_MARGIN - header_size
+    rule_y = header_y - header_size * 0.5
+    first_y = rule_y - leading
+    lines_per_page = max(1, int((first_y - TEXT_MARGIN) / leading) + 1)
+    text_filter = _TextFilter(font)
+    title = src.name.translate(text_filter)
+    
+    with open(dst, 'wb') as out, open(src, encoding=encoding, errors='replace') as text:
+        writer = PdfWriter(out)
+        font_name = writer.add_font(font)
+        row = None
+        
+        def new_page():
+            nonlocal row
+            if row is not None:
+                writer.end_page()
+            writer.begin_page(page_width, page_height)
+            number = f"стр. {writer.page_count + 1}"
+            writer.draw_text(font_name, header_size, TEXT_MARGIN, header_y, title)
+            writer.draw_text(
+                font_name, header_size,
+                page_width - TEXT_MARGIN - font.text_width(number, header_size), header_y, number
+            )
+            writer.add_content(
+                f"0.5 w {TEXT_MARGIN:.2f} {rule_y:.2f} m {page_width - TEXT_MARGIN:.2f} {rule_y:.2f} l S"
+            )
+            row = 0
+        
+        while True:
+            chunk = text.readline(TEXT_READ_LIMIT)
+            if not chunk:
+                break
+            parts = chunk.rstrip('\n').split('\f')
+            for index, part in enumerate(parts):
+                if index:
+                    new_page()
+                cleaned = part.expandtabs(TEXT_TAB_SIZE).translate(text_filter)
+                for line in _wrap_text_line(cleaned, font, size, text_width):
+                    if row is None or row >= lines_per_page:
+                        new_page()
+                    if line:
+                        writer.draw_text(font_name, size, TEXT_MARGIN, first_y - row * leading, line)
+                    row += 1
+        if row is None:
+            new_page()
+        writer.close()
+        return writer.page_count
+
+# --- Кэш подготовленных к печати файлов ---
+
+# Форматы, которые печатаются без конвертации
+DIRECT_PRINT_SUFFIXES = ('.pdf', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif')
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ConversionCache:
+    """
+    Кэш готовых к печати файлов в PRINT_TEMP_DIR/cache.
+    
+    Файл хранится под SHA-256 исходного содержимого, поэтому повторная
+    печать того же документа обходится без конвертации. Дополнительно
+    запоминается file_unique_id Telegram -> хэш: если файл уже печатали,
+    его не нужно даже скачивать. Объём ограничен PRINT_CACHE_MAX_MB,
+    вытесняются давно не использованные файлы (время доступа — mtime).
+    """
+    def __init__(self, directory: Path, max_bytes: int):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.index_file = directory / 'index.json'
+        self._ids = {}
+        if self.enabled:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self._ids = json.load(f)
+            except (OSError, ValueError):
+                self._ids = {}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+    
+    def owns(self, path: Path) -> bool:
+        return self.enabled and path.parent == self.dir
+    
+    def _save_index(self):
+        try:
+            tmp = self.index_file.with_suffix('.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._ids, f)
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить индекс кэша печати: {e}")
+    
+    def _entries(self) -> list:
+        return [p for p in self.dir.iterdir() if p.is_file() and p != self.index_file and p.suffix != '.tmp']
+    
+    def get(self, digest: str) -> Optional[Path]:
+        """Готовый файл по хэшу содержимого; обращение продлевает ему жизнь в кэше"""
+        if not self.enabled:
+            return None
+        for path in self.dir.glob(f"{digest}.*"):
+            if path.suffix == '.tmp':
+                continue
+            try:
+                os.utime(path)
+            except OSError:
+                continue
+            return path
+        return None
+    
+    def lookup(self, unique_id: Optional[str]) -> Optional[Path]:
+        """Готовый файл по file_unique_id Telegram, если этот файл уже печатали"""
+        digest = self._ids.get(unique_id) if unique_id else None
+        return self.get(digest) if digest else None
+    
+    def remember(self, unique_id: Optional[str], digest: str):
+        if self.enabled and unique_id and self._ids.get(unique_id) != digest:
+            self._ids[unique_id] = digest
+            self._save_index()
+    
+    def put(self, digest: str, prepared: Path, move: bool) -> Path:
+        """Сохранение готового файла (перенос конвертированного или копия исходного)"""
+        target = self.dir / f"{digest}{prepared.suffix.lower()}"
+        if target.exists():
+            # Тот же документ уже сохранил параллельный запрос — это попадание в кэш
+            if move:
+                prepared.unlink(missing_ok=True)
+            os.utime(target)
+            return target
+        # Временное имя у каждого писателя своё, иначе параллельные записи мешают друг другу
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(str(prepared), tmp)
+            else:
+                shutil.copyfile(prepared, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        self._evict(keep=target)
+        return target
+    
+    def _evict(self, keep: Path):
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = set()
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed.add(path.name.split('.', 1)[0])
+        if removed:
+            logger.info(f"Кэш печати: вытеснено файлов {len(removed)}")
+            self._ids = {uid: digest for uid, digest in self._ids.items() if digest not in removed}
+            self._save_index()
+
+class PrinterStateCache:
+    """
+    Кэш разобранного состояния принтера (enabled, accepting, idle, offline,
+    jobs, reasons) с коротким TTL.
+    
+    Печать и экран статуса читают состояние отсюда. Запись моложе
+    PRINTER_STATUS_TTL отдаётся сразу; после половины TTL она ещё отдаётся,
+    но в фоне запускается обновление. Одновременные запросы ждут одно и то
+    же обновление. После отправки задания или ошибки кэш сбрасывается.
+    """
+    def __init__(self, ipp: 'IppClient', printer_name: str, ttl: Optional[float] = None):
+        self.ipp = ipp
+        self.printer_name = printer_name
+        self.ttl = config.PRINTER_STATUS_TTL if ttl is None else ttl
+        self._state = None
+        self._updated = 0.0
+        self._refresh_task = None
+        # Номер поколения: ответ запроса, начатого до invalidate(), в кэш не попадает
+        self._generation = 0
+    
+    async def _fetch(self, generation: int) -> dict:
+        try:
+            state = parse_printer_state(await self.ipp.get_printer_attributes(self.printer_name))
+            state["error"] = None
+        except PrinterError as e:
+            state = {"error": str(e)}
+        if generation == self._generation:
+            self._state = state
+            self._updated = time.monotonic()
+        return state
+    
+    def _refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._fetch(self._generation))
+        return self._refresh_task
+    
+    async def get(self) -> dict:
+        """Состояние принтера; при недоступности CUPS — {'error': текст}"""
+        age = time.monotonic() - self._updated
+        if self._state is None or age >= self.ttl:
+            return dict(await asyncio.shield(self._refresh()))
+        if age >= self.ttl / 2:
+            self._refresh()
+        return dict(self._state)
+    
+    def invalidate(self):
+        """Сброс кэша: следующее чтение запросит CUPS заново, а уже идущее обновление не будет сохранено"""
+        self._updated = 0.0
+        self._generation += 1
+        self._refresh_task = None
+
 class Printer:
     def __init__(self):
         self.printer_name = config.PRINTER_NAME
         self.temp_dir = Path(config.PRINT_TEMP_DIR)
         self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.ipp = IppClient()
+        # Два экземпляра LibreOffice с одним профилем мешают друг другу, поэтому он запускается по одному
+        self.processes = ProcessRunner(limits={ProcessRunner.tool_name(config.OFFICE_BINARY): 1})
+        self.processes.resolve_tools(
+            [config.OFFICE_BINARY] + ([config.OFFICE_PYTHON] if config.OFFICE_DAEMON else [])
+        )
+        self.office = OfficeConverter(self.processes)
+        self.cache = ConversionCache(self.temp_dir / 'cache', config.PRINT_CACHE_MAX_MB * 1024 * 1024)
+        self._states = {}
+    
+    def _state_cache(self, printer_name: str) -> PrinterStateCache:
+        if printer_name not in self._states:
+            self._states[printer_name] = PrinterStateCache(self.ipp, printer_name)
+        return self._states[printer_name]
     
-    async def print_file(self, file_path: Path, printer_name: Optional[str] = None) -> bool:
+    async def print_file(self, file_path: Path, printer_name: Optional[str] = None,
+                         unique_id: Optional[str] = None) -> bool:
         """
         Печать файла
         
         Args:
             file_path: Путь к файлу для печати
             printer_name: Имя принтера (если None, используется из конфига)
+            unique_id: file_unique_id Telegram для кэша подготовленных файлов
         
         Returns:
             True если печать успешна, False в противном случае
@@ -50,14 +1008,17 @@ class Printer:
         
         try:
             # Подготовка файла для печати (конвертация при необходимости)
-            print_file = await self._prepare_file_for_printing(file_path)
+            print_file = await self._prepare_file_for_printing(file_path, unique_id)
             
-            # Отправка на печать
+            # Отправка на печать; очередь и состояние принтера после неё меняются
             logger.info(f"Отправка файла {print_file} на принтер {printer}")
-            result = await self._send_to_printer(print_file, printer)
+            try:
+                result = await self._send_to_printer(print_file, printer)
+            finally:
+                self._state_cache(printer).invalidate()
             
-            # Очистка временного файла, если он был создан
-            if print_file != file_path and print_file.exists():
+            # Очистка временного файла, если он был создан (файлы кэша остаются)
+            if print_file != file_path and print_file.exists() and not self.cache.owns(print_file):
                 try:
                     print_file.unlink()
                     logger.debug(f"Временный файл {print_file} удален")
@@ -70,85 +1031,142 @@ class Printer:
             logger.error(f"Ошибка печати файла {file_path}: {e}")
             raise PrinterError(f"Не удалось распечатать файл: {e}")
     
+    def can_stream(self, file_name: str) -> bool:
+        """Файл печатается как есть (PDF, изображения) и его можно передать CUPS прямо при скачивании"""
+        return config.PRINT_STREAMING and Path(file_name).suffix.lower() in DIRECT_PRINT_SUFFIXES
+    
+    async def print_stream(self, file_name: str, chunks: AsyncIterator[bytes], size: Optional[int] = None,
+                           printer_name: Optional[str] = None, unique_id: Optional[str] = None) -> bool:
+        """
+        Печать файла, который ещё скачивается: блоки сразу уходят в Print-Job.
+        Только для форматов без конвертации (can_stream)
+        
+        Если кэш печати включён, поток IPP попутно пишет копию документа, и после
+        печати она сохраняется в кэш под file_unique_id, как у скачанных файлов:
+        повторная печать того же файла обходится без скачивания.
+        
+        Args:
+            file_name: Имя файла (по расширению выбираются опции печати)
+            chunks: Асинхронный итератор блоков содержимого
+            size: Размер файла, если известен заранее
+            printer_name: Имя принтера (если None, используется из конфига)
+            unique_id: file_unique_id Telegram для кэша подготовленных файлов
+        """
+        printer = printer_name or self.printer_name
+        max_bytes = config.MAX_FILE_SIZE_MB * 1024 * 1024
+        if size and size > max_bytes:
+            raise PrinterError(
+                f"Файл слишком большой: {size / (1024 * 1024):.2f}MB (максимум {config.MAX_FILE_SIZE_MB}MB)"
+            )
+        
+        # Проверка доступности принтера
+        if not await self._check_printer_status(printer):
+            raise PrinterError(f"Принтер {printer} недоступен")
+        
+        copy_path = None
+        if self.cache.enabled:
+            fd, copy_path = tempfile.mkstemp(dir=self.temp_dir, prefix='stream_', suffix=Path(file_name).suffix.lower())
+            os.close(fd)
+            copy_path = Path(copy_path)
+        stream = DocumentStream(file_name, chunks, max_bytes, copy_path)
+        try:
+            logger.info(f"Потоковая отправка файла {file_name} на принтер {printer}")
+            started = time.monotonic()
+            stream.start()
+            try:
+                result = await self._send_to_printer(stream, printer)
+            finally:
+                self._state_cache(printer).invalidate()
+            logger.info(
+                f"Файл {file_name} ({stream.size / 1024:.0f} КБ) передан на печать за "
+                f"{time.monotonic() - started:.1f} с"
+            )
+            if result and stream.complete and copy_path is not None:
+                await self._cache_streamed(stream, unique_id)
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка печати файла {file_name}: {e}")
+            raise PrinterError(f"Не удалось распечатать файл: {e}")
+        finally:
+            await stream.close()
+            if copy_path is not None:
+                copy_path.unlink(missing_ok=True)
+    
+    async def _cache_streamed(self, stream: DocumentStream, unique_id: Optional[str]):
+        """Копия напечатанного потоком документа — в кэш; ошибка кэша печать не отменяет"""
+        digest = stream.digest.hexdigest()
+        try:
+            if self.cache.get(digest) is None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.cache.put, digest, stream.copy_path, True)
+            self.cache.remember(unique_id, digest)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить {stream.name} в кэш печати: {e}")
+    
     async def _check_printer_status(self, printer_name: str) -> bool:
-        """Проверка доступности принтера"""
+        """Проверка доступности принтера; остановленный принтер включается автоматически"""
         try:
             logger.info(f"Проверка доступности принтера: {printer_name}")
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        ['/usr/bin/lpstat', '-p', printer_name],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                )
-            
-            logger.info(f"lpstat вернул код: {result.returncode}, stdout: {result.stdout[:100]}, stderr: {result.stderr[:100] if result.stderr else 'None'}")
+            cache = self._state_cache(printer_name)
+            state = await cache.get()
+            if state["error"]:
+                raise PrinterError(state["error"])
+            logger.info(f"Состояние принтера {printer_name}: {state}")
             
-            if result.returncode == 0:
-                # Проверяем, что принтер не отключен
-                output_lower = result.stdout.lower()
-                if 'disabled' in output_lower:
-                    logger.warning(f"Принтер {printer_name} отключен, пытаюсь включить...")
-                    # Пытаемся автоматически включить принтер
+            if not state["enabled"] or not state["accepting"]:
+                logger.warning(f"Принтер {printer_name} отключен, пытаюсь включить...")
+                try:
                     try:
-                        enable_result = await loop.run_in_executor(
-                            executor,
-                            lambda: subprocess.run(
-                                ['/usr/bin/cupsenable', printer_name],
-                                capture_output=True,
-                                text=True,
-                                timeout=5
-                            )
-                        )
-                        if enable_result.returncode == 0:
-                            logger.info(f"Принтер {printer_name} успешно включен")
-                            # Также принимаем задания в очередь
-                            await loop.run_in_executor(
-                                executor,
-                                lambda: subprocess.run(
-                                    ['/usr/bin/cupsaccept', printer_name],
-                                    capture_output=True,
-                                    text=True,
-                                    timeout=5
-                                )
-                            )
-                            # Повторная проверка статуса
-                            result = await loop.run_in_executor(
-                                executor,
-                                lambda: subprocess.run(
-                                    ['/usr/bin/lpstat', '-p', printer_name],
-                                    capture_output=True,
-                                    text=True,
-                                    timeout=5
-                                )
-                            )
-                            if result.returncode == 0 and 'disabled' not in result.stdout.lower():
-                                logger.info(f"Принтер {printer_name} теперь доступен")
-                                return True
-                        else:
-                            logger.error(f"Не удалось включить принтер {printer_name}: {enable_result.stderr}")
-                    except Exception as enable_error:
-                        logger.error(f"Ошибка при попытке включить принтер {printer_name}: {enable_error}")
-                    return False
-                if 'offline' in output_lower:
-                    logger.warning(f"Принтер {printer_name} оффлайн")
-                    return False
-                logger.info(f"Принтер {printer_name} доступен")
-                return True
-            else:
-                error_msg = result.stderr.strip() if result.stderr else "Неизвестная ошибка"
-                logger.error(f"Принтер {printer_name} не найден или недоступен: {error_msg}")
+                        await self.ipp.enable_printer(printer_name)
+                    finally:
+                        cache.invalidate()
+                    logger.info(f"Принтер {printer_name} успешно включен")
+                    # Повторная проверка статуса
+                    state = await cache.get()
+                    if not state["error"] and state["enabled"] and state["accepting"]:
+                        logger.info(f"Принтер {printer_name} теперь доступен")
+                        return True
+                except PrinterError as enable_error:
+                    logger.error(f"Не удалось включить принтер {printer_name}: {enable_error}")
                 return False
-                
+            if state["offline"]:
+                logger.warning(f"Принтер {printer_name} оффлайн")
+                return False
+            logger.info(f"Принтер {printer_name} доступен")
+            return True
+            
+        except PrinterError as e:
+            logger.error(f"Принтер {printer_name} не найден или недоступен: {e}")
+            return False
         except Exception as e:
             logger.error(f"Ошибка проверки принтера {printer_name}: {e}", exc_info=True)
             return False
     
-    async def _prepare_file_for_printing(self, file_path: Path) -> Path:
+    async def _prepare_file_for_printing(self, file_path: Path, unique_id: Optional[str] = None) -> Path:
+        """
+        Подготовка файла для печати с кэшем по содержимому: тот же документ
+        второй раз не конвертируется
+        """
+        if not self.cache.enabled or self.cache.owns(file_path):
+            return await self._convert_for_printing(file_path)
+        
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, _file_digest, file_path)
+        cached = self.cache.get(digest)
+        if cached is None:
+            prepared = await self._convert_for_printing(file_path)
+            if prepared == file_path and file_path.suffix.lower() not in DIRECT_PRINT_SUFFIXES:
+                # Конвертация не удалась и файл печатается как есть — такое не кэшируем
+                return prepared
+            cached = await loop.run_in_executor(
+                None, self.cache.put, digest, prepared, prepared != file_path
+            )
+        else:
+            logger.info(f"Файл {file_path.name} уже подготовлен к печати (кэш): {cached.name}")
+        self.cache.remember(unique_id, digest)
+        return cached
+    
+    async def _convert_for_printing(self, file_path: Path) -> Path:
         """
         Подготовка файла для печати
         Конвертирует файл в поддерживаемый формат при необходимости
@@ -156,7 +1174,7 @@ class Printer:
         suffix = file_path.suffix.lower()
         
         # Файлы, которые можно печатать напрямую
-        if suffix in ['.pdf', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif']:
+        if suffix in DIRECT_PRINT_SUFFIXES:
             return file_path
         
         # Документы Word - конвертируем в PDF через pandoc
@@ -172,206 +1190,112 @@ class Printer:
         return file_path
     
     async def _convert_text_to_pdf(self, file_path: Path) -> Path:
-        """Конвертация текстового файла в PDF"""
+        """Вёрстка текстового файла в PDF со встроенным шрифтом (без внешних программ)"""
+        font_path = find_text_font()
+        if font_path is None:
+            logger.warning("Не найден шрифт TrueType для печати текста (PRINT_TEXT_FONT), печатаем как есть")
+            return file_path
+        
+        output_pdf = self.temp_dir / f"{file_path.stem}_print.pdf"
         try:
-            # Используем enscript для конвертации текста в PostScript, затем ps2pdf
-            output_pdf = self.temp_dir / f"{file_path.stem}_print.pdf"
-            
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                # Попытка использовать enscript
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        ['which', 'enscript'],
-                        capture_output=True,
-                        text=True
-                    )
-                )
-                
-                if result.returncode == 0:
-                    # Конвертация через enscript -> ps2pdf
-                    ps_file = self.temp_dir / f"{file_path.stem}_print.ps"
-                    
-                    # enscript: текст -> PostScript
-                    result = await loop.run_in_executor(
-                        executor,
-                        lambda: subprocess.run(
-                            ['enscript', '-p', str(ps_file), str(file_path)],
-                            capture_output=True,
-                            text=True,
-                            timeout=30
-                        )
-                    )
-                    
-                    if result.returncode == 0 and ps_file.exists():
-                        # ps2pdf: PostScript -> PDF
-                        result = await loop.run_in_executor(
-                            executor,
-                            lambda: subprocess.run(
-                                ['ps2pdf', str(ps_file), str(output_pdf)],
-                                capture_output=True,
-                                text=True,
-                                timeout=30
-                            )
-                        )
-                        
-                        # Удаляем временный PS файл
-                        if ps_file.exists():
-                            ps_file.unlink()
-                        
-                        if result.returncode == 0 and output_pdf.exists():
-                            logger.info(f"Текстовый файл конвертирован в PDF: {output_pdf}")
-                            return output_pdf
-                
-                # Если enscript недоступен, пробуем через a2ps или просто печатаем как есть
-                logger.warning("enscript недоступен, пробуем a2ps")
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        ['which', 'a2ps'],
-                        capture_output=True,
-                        text=True
-                    )
-                )
-                
-                if result.returncode == 0:
-                    # a2ps: текст -> PostScript -> PDF
-                    ps_file = self.temp_dir / f"{file_path.stem}_print.ps"
-                    result = await loop.run_in_executor(
-                        executor,
-                        lambda: subprocess.run(
-                            ['a2ps', '-o', str(ps_file), str(file_path)],
-                            capture_output=True,
-                            text=True,
-                            timeout=30
-                        )
-                    )
-                    
-                    if result.returncode == 0 and ps_file.exists():
-                        result = await loop.run_in_executor(
-                            executor,
-                            lambda: subprocess.run(
-                                ['ps2pdf', str(ps_file), str(output_pdf)],
-                                capture_output=True,
-                                text=True,
-                                timeout=30
-                            )
-                        )
-                        
-                        if ps_file.exists():
-                            ps_file.unlink()
-                        
-                        if result.returncode == 0 and output_pdf.exists():
-                            logger.info(f"Текстовый файл конвертирован в PDF: {output_pdf}")
-                            return output_pdf
-                
-                # Если ничего не помогло, возвращаем исходный файл
-                logger.warning("Не удалось конвертировать текст в PDF, печатаем как есть")
-                return file_path
-                
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            pages = await loop.run_in_executor(
+                None, render_text_pdf, file_path, output_pdf, font_path, config.PRINT_TEXT_FONT_SIZE
+            )
+            logger.info(
+                f"Текстовый файл конвертирован в PDF ({pages} стр.) за "
+                f"{time.monotonic() - started:.1f} с: {output_pdf}"
+            )
+            return output_pdf
         except Exception as e:
             logger.error(f"Ошибка конвертации текста в PDF: {e}")
+            if output_pdf.exists():
+                output_pdf.unlink()
             # Если конвертация не удалась, возвращаем исходный файл
             return file_path
     
     async def _convert_docx_to_pdf(self, file_path: Path) -> Path:
-        """Конвертация DOCX/DOC в PDF через LibreOffice"""
+        """Конвертация DOCX/DOC в PDF через постоянно запущенный LibreOffice"""
+        output_pdf = self.temp_dir / f"{file_path.stem}_print.pdf"
+        if self.office.available():
+            try:
+                logger.info(f"Конвертирую DOCX файл {file_path} в PDF через запущенный LibreOffice")
+                started = time.monotonic()
+                await self.office.convert(file_path, output_pdf)
+                logger.info(f"DOCX файл конвертирован в PDF за {time.monotonic() - started:.1f} с: {output_pdf}")
+                return output_pdf
+            except OfficeUnavailable as e:
+                logger.warning(f"Постоянный LibreOffice недоступен ({e}), конвертирую отдельным запуском")
+        return await self._convert_docx_to_pdf_cli(file_path, output_pdf)
+    
+    async def _convert_docx_to_pdf_cli(self, file_path: Path, output_pdf: Path) -> Path:
+        """Конвертация DOCX/DOC в PDF отдельным запуском LibreOffice"""
         try:
-            output_pdf = self.temp_dir / f"{file_path.stem}_print.pdf"
-            
             logger.info(f"Конвертирую DOCX файл {file_path} в PDF через LibreOffice")
             
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                # LibreOffice конвертирует в директорию, поэтому нужно указать выходную директорию
-                output_dir = output_pdf.parent
-                
-                # Устанавливаем PATH для поиска LibreOffice
-                env = os.environ.copy()
-                env['PATH'] = '/usr/bin:/usr/local/bin:/bin:' + env.get('PATH', '')
-                env['HOME'] = str(self.temp_dir)  # Устанавливаем HOME для LibreOffice
-                
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        [
-                            '/usr/bin/libreoffice',
-                            '--headless',
-                            '--convert-to', 'pdf',
-                            '--outdir', str(output_dir),
-                            str(file_path)
-                        ],
-                        capture_output=True,
-                        text=True,
-                        timeout=120,
-                        env=env
-                    )
-                )
+            # LibreOffice конвертирует в директорию, поэтому нужно указать выходную директорию
+            output_dir = output_pdf.parent
+            result = await self.processes.run(
+                [
+                    config.OFFICE_BINARY,
+                    '--headless',
+                    _office_profile_arg(cli=True),
+                    '--convert-to', 'pdf',
+                    '--outdir', str(output_dir),
+                    str(file_path)
+                ],
+                timeout=120,
+                env=_office_env()
+            )
             
             # LibreOffice создает файл с тем же именем, но расширением .pdf
             expected_pdf = output_dir / f"{file_path.stem}.pdf"
             
-            if result.returncode == 0 and expected_pdf.exists():
+            if result.ok and expected_pdf.exists():
                 # Переименовываем в нужное имя, если нужно
                 if expected_pdf != output_pdf:
                     expected_pdf.rename(output_pdf)
-                logger.info(f"DOCX файл конвертирован в PDF: {output_pdf}")
+                logger.info(f"DOCX файл конвертирован в PDF за {result.seconds:.1f} с: {output_pdf}")
                 return output_pdf
             else:
-                error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
+                error_msg = result.error_text()
                 logger.error(f"Ошибка конвертации DOCX в PDF: {error_msg}")
                 raise PrinterError(f"Не удалось конвертировать DOCX в PDF: {error_msg}")
                 
-        except subprocess.TimeoutExpired:
+        except ProcessTimeout:
             logger.error("Таймаут при конвертации DOCX в PDF")
             raise PrinterError("Таймаут при конвертации DOCX в PDF")
-        except FileNotFoundError:
+        except ToolNotFound:
             raise PrinterError("Утилита 'libreoffice' не найдена. Установите её: sudo apt install libreoffice")
+        except PrinterError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка конвертации DOCX в PDF: {e}")
             raise PrinterError(f"Не удалось конвертировать DOCX в PDF: {e}")
     
-    async def _send_to_printer(self, file_path: Path, printer_name: str) -> bool:
-        """Отправка файла на принтер через lp"""
+    async def _send_to_printer(self, document: Union[Path, DocumentStream], printer_name: str) -> bool:
+        """Отправка файла или потока на принтер запросом IPP Print-Job"""
         try:
             # Определяем тип файла для правильных опций печати
-            suffix = file_path.suffix.lower()
-            lp_options = []
+            suffix = Path(document.name).suffix.lower()
+            job_attributes = []
             
-            # Для PDF файлов добавляем опции для правильной печати
+            # Для PDF файлов добавляем опции для правильной печати (как lp -o media=A4 -o fit-to-page)
             if suffix == '.pdf':
-                lp_options = ['-o', 'media=A4', '-o', 'fit-to-page']
-                logger.info(f"Печать PDF файла с опциями: {lp_options}")
+                job_attributes = [
+                    (IPP_KEYWORD, 'media', 'iso_a4_210x297mm'),
+                    (IPP_BOOLEAN, 'fit-to-page', True),
+                ]
+                logger.info("Печать PDF файла с опциями: media=A4, fit-to-page")
             
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                # Формируем команду lp с опциями
-                lp_command = ['/usr/bin/lp', '-d', printer_name] + lp_options + [str(file_path)]
-                logger.info(f"Выполняю команду: {' '.join(lp_command)}")
-                
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        lp_command,
-                        capture_output=True,
-                        text=True,
-                        timeout=60
-                    )
-                )
+            job_id = await self.ipp.print_job(printer_name, document, job_attributes=job_attributes)
+            logger.info(f"Файл отправлен на печать. Job ID: {printer_name}-{job_id}")
+            return True
             
-            if result.returncode == 0:
-                job_id = result.stdout.strip().split()[-1] if result.stdout.strip() else "unknown"
-                logger.info(f"Файл отправлен на печать. Job ID: {job_id}")
-                return True
-            else:
-                error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
-                logger.error(f"Ошибка отправки на печать: {error_msg}")
-                raise PrinterError(f"Ошибка CUPS: {error_msg}")
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Таймаут при отправке на печать")
-            raise PrinterError("Таймаут при отправке на печать")
+        except PrinterError as e:
+            logger.error(f"Ошибка отправки на печать: {e}")
+            raise PrinterError(f"Ошибка CUPS: {e}")
         except Exception as e:
             logger.error(f"Ошибка при отправке на печать: {e}")
             raise PrinterError(f"Ошибка при отправке на печать: {e}")
@@ -386,60 +1310,41 @@ class Printer:
             }
         
         try:
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                result = await loop.run_in_executor(
-                    executor,
-                    lambda: subprocess.run(
-                        ['/usr/bin/lpstat', '-p', self.printer_name, '-l'],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                )
+            state = await self._state_cache(self.printer_name).get()
+            if state["error"]:
+                raise PrinterError(state["error"])
             
-            if result.returncode == 0:
-                status_text = result.stdout
-                is_enabled = 'enabled' in status_text.lower()
-                is_idle = 'idle' in status_text.lower()
-                is_disabled = 'disabled' in status_text.lower()
-                is_offline = 'offline' in status_text.lower()
-                
-                # Определяем статус
-                if is_disabled:
-                    status = "error"
-                    message = "Принтер отключен"
-                elif is_offline:
-                    status = "error"
-                    message = "Принтер оффлайн"
-                elif is_enabled and is_idle:
-                    status = "ready"
-                    message = "Принтер готов к работе"
-                else:
-                    status = "busy"
-                    message = "Принтер занят (есть задания в очереди)"
-                
-                return {
-                    "status": status,
-                    "enabled": is_enabled,
-                    "idle": is_idle,
-                    "name": self.printer_name,
-                    "message": message
-                }
+            # Определяем статус
+            if not state["enabled"]:
+                status = "error"
+                message = "Принтер отключен"
+            elif state["offline"]:
+                status = "error"
+                message = "Принтер оффлайн"
+            elif state["idle"]:
+                status = "ready"
+                message = "Принтер готов к работе"
             else:
-                error_msg = result.stderr.strip() if result.stderr else "Неизвестная ошибка"
-                return {
-                    "status": "error",
-                    "name": self.printer_name,
-                    "message": f"Принтер недоступен: {error_msg}"
-                }
-                
-        except subprocess.TimeoutExpired:
-            logger.error(f"Таймаут при проверке статуса принтера {self.printer_name}")
+                status = "busy"
+                message = f"Принтер занят (заданий в очереди: {state['jobs']})"
+            
+            return {
+                "status": status,
+                "enabled": state["enabled"],
+                "accepting": state["accepting"],
+                "idle": state["idle"],
+                "offline": state["offline"],
+                "jobs": state["jobs"],
+                "reasons": state["reasons"],
+                "name": self.printer_name,
+                "message": message
+            }
+            
+        except PrinterError as e:
             return {
                 "status": "error",
                 "name": self.printer_name,
-                "message": "Таймаут при проверке статуса принтера"
+                "message": f"Принтер недоступен: {e}"
             }
         except Exception as e:
             logger.error(f"Ошибка получения статуса принтера: {e}")
@@ -448,6 +1353,12 @@ class Printer:
                 "name": self.printer_name,
                 "message": f"Ошибка проверки статуса: {str(e)}"
             }
+    
+    async def close(self):
+        """Остановка LibreOffice и соединения с CUPS при завершении бота"""
+        await self.office.close()
+        self.ipp.close()
+        self.processes.log_stats()
 
 # Глобальный экземпляр принтера
 printer = Printer()
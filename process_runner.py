@@ -0,0 +1,192 @@
+"""
+Запуск внешних программ из asyncio без потоков
+
+Программы запускаются через asyncio.create_subprocess_exec в собственной
+группе процессов: по таймауту или при отмене задачи останавливается вся
+группа (у libreoffice, например, настоящий процесс — дочерний soffice.bin),
+и сирот не остаётся. Пути к программам находятся один раз при старте,
+число одновременных запусков ограничено для каждой программы отдельно,
+по каждой программе ведётся статистика запусков и времени работы.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Одновременных запусков одной программы, если для неё не задано иное
+DEFAULT_TOOL_CONCURRENCY = 2
+# Сколько ждать выхода после SIGTERM перед SIGKILL при остановке по таймауту
+KILL_GRACE = 3.0
+
+class ProcessError(Exception):
+    """Ошибка запуска внешней программы"""
+    pass
+
+class ToolNotFound(ProcessError):
+    """Программа не найдена при старте бота"""
+    pass
+
+class ProcessTimeout(ProcessError):
+    """Программа не завершилась за отведённое время и остановлена"""
+    pass
+
+class ProcessResult:
+    def __init__(self, tool: str, returncode: int, stdout: bytes, stderr: bytes, seconds: float):
+        self.tool = tool
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    def error_text(self, limit: int = 500) -> str:
+        """Текст ошибки для лога: stderr, а если он пуст — stdout"""
+        text = (self.stderr or self.stdout).decode('utf-8', 'replace').strip()
+        return text[-limit:] or f"код возврата {self.returncode}"
+
+class ProcessRunner:
+    """
+    Общий запускатель внешних программ
+    
+    run() — короткие вызовы с таймаутом и захватом вывода; spawn() и
+    terminate() — долгоживущие процессы, которыми управляет вызывающий код.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self._limits = dict(limits or {})
+        self._semaphores = {}
+        self._paths = {}
+        self._stats = {}
+
+    @staticmethod
+    def tool_name(program: str) -> str:
+        return Path(program).name
+
+    def resolve_tools(self, programs: Iterable[str]):
+        """Поиск путей к программам (вызывается при старте); результат, в том числе отсутствие, запоминается"""
+        for program in programs:
+            path = self.path(program)
+            if path:
+                logger.debug(f"Программа {self.tool_name(program)}: {path}")
+            else:
+                logger.warning(f"Программа {program} не найдена, связанные функции недоступны")
+
+    def path(self, program: str) -> Optional[str]:
+        """Полный путь к программе или None; ищется только при первом обращении"""
+        if program not in self._paths:
+            if os.sep in program:
+                found = program if os.access(program, os.X_OK) else None
+            else:
+                found = shutil.which(program)
+            self._paths[program] = found
+        return self._paths[program]
+
+    def _semaphore(self, tool: str) -> asyncio.Semaphore:
+        # Создаётся внутри работающего цикла: в Python 3.9 примитивы привязываются к циклу при создании
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(self._limits.get(tool, DEFAULT_TOOL_CONCURRENCY))
+        return self._semaphores[tool]
+
+    def _record(self, tool: str, seconds: float, queued: float, outcome: str):
+        stats = self._stats.setdefault(tool, {
+            "calls": 0, "failures": 0, "timeouts": 0,
+            "seconds": 0.0, "max_seconds": 0.0, "queued_seconds": 0.0,
+        })
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["queued_seconds"] += queued
+        if outcome == "failure":
+            stats["failures"] += 1
+        elif outcome == "timeout":
+            stats["timeouts"] += 1
+
+    def stats(self) -> Dict[str, dict]:
+        """Статистика по программам: число запусков, ошибок, таймаутов, суммарное и максимальное время"""
+        return {tool: dict(values) for tool, values in self._stats.items()}
+
+    def log_stats(self):
+        for tool, stats in self._stats.items():
+            logger.info(
+                f"{tool}: запусков {stats['calls']}, ошибок {stats['failures']}, таймаутов {stats['timeouts']}, "
+                f"в среднем {stats['seconds'] / stats['calls']:.1f} с, максимум {stats['max_seconds']:.1f} с, "
+                f"ожидание очереди {stats['queued_seconds']:.1f} с"
+            )
+
+    def _command(self, args: List[str]) -> List[str]:
+        path = self.path(args[0])
+        if path is None:
+            raise ToolNotFound(f"Программа {args[0]} не найдена")
+        return [path, *args[1:]]
+
+    async def spawn(self, args: List[str], stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                    env: Optional[dict] = None, cwd: Optional[Path] = None) -> asyncio.subprocess.Process:
+        """Запуск долгоживущего процесса в отдельной группе; остановка — через terminate()"""
+        return await asyncio.create_subprocess_exec(
+            *self._command(args), stdin=stdin, stdout=stdout, stderr=stderr,
+            env=env, cwd=cwd, start_new_session=True
+        )
+
+    async def terminate(self, process: asyncio.subprocess.Process, grace: float = KILL_GRACE):
+        """Остановка группы процесса: SIGTERM, а если через grace секунд она жива — SIGKILL"""
+        if process.returncode is not None:
+            return
+        for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, None)):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(process.wait(), wait)
+                return
+            except asyncio.TimeoutError:
+                continue
+        await process.wait()
+
+    async def run(self, args: List[str], timeout: float, input: Optional[bytes] = None,
+                  env: Optional[dict] = None, cwd: Optional[Path] = None) -> ProcessResult:
+        """
+        Запуск программы с ожиданием завершения и захватом вывода
+        
+        Ненулевой код возврата не считается исключением (см. ProcessResult.ok);
+        ToolNotFound, если программы нет, ProcessTimeout по таймауту.
+        """
+        command = self._command(args)
+        tool = self.tool_name(args[0])
+        queued_at = time.monotonic()
+        async with self._semaphore(tool):
+            started = time.monotonic()
+            queued = started - queued_at
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                env=env, cwd=cwd, start_new_session=True
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+            except asyncio.TimeoutError:
+                await self.terminate(process)
+                self._record(tool, time.monotonic() - started, queued, "timeout")
+                logger.warning(f"{tool} не завершился за {timeout:.0f} с, группа процессов остановлена")
+                raise ProcessTimeout(f"{tool} не завершился за {timeout:.0f} с")
+            except asyncio.CancelledError:
+                await self.terminate(process)
+                self._record(tool, time.monotonic() - started, queued, "failure")
+                raise
+        
+        seconds = time.monotonic() - started
+        result = ProcessResult(tool, process.returncode, stdout, stderr, seconds)
+        self._record(tool, seconds, queued, "ok" if result.ok else "failure")
+        logger.debug(f"{tool}: код {result.returncode} за {seconds:.2f} с (очередь {queued:.2f} с)")
+        return result
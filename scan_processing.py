@@ -0,0 +1,819 @@
+"""
+Обработка и кодирование сканов без обращения к устройству
+
+Здесь собрано всё, что делается с уже полученным кадром: анализ страницы,
+обрезка и выравнивание, понижение цветового режима, кодирование в PDF/MRC
+и под лимит размера, передача кадра через shared memory. Модуль не
+импортирует SANE и не создаёт глобальных объектов, поэтому процессы пула
+кодирования (spawn) загружают только его, а не scanner.py с HPScanner.
+"""
+import io
+import logging
+import math
+import os
+import itertools
+from pathlib import Path
+from PIL import Image, ImageFilter
+import numpy as np
+from multiprocessing import shared_memory
+from typing import Optional, Tuple, Iterator
+import config
+from pdf_writer import PdfWriter
+
+logger = logging.getLogger(__name__)
+
+# --- Обработка полосами ---
+
+def _strip_height(width: int, bytes_per_pixel: int, align: int = 1) -> int:
+    """Высота полосы, при которой рабочие буферы одной полосы укладываются в SCAN_TILE_MEMORY_MB"""
+    budget = max(config.SCAN_TILE_MEMORY_MB, 1) * 1024 * 1024
+    rows = max(budget // max(width * bytes_per_pixel, 1), 16)
+    return max(rows - rows % align, align)
+
+def _iter_strips(height: int, rows: int, overlap: int = 0) -> Iterator[Tuple[int, int, int, int]]:
+    """Полосы (top, bottom) и они же с запасом overlap строк (для фильтров с окном)"""
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        yield top, bottom, max(top - overlap, 0), min(bottom + overlap, height)
+
+def _new_like(image: Image.Image, size: Tuple[int, int], mode: Optional[str] = None) -> Image.Image:
+    result = Image.new(mode or image.mode, size)
+    if result.mode == 'P':
+        result.putpalette(image.getpalette())
+    return result
+
+def _resize_strips(image: Image.Image, size: Tuple[int, int], resample) -> Image.Image:
+    """
+    Масштабирование полосами: Pillow берёт для полосы только нужные строки
+    источника, поэтому промежуточный буфер ограничен полосой, а не кадром.
+    """
+    scale_y = image.size[1] / float(size[1])
+    rows = _strip_height(max(image.size[0], size[0]), int(4 * (1 + scale_y)) + 4)
+    if rows >= size[1]:
+        return image.resize(size, resample)
+    result = _new_like(image, size)
+    for top, bottom, _, _ in _iter_strips(size[1], rows):
+        box = (0, top * scale_y, image.size[0], bottom * scale_y)
+        result.paste(image.resize((size[0], bottom - top), resample, box=box), (0, top))
+    return result
+
+# --- Анализ страницы ---
+
+# Ширина уменьшенной копии для анализа: на 300 dpi это ~8 пикселей на точку,
+# штрих текста ещё заметно темнее фона
+ANALYSIS_WIDTH = 320
+
+class PageStats:
+    """
+    Сводка страницы для анализа, собранная за один проход полосами.
+    
+    gray — серая копия с усреднением по блокам (фон, чернила, границы, наклон),
+    sample — прореженная без усреднения копия в исходных каналах (цветность,
+    полутона штрихов). Обе шириной около ANALYSIS_WIDTH * 2; полный кадр в
+    оттенках серого при этом не создаётся. После обрезки и поворота кадра
+    сводка пересчитывается так же, без нового прохода по пикселям.
+    """
+    def __init__(self, gray: np.ndarray, sample: np.ndarray, size: Tuple[int, int]):
+        self.gray = gray
+        self.sample = sample
+        self.size = size
+    
+    @classmethod
+    def collect(cls, image: Image.Image, width: int = ANALYSIS_WIDTH * 2) -> 'PageStats':
+        factor = max(image.size[0] // width, 1)
+        # Полоса кратна factor, чтобы блоки усреднения не разрезались на границах полос
+        rows = _strip_height(image.size[0], 6, align=factor)
+        grays, samples = [], []
+        for top, bottom, _, _ in _iter_strips(image.size[1], rows):
+            strip = image.crop((0, top, image.size[0], bottom))
+            if strip.mode not in ('RGB', 'L'):
+                strip = strip.convert('RGB')
+            gray = strip if strip.mode == 'L' else strip.convert('L')
+            grays.append(np.asarray(gray.reduce(factor) if factor > 1 else gray))
+            samples.append(np.asarray(strip)[::factor, ::factor])
+        return cls(np.concatenate(grays), np.concatenate(samples), image.size)
+    
+    def view(self, width: int = ANALYSIS_WIDTH) -> np.ndarray:
+        """Серая копия шириной не меньше width как массив float32"""
+        view = self.gray.astype(np.float32)
+        factor = max(view.shape[1] // width, 1)
+        if factor > 1:
+            height, width = view.shape[0] // factor * factor, view.shape[1] // factor * factor
+            view = view[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+        return view
+    
+    def crop(self, box: Tuple[int, int, int, int]) -> 'PageStats':
+        left, top, right, bottom = box
+        scale_x = self.gray.shape[1] / float(self.size[0])
+        scale_y = self.gray.shape[0] / float(self.size[1])
+        rows = slice(int(top * scale_y), max(int(np.ceil(bottom * scale_y)), int(top * scale_y) + 1))
+        cols = slice(int(left * scale_x), max(int(np.ceil(right * scale_x)), int(left * scale_x) + 1))
+        return PageStats(self.gray[rows, cols], self.sample[rows, cols], (right - left, bottom - top))
+    
+    def rotate(self, angle: float, fill, size: Tuple[int, int]) -> 'PageStats':
+        """Сводка кадра, повёрнутого image.rotate(angle, expand=True) до размера size"""
+        fill_gray = fill if isinstance(fill, int) else int(round(sum(fill) / 3.0))
+        gray = Image.fromarray(self.gray).rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=fill_gray)
+        sample = Image.fromarray(self.sample).rotate(angle, resample=Image.NEAREST, expand=True, fillcolor=fill)
+        return PageStats(np.asarray(gray), np.asarray(sample), size)
+
+def _ink_mask(view: np.ndarray, background: float, delta: float = 40.0) -> np.ndarray:
+    return view < background - delta
+
+def detect_blank_page(image: Image.Image, threshold: Optional[float] = None,
+                      stats: Optional[PageStats] = None) -> Tuple[bool, dict]:
+    """
+    Пустая ли страница: доля «чернил» на уменьшенной копии ниже threshold.
+    
+    Чернилами считаются пиксели заметно темнее фона; порог темноты зависит
+    от разброса яркости самого фона, поэтому шум сканера и оттенок бумаги
+    не принимаются за текст. Поля страницы (тени от краёв листа) не учитываются.
+    Возвращает (пустая ли, {'ink', 'noise'}).
+    """
+    if threshold is None:
+        threshold = config.SCAN_BLANK_THRESHOLD
+    view = (stats or PageStats.collect(image)).view()
+    height, width = view.shape
+    margin_y, margin_x = height // 20, width // 20
+    view = view[margin_y:height - margin_y, margin_x:width - margin_x]
+    if view.size == 0:
+        return False, {"ink": 1.0, "noise": 0.0}
+    
+    background = float(np.median(view))
+    # Медианное абсолютное отклонение — оценка шума фона, устойчивая к самим чернилам
+    noise = float(np.median(np.abs(view - background))) * 1.4826
+    ink_delta = max(40.0, 4.0 * noise)
+    ink = float(np.count_nonzero(_ink_mask(view, background, ink_delta))) / view.size
+    return ink < threshold, {"ink": ink, "noise": noise}
+
+def estimate_skew(image: Image.Image, max_angle: Optional[float] = None, step: float = 0.25,
+                  stats: Optional[PageStats] = None) -> float:
+    """
+    Угол наклона содержимого в градусах (против часовой стрелки — положительный).
+    
+    Координаты тёмных пикселей уменьшенной копии поворачиваются на каждый
+    угол-кандидат, и для каждого строится гистограмма по строкам: у ровных
+    строк текста она самая «острая» (максимальная сумма квадратов).
+    """
+    if max_angle is None:
+        max_angle = config.SCAN_DESKEW_MAX_ANGLE
+    view = (stats or PageStats.collect(image)).view(ANALYSIS_WIDTH * 2)
+    ys, xs = np.nonzero(_ink_mask(view, float(np.median(view))))
+    if len(ys) < 50:
+        return 0.0
+    ys = ys.astype(np.float32)
+    xs = xs.astype(np.float32)
+    angles = np.arange(-max_angle, max_angle + step / 2, step, dtype=np.float32)
+    radians = np.deg2rad(angles)
+    # Строка каждого пикселя после поворота, сразу для всех углов: (углы x пиксели)
+    rows = ys[None, :] * np.cos(radians)[:, None] + xs[None, :] * np.sin(radians)[:, None]
+    rows = np.rint(rows - rows.min()).astype(np.int64)
+    bins = int(rows.max()) + 1
+    offsets = np.arange(len(angles), dtype=np.int64)[:, None] * bins
+    histograms = np.bincount((rows + offsets).ravel(), minlength=len(angles) * bins)
+    scores = (histograms.reshape(len(angles), bins).astype(np.float64) ** 2).sum(axis=1)
+    return float(angles[int(np.argmax(scores))])
+
+def detect_content_bounds(image: Image.Image,
+                          stats: Optional[PageStats] = None) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Границы документа на стекле по проекциям строк и столбцов.
+    
+    Фоном считается цвет рамки кадра (крышка сканера); строка или столбец
+    относятся к документу, если в них заметная доля пикселей отличается
+    от фона — это и края листа, и его содержимое.
+    Возвращает (left, top, right, bottom) в пикселях исходного кадра или None.
+    """
+    stats = stats or PageStats.collect(image)
+    view = stats.view()
+    height, width = view.shape
+    if height < 8 or width < 8:
+        return None
+    border = np.concatenate([view[0], view[-1], view[:, 0], view[:, -1]])
+    background = float(np.median(border))
+    mask = np.abs(view - background) > 24.0
+    rows = np.nonzero(mask.mean(axis=1) > 0.005)[0]
+    cols = np.nonzero(mask.mean(axis=0) > 0.005)[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    size = stats.size
+    scale_x = size[0] / float(width)
+    scale_y = size[1] / float(height)
+    return (int(cols[0] * scale_x), int(rows[0] * scale_y),
+            int(min((cols[-1] + 1) * scale_x, size[0])), int(min((rows[-1] + 1) * scale_y, size[1])))
+
+def _background_fill(stats: PageStats):
+    """Цвет фона для заполнения углов после поворота"""
+    values = stats.sample.reshape(-1, 1 if stats.sample.ndim == 2 else stats.sample.shape[2])
+    fill = [int(v) for v in np.median(values, axis=0)]
+    return fill[0] if len(fill) == 1 else tuple(fill)
+
+def _content_box(size: Tuple[int, int], stats: PageStats) -> Optional[Tuple[int, int, int, int]]:
+    """Область документа с полями 5 мм или None, если он занимает не меньше SCAN_CROP_MAX_AREA кадра"""
+    bounds = detect_content_bounds(None, stats)
+    if not bounds:
+        return None
+    left, top, right, bottom = bounds
+    # Поля вокруг найденной области, чтобы не срезать край листа
+    pad = int(config.SCAN_DPI * 5 / 25.4)
+    left, top = max(left - pad, 0), max(top - pad, 0)
+    right, bottom = min(right + pad, size[0]), min(bottom + pad, size[1])
+    if (right - left) * (bottom - top) >= size[0] * size[1] * config.SCAN_CROP_MAX_AREA:
+        return None
+    logger.info("Обрезка по границам документа: %sx%s -> %sx%s", size[0], size[1], right - left, bottom - top)
+    return left, top, right, bottom
+
+def _crop_to_content(image: Image.Image, stats: PageStats) -> Tuple[Image.Image, PageStats]:
+    """Обрезка по detect_content_bounds (_content_box)"""
+    box = _content_box(image.size, stats)
+    if not box:
+        return image, stats
+    return image.crop(box), stats.crop(box)
+
+def _rotation_transform(size: Tuple[int, int], angle: float) -> Tuple[Tuple[int, int], list]:
+    """
+    Размер и коэффициенты AFFINE кадра, повёрнутого как image.rotate(angle, expand=True).
+    
+    Формулы те же, что в Pillow, поэтому область повёрнутого кадра можно
+    получить одним Image.transform, не создавая повёрнутый кадр целиком.
+    """
+    width, height = size
+    theta = -math.radians(angle)
+    matrix = [round(math.cos(theta), 15), round(math.sin(theta), 15), 0.0,
+              round(-math.sin(theta), 15), round(math.cos(theta), 15), 0.0]
+    
+    def apply(x, y):
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+    
+    matrix[2], matrix[5] = apply(-width / 2.0, -height / 2.0)
+    matrix[2] += width / 2.0
+    matrix[5] += height / 2.0
+    corners = [apply(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    new_width = math.ceil(max(x for x, _ in corners)) - math.floor(min(x for x, _ in corners))
+    new_height = math.ceil(max(y for _, y in corners)) - math.floor(min(y for _, y in corners))
+    matrix[2], matrix[5] = apply(-(new_width - width) / 2.0, -(new_height - height) / 2.0)
+    return (new_width, new_height), matrix
+
+def _rotate_to_box(image: Image.Image, angle: float, box: Tuple[int, int, int, int], fill) -> Image.Image:
+    """Область box кадра, повёрнутого image.rotate(angle, expand=True), без промежуточного полного кадра"""
+    a, b, c, d, e, f = _rotation_transform(image.size, angle)[1]
+    left, top, right, bottom = box
+    matrix = (a, b, a * left + b * top + c, d, e, d * left + e * top + f)
+    return image.transform((right - left, bottom - top), Image.AFFINE, matrix,
+                           resample=Image.BICUBIC, fillcolor=fill)
+
+def _prepare_with_stats(image: Image.Image,
+                        stats: Optional[PageStats] = None) -> Tuple[Image.Image, PageStats]:
+    """prepare_scan_image, возвращающий и сводку уже обработанного кадра"""
+    if stats is None:
+        stats = PageStats.collect(image)
+    if config.SCAN_AUTO_CROP:
+        image, stats = _crop_to_content(image, stats)
+    
+    if config.SCAN_DESKEW and image.mode not in ('1', 'P'):
+        angle = estimate_skew(image, stats=stats)
+        if abs(angle) >= 0.3:
+            logger.info("Выравнивание наклона: %.2f°", angle)
+            fill = _background_fill(stats)
+            size = _rotation_transform(image.size, -angle)[0]
+            stats = stats.rotate(-angle, fill, size)
+            # Повторная обрезка решается по сводке заранее, и поворот сразу даёт
+            # только нужную область: полный повёрнутый кадр не создаётся
+            box = _content_box(size, stats) if config.SCAN_AUTO_CROP else None
+            image = _rotate_to_box(image, -angle, box or (0, 0) + size, fill)
+            if box:
+                stats = stats.crop(box)
+    return image, stats
+
+def prepare_scan_image(image: Image.Image, stats: Optional[PageStats] = None) -> Image.Image:
+    """
+    Обработка кадра перед кодированием: обрезка по границам документа
+    и выравнивание наклона (SCAN_AUTO_CROP, SCAN_DESKEW).
+    
+    Сначала кадр обрезается, и поворачивается уже только сам документ;
+    после поворота обрезка повторяется по новым границам. Все решения
+    принимаются по сводке PageStats, собранной одним проходом полосами.
+    Поворот и повторная обрезка выполняются одним преобразованием, так что
+    кроме исходного кадра в памяти только итоговый.
+    """
+    return _prepare_with_stats(image, stats)[0]
+
+def _encode_g4(image: Image.Image) -> bytes:
+    """
+    Сжатие 1-битного кадра CCITT Group 4 (одна полоса TIFF без заголовка).
+    
+    Pillow пишет TIFF с MinIsBlack, поэтому чёрные пиксели кадра идут
+    в потоке как «белые» серии факса.
+    """
+    buf = io.BytesIO()
+    image.save(buf, 'TIFF', compression='group4', tiffinfo={278: image.size[1]})
+    tiff = Image.open(io.BytesIO(buf.getvalue()))
+    data = buf.getvalue()
+    return b"".join(data[offset:offset + count]
+                    for offset, count in zip(tiff.tag_v2[273], tiff.tag_v2[279]))
+
+def _encode_pdf_page(image: Image.Image, quality: int = 85) -> dict:
+    """Кодирование страницы для PDF: JPEG для цвета/серого, CCITT G4 для 1 бита"""
+    width, height = image.size
+    if image.mode == '1':
+        return {"data": _encode_g4(image), "size": (width, height), "colorspace": '/DeviceGray',
+                "bits": 1, "filter": '/CCITTFaxDecode',
+                "decode_parms": f"<< /K -1 /Columns {width} /Rows {height} /BlackIs1 true >>"}
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality)
+    colorspace = '/DeviceRGB' if image.mode == 'RGB' else '/DeviceGray'
+    return {"data": buf.getvalue(), "size": (width, height),
+            "colorspace": colorspace, "bits": 8, "filter": '/DCTDecode'}
+
+class _MaskedBlockMean:
+    """
+    Среднее по блокам factor x factor только по пикселям маски, собираемое
+    полосами кадра; блоки без таких пикселей заполняются fill. Суммы копятся
+    по сдвигам внутри блока и только для текущей полосы, поэтому дополнительная
+    память — размер результата (uint8). Неполные блоки у правого и нижнего
+    края получают меньше слагаемых, кадр не дополняется.
+    """
+    def __init__(self, size: Tuple[int, int], channels: int, factor: int):
+        out_h, out_w = -(-size[1] // factor), -(-size[0] // factor)
+        self.factor = factor
+        self.means = np.zeros((out_h, out_w, channels), dtype=np.uint8)
+        self.filled = np.zeros((out_h, out_w), dtype=bool)
+    
+    def add(self, top: int, pixels: np.ndarray, mask: np.ndarray):
+        """Полоса кадра со строки top (кратной factor): пиксели (h, w, каналы) и маска (h, w)"""
+        factor = self.factor
+        height, width = mask.shape
+        out_h, out_w = -(-height // factor), -(-width // factor)
+        sums = np.zeros((out_h, out_w, pixels.shape[2]), dtype=np.uint32)
+        counts = np.zeros((out_h, out_w), dtype=np.uint32)
+        for dy in range(min(factor, height)):
+            for dx in range(min(factor, width)):
+                block_mask = mask[dy::factor, dx::factor]
+                rows, cols = block_mask.shape
+                sums[:rows, :cols] += pixels[dy::factor, dx::factor] * block_mask[..., None]
+                counts[:rows, :cols] += block_mask
+        row = top // factor
+        self.filled[row:row + out_h] = counts > 0
+        counts = np.maximum(counts, 1)[..., None]
+        self.means[row:row + out_h] = (sums + counts // 2) // counts
+    
+    def result(self, fill) -> np.ndarray:
+        self.means[~self.filled] = fill
+        return self.means
+
+def _encode_jpeg_layer(pixels: np.ndarray, quality: int) -> dict:
+    image = Image.fromarray(pixels[..., 0] if pixels.shape[2] == 1 else pixels)
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality)
+    return {"data": buf.getvalue(), "size": image.size,
+            "colorspace": '/DeviceRGB' if image.mode == 'RGB' else '/DeviceGray'}
+
+def _encode_mrc_page(image: Image.Image, quality: int = 85) -> dict:
+    """
+    Страница со смешанным растром (MRC): маска текста в полном разрешении
+    (CCITT G4), цвет текста и фон — отдельными JPEG низкого разрешения.
+    
+    Маска строится адаптивной бинаризацией; фон под текстом заполняется
+    средним цветом соседних пикселей фона, поэтому JPEG не тратит байты на
+    резкие края, а цвет текста (синие чернила, печати) сохраняется слоем
+    переднего плана под маской.
+    """
+    if image.mode == '1':
+        return _encode_pdf_page(image, quality)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    mask_image = _adaptive_threshold(image, config.SCAN_DPI)
+    width, height = image.size
+    channels = 3 if image.mode == 'RGB' else 1
+    background = _MaskedBlockMean(image.size, channels, config.SCAN_MRC_BG_FACTOR)
+    foreground = _MaskedBlockMean(image.size, channels, config.SCAN_MRC_FG_FACTOR)
+    samples, text_samples, text_seen = [], [], 0
+    # Слои копятся полосами: полная копия кадра в NumPy и полнокадровые маски
+    # текста и фона не создаются. Полоса кратна обоим коэффициентам и шагу
+    # выборки фона, чтобы блоки не разрезались на границах полос.
+    align = math.lcm(config.SCAN_MRC_BG_FACTOR, config.SCAN_MRC_FG_FACTOR, 8)
+    rows = _strip_height(width, 12, align=align)
+    for top, bottom, _, _ in _iter_strips(height, rows):
+        pixels = np.asarray(image.crop((0, top, width, bottom)))
+        if pixels.ndim == 2:
+            pixels = pixels[..., None]
+        text = ~np.asarray(mask_image.crop((0, top, width, bottom)))
+        samples.append(pixels[::8, ::8].reshape(-1, channels))
+        # Каждый 16-й пиксель текста в порядке строк, как при выборке по всему кадру
+        text_pixels = pixels[text]
+        text_samples.append(text_pixels[-text_seen % 16::16])
+        text_seen += len(text_pixels)
+        background.add(top, pixels, ~text)
+        foreground.add(top, pixels, text)
+    
+    background_fill = np.median(np.concatenate(samples), axis=0).astype(np.uint8)
+    text_sample = np.concatenate(text_samples)
+    text_fill = np.median(text_sample, axis=0).astype(np.uint8) if len(text_sample) else 0
+    return {
+        "size": image.size,
+        "background": _encode_jpeg_layer(background.result(background_fill), quality),
+        "foreground": _encode_jpeg_layer(foreground.result(text_fill), quality),
+        "mask": _encode_g4(mask_image),
+    }
+
+def _write_mrc_page(writer: PdfWriter, page: dict, dpi: int):
+    """Фон на всю страницу, поверх — слой цвета текста, видимый только через маску"""
+    scale = 72.0 / (dpi or 72)
+    width, height = page["size"]
+    mask = writer.add_image_mask(page["mask"], width, height, '/CCITTFaxDecode',
+                                 f"<< /K -1 /Columns {width} /Rows {height} /BlackIs1 true >>")
+    layers = []
+    for name, extra in (("background", ''), ("foreground", f"/Mask {mask} 0 R")):
+        layer = page[name]
+        layers.append(writer.add_image(layer["data"], layer["size"][0], layer["size"][1],
+                                       layer["colorspace"], extra=extra))
+    writer.begin_page(width * scale, height * scale)
+    for obj in layers:
+        writer.draw_image(obj, 0, 0, width * scale, height * scale)
+    writer.end_page()
+
+def _write_pdf_page(writer: PdfWriter, page: dict, dpi: int):
+    """Запись закодированной страницы (_encode_pdf_page, _encode_mrc_page) в PDF"""
+    if "mask" in page:
+        _write_mrc_page(writer, page, dpi)
+        return
+    scale = 72.0 / (dpi or 72)
+    width, height = page["size"]
+    obj = writer.add_image(page["data"], width, height, page["colorspace"], page["bits"], page["filter"],
+                           decode_parms=page.get("decode_parms"))
+    writer.begin_page(width * scale, height * scale)
+    writer.draw_image(obj, 0, 0, width * scale, height * scale)
+    writer.end_page()
+
+# --- Форматы и кодирование под целевой размер файла ---
+
+# Размер пробы для оценки: ~0.25 Мп кодируются за доли секунды даже на Pi 3
+SIZE_PROBE_PIXELS = 250_000
+# Запас относительно лимита на погрешность оценки по пробе
+SIZE_TARGET_MARGIN = 0.9
+LOSSY_FORMATS = ('JPEG', 'PDF', 'WEBP', 'MRC')
+# MRC — PDF со смешанным растром (маска текста + фон и цвет текста низкого разрешения)
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpeg', 'PDF': 'pdf', 'TIFF': 'tif', 'WEBP': 'webp', 'MRC': 'pdf'}
+# Кандидаты SCAN_FORMAT=AUTO для ч/б и для цветных/серых страниц
+BILEVEL_FORMATS = ('TIFF', 'PDF', 'PNG')
+TONE_FORMATS = ('PDF', 'MRC', 'JPEG', 'WEBP', 'PNG')
+# Формат из списка SCAN_AUTO_FORMATS уступает следующему, только если тот меньше больше чем на 5%
+AUTO_FORMAT_TOLERANCE = 1.05
+
+def _resample_filter(image: Image.Image):
+    if image.mode in ('1', 'P'):
+        return Image.NEAREST
+    # Совместимость со старыми версиями Pillow
+    try:
+        return Image.Resampling.LANCZOS
+    except AttributeError:
+        return Image.LANCZOS
+
+def _format_quality(fmt: str) -> int:
+    return config.SCAN_WEBP_QUALITY if fmt == 'WEBP' else config.SCAN_JPEG_QUALITY
+
+def _encode_pdf_document(image: Image.Image, quality: int, mrc: bool = False) -> bytes:
+    """Одностраничный PDF: CCITT G4 для 1 бита, JPEG для цвета и серого или MRC"""
+    buf = io.BytesIO()
+    writer = PdfWriter(buf)
+    page = _encode_mrc_page(image, quality) if mrc else _encode_pdf_page(image, quality)
+    _write_pdf_page(writer, page, config.SCAN_DPI)
+    writer.close()
+    return buf.getvalue()
+
+def _encode_image(image: Image.Image, fmt: str, quality: Optional[int] = None) -> bytes:
+    """Кодирование изображения в память в одном из форматов FORMAT_EXTENSIONS"""
+    if quality is None and fmt in LOSSY_FORMATS:
+        quality = _format_quality(fmt)
+    if fmt in LOSSY_FORMATS and image.mode not in ('RGB', 'L', '1'):
+        image = image.convert('RGB')
+    if fmt in ('PDF', 'MRC'):
+        return _encode_pdf_document(image, quality, mrc=fmt == 'MRC')
+    
+    buf = io.BytesIO()
+    if fmt == 'TIFF':
+        if image.mode == '1':
+            image.save(buf, 'TIFF', compression='group4', dpi=(config.SCAN_DPI, config.SCAN_DPI))
+        else:
+            image.save(buf, 'TIFF', compression='tiff_adobe_deflate', dpi=(config.SCAN_DPI, config.SCAN_DPI))
+    elif fmt in ('JPEG', 'WEBP'):
+        if image.mode == '1':
+            image = image.convert('L')
+        image.save(buf, fmt, quality=quality)
+    else:
+        image.save(buf, fmt)
+    return buf.getvalue()
+
+def _size_probe(image: Image.Image) -> Tuple[Image.Image, float]:
+    """
+    Проба для оценки размера: мозаика из 2x2 фрагментов в исходном разрешении.
+    
+    Уменьшенная копия теряет мелкие детали и даёт заниженную оценку,
+    а фрагменты 1:1 сохраняют текстуру (шум, растр, текст) кадра.
+    Возвращает пробу и во сколько раз в кадре больше пикселей, чем в ней.
+    """
+    width, height = image.size
+    if width * height <= SIZE_PROBE_PIXELS:
+        return image, 1.0
+    tile_w = min(int((SIZE_PROBE_PIXELS / 4) ** 0.5), width // 2)
+    tile_h = min(int((SIZE_PROBE_PIXELS / 4) ** 0.5), height // 2)
+    probe = Image.new(image.mode, (tile_w * 2, tile_h * 2))
+    if image.mode == 'P':
+        probe.putpalette(image.getpalette())
+    for row in range(2):
+        for col in range(2):
+            # Центры четвертей кадра: поля страницы не попадают в пробу целиком
+            left = (width * (2 * col + 1)) // 4 - tile_w // 2
+            top = (height * (2 * row + 1)) // 4 - tile_h // 2
+            tile = image.crop((left, top, left + tile_w, top + tile_h))
+            probe.paste(tile, (col * tile_w, row * tile_h))
+    return probe, (width * height) / float(probe.size[0] * probe.size[1])
+
+def _estimate_size(probe: Image.Image, ratio: float, fmt: str, quality: Optional[int] = None) -> float:
+    """Оценка размера полного кадра по пробе; PDF оценивается по вложенному потоку без обвязки"""
+    if fmt == 'PDF':
+        data = _encode_g4(probe) if probe.mode == '1' else _encode_image(probe, 'JPEG', quality)
+    else:
+        data = _encode_image(probe, fmt, quality)
+    return len(data) * ratio
+
+def estimate_format_sizes(image: Image.Image, formats) -> dict:
+    """Сравнение форматов: оценка размера полного кадра в байтах для каждого из formats"""
+    probe, ratio = _size_probe(image)
+    return {fmt: int(_estimate_size(probe, ratio, fmt)) for fmt in formats}
+
+def choose_format(image: Image.Image) -> str:
+    """
+    Формат для страницы. При SCAN_FORMAT=AUTO кандидаты из SCAN_AUTO_FORMATS,
+    подходящие к странице (BILEVEL_FORMATS для ч/б, TONE_FORMATS для остальных),
+    сравниваются по оценке размера; среди почти равных выигрывает стоящий
+    раньше в списке.
+    """
+    fmt = config.SCAN_FORMAT.upper()
+    if fmt != 'AUTO':
+        return fmt
+    allowed = BILEVEL_FORMATS if image.mode == '1' else TONE_FORMATS
+    candidates = [f for f in config.SCAN_AUTO_FORMATS if f in allowed] or ['PDF']
+    if len(candidates) == 1:
+        return candidates[0]
+    sizes = estimate_format_sizes(image, candidates)
+    smallest = min(sizes.values())
+    chosen = next(f for f in candidates if sizes[f] <= smallest * AUTO_FORMAT_TOLERANCE)
+    logger.info("Оценка размера (%s): %s; выбран %s", image.mode,
+                ", ".join(f"{f} ~{sizes[f] // 1024} КБ" for f in candidates), chosen)
+    return chosen
+
+def encode_to_size(image: Image.Image, fmt: str, max_bytes: int,
+                   quality: Optional[int] = None, min_quality: Optional[int] = None) -> Tuple[bytes, dict]:
+    """
+    Кодирование в память с попаданием под max_bytes за один проход по полному кадру.
+    
+    Качество и масштаб подбираются на уменьшенной пробе (размер полного кадра
+    оценивается пропорционально числу пикселей); полный кадр кодируется один
+    раз и лишь при промахе оценки — ещё раз с поправленным масштабом.
+    Возвращает (данные, {'quality', 'scale', 'estimate'}).
+    """
+    fmt = fmt.upper()
+    quality = quality or _format_quality(fmt)
+    min_quality = min_quality or config.SCAN_MIN_JPEG_QUALITY
+    target = max_bytes * SIZE_TARGET_MARGIN
+    probe, ratio = _size_probe(image)
+    # 1-битный кадр сжимается без потерь (G4), качество подбирать не у чего
+    lossy = fmt in LOSSY_FORMATS and image.mode != '1'
+    
+    def estimate(q):
+        return _estimate_size(probe, ratio, fmt, q)
+    
+    scale = 1.0
+    if lossy:
+        size = estimate(quality)
+        if size > target:
+            # Бинарный поиск максимального качества, укладывающегося в лимит
+            low, high, best = min_quality, quality - 1, None
+            while low <= high:
+                mid = (low + high) // 2
+                mid_size = estimate(mid)
+                if mid_size <= target:
+                    best, size, low = mid, mid_size, mid + 1
+                else:
+                    high = mid - 1
+            if best is None:
+                quality = min_quality
+                size = estimate(quality)
+                scale = (target / size) ** 0.5
+            else:
+                quality = best
+    else:
+        quality = None
+        size = estimate(None)
+        if size > target:
+            scale = (target / size) ** 0.5
+    
+    info = {"quality": quality, "scale": round(scale, 3), "estimate": int(size * min(scale, 1.0) ** 2)}
+    for attempt in range(3):
+        frame = image
+        if scale < 1.0:
+            new_size = (max(int(image.size[0] * scale), 1), max(int(image.size[1] * scale), 1))
+            frame = _resize_strips(image, new_size, _resample_filter(image))
+        data = _encode_image(frame, fmt, quality)
+        if len(data) <= max_bytes:
+            break
+        # Оценка ошиблась — уменьшаем масштаб пропорционально промаху
+        scale *= (target / len(data)) ** 0.5
+        logger.info("Размер %s байт больше лимита, повторяю с масштабом %.2f", len(data), scale)
+    info["scale"] = round(scale, 3)
+    if len(data) > max_bytes:
+        logger.warning("Не удалось уложиться в %s байт: %s байт", max_bytes, len(data))
+    return data, info
+
+def _encode_for_delivery(image: Image.Image, fmt: str) -> bytes:
+    """Кодирование под лимит MAX_FILE_SIZE_MB без записи на диск"""
+    data, info = encode_to_size(image, fmt, config.MAX_FILE_SIZE_MB * 1024 * 1024)
+    lossy = fmt.upper() in LOSSY_FORMATS and image.mode != '1'
+    if info["scale"] < 1.0 or (lossy and info["quality"] != _format_quality(fmt.upper())):
+        logger.info("Скан сжат под лимит %sMB: качество %s, масштаб %s", config.MAX_FILE_SIZE_MB,
+                    info["quality"], info["scale"])
+    logger.info("Закодировано в %s: %s КБ (оценка %s КБ)", fmt, len(data) // 1024, info["estimate"] // 1024)
+    return data
+
+def _write_bytes(filepath: Path, data: bytes):
+    with open(filepath, 'wb') as f:
+        f.write(data)
+
+def _adaptive_threshold(image: Image.Image, dpi: int) -> Image.Image:
+    """
+    Бинаризация с порогом по локальному среднему (окно ~2.5 мм):
+    неравномерная подсветка и серая бумага не превращаются в чёрные пятна.
+    
+    Считается полосами с перекрытием на радиус окна, поэтому рабочие
+    массивы (int16 на пиксель) не выходят за SCAN_TILE_MEMORY_MB; на выходе
+    сразу 1-битный кадр, полная серая копия цветного кадра не создаётся.
+    """
+    radius = max(int(dpi / 20), 4)
+    width, height = image.size
+    result = Image.new('1', image.size)
+    rows = _strip_height(width, 12)
+    for top, bottom, context_top, context_bottom in _iter_strips(height, rows, radius + 1):
+        strip = image.crop((0, context_top, width, context_bottom))
+        gray = strip if strip.mode == 'L' else strip.convert('L')
+        local_mean = np.asarray(gray.filter(ImageFilter.BoxBlur(radius)), dtype=np.int16)
+        pixels = np.asarray(gray, dtype=np.int16)
+        # Пиксель белый, если он не темнее окружения больше чем на 12 уровней
+        white = pixels > local_mean - 12
+        result.paste(Image.fromarray(white[top - context_top:bottom - context_top]), (0, top))
+    return result
+
+def classify_colour(image: Image.Image, stats: Optional[PageStats] = None) -> str:
+    """
+    Какой цветовой режим нужен странице: 'color', 'gray' или 'bw'.
+    
+    Цветность (max - min по каналам) считается на прореженной копии из
+    PageStats; страница цветная, если заметно цветных пикселей больше
+    SCAN_COLOR_THRESHOLD. Серую страницу можно бинаризовать, если полутонов
+    на ней мало (текст, таблицы, подписи) — их доля среди тёмных пикселей
+    не больше SCAN_BW_MAX_MIDTONES.
+    """
+    if image.mode == '1':
+        return 'bw'
+    # Прореживание без усреднения: усреднение размывает штрихи в полутона
+    # и растворяет мелкие цветные пометки
+    view = (stats or PageStats.collect(image)).sample.astype(np.int16)
+    if view.ndim == 3:
+        chroma = view.max(axis=2) - view.min(axis=2)
+        if np.count_nonzero(chroma > 40) > chroma.size * config.SCAN_COLOR_THRESHOLD:
+            return 'color'
+        gray = view.mean(axis=2)
+    else:
+        gray = view
+    # Доля полутонов среди всех не-фоновых пикселей: у текста это только
+    # края штрихов, у фотографий и заливок — большая часть
+    midtones = np.count_nonzero((gray > 70) & (gray < 180))
+    dark = np.count_nonzero(gray <= 70)
+    if midtones <= (midtones + dark) * config.SCAN_BW_MAX_MIDTONES:
+        return 'bw'
+    return 'gray'
+
+def reduce_colour_mode(image: Image.Image, fmt: str,
+                       stats: Optional[PageStats] = None) -> Tuple[Image.Image, str]:
+    """
+    Понижение цветового режима по содержимому страницы (SCAN_AUTO_COLOR).
+    
+    Возвращает изображение и метку режима для имени файла. JPEG и WebP
+    не умеют 1 бит, поэтому для них бинаризация заменяется оттенками серого.
+    """
+    kind = classify_colour(image, stats)
+    if kind == 'color' or (kind == 'gray' and image.mode == 'L'):
+        return image, kind
+    if kind == 'bw' and fmt not in ('JPEG', 'WEBP'):
+        return _adaptive_threshold(image, config.SCAN_DPI), kind
+    return (image if image.mode == 'L' else image.convert('L')), 'gray'
+
+def _finish_scan(image: Image.Image, fmt: str) -> Tuple[bytes, Optional[str], str]:
+    """
+    Обработка кадра (prepare_scan_image, reduce_colour_mode), выбор формата
+    (choose_format при AUTO) и кодирование под лимит размера.
+    
+    Возвращает данные, метку режима ('gray', 'bw') для имени файла или None
+    и итоговый формат.
+    """
+    image, stats = _prepare_with_stats(image)
+    tag = None
+    if config.SCAN_AUTO_COLOR and image.mode not in ('1', 'P'):
+        reduced, kind = reduce_colour_mode(image, fmt, stats)
+        if reduced.mode != image.mode:
+            logger.info("Цветовой режим понижен: %s -> %s", image.mode, reduced.mode)
+            image, tag = reduced, kind
+    if fmt == 'AUTO':
+        fmt = choose_format(image)
+    return _encode_for_delivery(image, fmt), tag, fmt
+
+def _write_encoded(image: Image.Image, filepath: Path, fmt: str):
+    """Кодирование под лимит MAX_FILE_SIZE_MB и однократная запись файла"""
+    _write_bytes(filepath, _encode_for_delivery(image, fmt))
+
+# --- Передача кадров через shared memory ---
+
+# Сегменты shared memory называются по pid создавшего процесса: если процесс
+# SANE убит между созданием сегмента и ответом, родитель находит и удаляет их сам
+SHM_PREFIX = "scan2telegram_"
+SHM_DIR = Path("/dev/shm")
+_shm_counter = itertools.count()
+
+def _create_shared_memory(size: int) -> shared_memory.SharedMemory:
+    while True:
+        name = f"{SHM_PREFIX}{os.getpid()}_{next(_shm_counter)}"
+        try:
+            return shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+        except FileExistsError:
+            # Остаток от прошлого процесса с тем же pid
+            continue
+
+def _export_image_to_shared_memory(image: Image.Image) -> dict:
+    """
+    Запись пикселей в сегмент shared memory; по pipe уходит только описание.
+    
+    Кадр копируется в сегмент полосами, поэтому кроме самого сегмента
+    в памяти одновременно лежит только одна полоса, а не весь tobytes().
+    """
+    width, height = image.size
+    row_bytes = len(image.crop((0, 0, width, 1)).tobytes()) if height else 0
+    nbytes = row_bytes * height
+    shm = _create_shared_memory(nbytes)
+    try:
+        rows = _strip_height(max(row_bytes, 1), 1)
+        for top, bottom, _, _ in _iter_strips(height, rows):
+            shm.buf[top * row_bytes:bottom * row_bytes] = image.crop((0, top, width, bottom)).tobytes()
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return {"shm": shm.name, "mode": image.mode, "size": image.size, "nbytes": nbytes}
+
+def _import_image_from_shared_memory(meta: dict) -> Image.Image:
+    """Сборка PIL Image из сегмента shared memory с последующим его удалением"""
+    shm = shared_memory.SharedMemory(name=meta["shm"])
+    try:
+        view = shm.buf[:meta["nbytes"]]
+        try:
+            return Image.frombytes(meta["mode"], tuple(meta["size"]), view)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _unlink_shared_memory(name: str):
+    """Удаление сегмента, который уже никто не прочитает"""
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def _unlink_process_segments(pid: int):
+    """Удаление сегментов, оставшихся от завершённого процесса"""
+    if not SHM_DIR.is_dir():
+        return
+    for path in SHM_DIR.glob(f"{SHM_PREFIX}{pid}_*"):
+        _unlink_shared_memory(path.name)
+        logger.warning("Удалён сегмент shared memory процесса %s: %s", pid, path.name)
+
+# --- Задачи пула процессов кодирования ---
+
+def _encode_batch_page(image: Image.Image, quality: int, stats: Optional[PageStats] = None) -> dict:
+    """Страница пакетного сканирования: обработка -> данные для PDF"""
+    image, stats = _prepare_with_stats(image, stats)
+    if config.SCAN_AUTO_COLOR and image.mode not in ('1', 'P'):
+        image = reduce_colour_mode(image, 'PDF', stats)[0]
+    if config.SCAN_FORMAT.upper() == 'MRC':
+        return _encode_mrc_page(image, quality)
+    return _encode_pdf_page(image, quality)
+
+def _run_shared_task(func, meta: dict, *args):
+    """Задача пула: кадр из shared memory передаётся func (сегмент удаляется после чтения)"""
+    return func(_import_image_from_shared_memory(meta), *args)
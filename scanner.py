@@ -6,12 +6,34 @@ import asyncio
 import aiofiles
 from pathlib import Path
 from PIL import Image
+import numpy as np
+import io
 import logging
+import os
+import json
+import sys
 import tempfile
+import threading
+import time
+import multiprocessing
+import ctypes
+import ctypes.util
+import importlib.metadata
+import queue
+import struct
+import zlib
+from collections import deque
 from datetime import datetime
-from typing import Optional, Tuple, List
-from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, List, Iterator, Union
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import config
+from pdf_writer import PdfWriter
+from scan_processing import (
+    PageStats, FORMAT_EXTENSIONS, detect_blank_page, _finish_scan, _encode_batch_page, _encode_image,
+    _write_pdf_page, _write_bytes, _write_encoded, _run_shared_task, _export_image_to_shared_memory,
+    _import_image_from_shared_memory, _unlink_shared_memory, _unlink_process_segments,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -19,57 +41,971 @@ class ScannerError(Exception):
     """Исключение для ошибок сканера"""
     pass
 
-class HPScanner:
+class ScanCancelled(ScannerError):
+    """Сканирование отменено пользователем"""
+    pass
+
+# Счётчики преобразования кадров: отображение буфера без копии, одна распаковка
+# RGB во внутренний формат PIL (4 байта на пиксель) и лишние полные копии
+_conversion_stats = {"zero_copy": 0, "decoded": 0, "copies": 0, "copied_bytes": 0}
+
+def _count_copy(reason: str, nbytes: int):
+    """Учёт дорогой копии кадра: на 600 DPI в цвете это сотни мегабайт"""
+    _conversion_stats["copies"] += 1
+    _conversion_stats["copied_bytes"] += nbytes
+    logger.warning("Кадр скопирован при преобразовании (%s): %.1f МБ, всего копий %s (%.1f МБ)",
+                   reason, nbytes / 1048576, _conversion_stats["copies"],
+                   _conversion_stats["copied_bytes"] / 1048576)
+
+def _buffer_to_image(buffer, mode: str, size: Tuple[int, int]) -> Image.Image:
+    """
+    PIL Image поверх буфера кадра без промежуточных копий.
+    
+    Для L Image.frombuffer отображает память буфера (bytearray, numpy,
+    memoryview) как есть. RGB внутри PIL хранится по 4 байта на пиксель,
+    поэтому распаковывается один раз прямо из буфера — без bytes() и
+    np.array() перед этим. Буфер с выравниванием строк копируется.
+    """
+    view = memoryview(buffer)
+    expected = size[0] * size[1] * len(mode)
+    if view.c_contiguous and view.nbytes == expected:
+        _conversion_stats["zero_copy" if mode == 'L' else "decoded"] += 1
+        return Image.frombuffer(mode, size, view.cast('B'), 'raw', mode, 0, 1)
+    if view.nbytes < expected:
+        raise ScannerError(f"Буфер кадра короче ожидаемого: {view.nbytes} из {expected} байт")
+    _count_copy("неплотный буфер", view.nbytes)
+    data = view.tobytes()
+    return Image.frombytes(mode, size, data, 'raw', mode, len(data) // size[1], 1)
+
+def _array_to_image(array: np.ndarray) -> Image.Image:
+    """numpy-кадр (H, W) или (H, W, 3) в PIL Image; 8-битный плотный массив — без копирования"""
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.ndim == 2:
+        mode = 'L'
+    elif array.ndim == 3 and array.shape[2] == 3:
+        mode = 'RGB'
+    else:
+        raise ScannerError(f"Неподдерживаемая форма кадра: {array.shape}")
+    if array.dtype == np.uint16:
+        # 16-битные отсчёты (arr_snap) сводятся к 8 битам, как это делает _sane.snap
+        array = (array >> 8).astype(np.uint8)
+        _count_copy("16 бит в 8", array.nbytes)
+    elif array.dtype != np.uint8:
+        raise ScannerError(f"Неподдерживаемый тип пикселей: {array.dtype}")
+    elif not array.flags.c_contiguous:
+        _count_copy("несмежный массив", array.nbytes)
+        array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    return _buffer_to_image(array, mode, (width, height))
+
+def _snap_to_image(device, no_cancel: bool = False) -> Image.Image:
+    """
+    Чтение кадра после start() без лишних копий.
+    
+    SaneDev.snap оборачивает bytearray из _sane.snap в bytes(data) — это
+    вторая копия всего кадра. Здесь тот же bytearray отдаётся в
+    Image.frombuffer напрямую, и в памяти остаётся один буфер.
+    """
+    dev = getattr(device, 'dev', None)
+    if dev is None or not hasattr(dev, 'snap'):
+        return _scan_data_to_image(device.snap(no_cancel))
+    data, width, height, samples, _ = dev.snap(no_cancel, False, None)
+    if not data:
+        raise ScannerError("Не удалось получить данные сканирования")
+    mode = 'RGB' if samples == 3 else 'L'
+    return _buffer_to_image(data, mode, (width, height))
+
+def _scan_to_image(device) -> Image.Image:
+    """Сканирование одного кадра: start() и чтение без копий через _snap_to_image"""
+    device.start()
+    return _snap_to_image(device)
+
+def _scan_data_to_image(scan_data) -> Image.Image:
+    """Приведение данных, полученных от SANE, к PIL Image"""
+    if scan_data is None:
+        raise ScannerError("Не удалось получить данные сканирования")
+    
+    logger.debug(f"Тип данных сканирования: {type(scan_data)}")
+    
+    # Обработка разных типов данных от SANE
+    if isinstance(scan_data, Image.Image):
+        return scan_data
+    if hasattr(scan_data, 'save'):
+        # Если это PIL-подобный объект
+        logger.info("Получен PIL-подобный объект")
+        return scan_data
+    if isinstance(scan_data, np.ndarray):
+        return _array_to_image(scan_data)
+    try:
+        # Последний вариант — произвольная последовательность пикселей
+        scan_array = np.asarray(scan_data)
+        _count_copy(type(scan_data).__name__, scan_array.nbytes)
+        return _array_to_image(scan_array)
+    except ScannerError:
+        raise
+    except Exception as conv_error:
+        logger.error(f"Ошибка конвертации данных: {conv_error}")
+        raise ScannerError(f"Неподдерживаемый тип данных сканирования: {type(scan_data)}")
+
+# --- Потоковое чтение через sane_start/sane_read ---
+
+# Форматы, которые кодируются по полосам; JPEG в Pillow требует кадр целиком
+STREAMING_FORMATS = ('PNG', 'PDF')
+
+_SANE_STATUS_GOOD = 0
+_SANE_STATUS_EOF = 5
+_SANE_FRAME_GRAY = 0
+_SANE_FRAME_RGB = 1
+_SANE_UNIT_PIXEL = 1
+
+class _SaneParameters(ctypes.Structure):
+    _fields_ = [
+        ("format", ctypes.c_int),
+        ("last_frame", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("pixels_per_line", ctypes.c_int),
+        ("lines", ctypes.c_int),
+        ("depth", ctypes.c_int),
+    ]
+
+_libsane = None
+
+def _get_libsane():
+    """libsane, уже загруженная модулем _sane (dlopen вернёт ту же копию)"""
+    global _libsane
+    if _libsane is None:
+        lib = ctypes.CDLL(ctypes.util.find_library('sane') or 'libsane.so.1')
+        lib.sane_start.argtypes = [ctypes.c_void_p]
+        lib.sane_start.restype = ctypes.c_int
+        lib.sane_get_parameters.argtypes = [ctypes.c_void_p, ctypes.POINTER(_SaneParameters)]
+        lib.sane_get_parameters.restype = ctypes.c_int
+        lib.sane_read.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+        lib.sane_read.restype = ctypes.c_int
+        lib.sane_strstatus.argtypes = [ctypes.c_int]
+        lib.sane_strstatus.restype = ctypes.c_char_p
+        _libsane = lib
+    return _libsane
+
+# Версии python-sane, в которых SaneDevObject — это PyObject_HEAD и SANE_Handle
+_SANE_HANDLE_LAYOUT_VERSIONS = ('2.9.1',)
+
+def _sane_handle_offset(dev) -> int:
+    """
+    Смещение SANE_Handle в объекте _sane.SaneDev.
+    
+    Публичного способа получить дескриптор нет, а ошибка в смещении — это
+    падение процесса, которое не перехватить. Поэтому смещение используется,
+    только если совпадает всё: проверенная версия python-sane, CPython, тип
+    из _sane (tp_name "SaneDev" без модуля), размер объекта ровно
+    PyObject_HEAD плюс указатель и ненулевой выровненный указатель по этому
+    смещению. Иначе ScannerError, и кадр читается целиком через snap().
+    """
+    try:
+        version = importlib.metadata.version('python-sane')
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    if version not in _SANE_HANDLE_LAYOUT_VERSIONS:
+        raise ScannerError(f"Раскладка SaneDev не проверена для python-sane {version}")
+    dev_type = type(dev)
+    pointer = ctypes.sizeof(ctypes.c_void_p)
+    if (sys.implementation.name != 'cpython'
+            or (dev_type.__module__, dev_type.__name__) != ('builtins', 'SaneDev')
+            or dev_type.__basicsize__ != object.__basicsize__ + pointer
+            or dev_type.__itemsize__ != 0):
+        raise ScannerError("Неожиданная раскладка объекта SaneDev")
+    handle = ctypes.c_void_p.from_address(id(dev) + object.__basicsize__).value
+    if not handle or handle % pointer:
+        raise ScannerError("По смещению SaneDev нет дескриптора SANE")
+    return object.__basicsize__
+
+class SaneStreamReader:
+    """
+    Построчное чтение кадра через sane_start/sane_read.
+    
+    python-sane отдаёт кадр только целиком (snap), поэтому SANE_Handle
+    берётся из объекта _sane.SaneDev: в SaneDevObject он лежит сразу
+    после PyObject_HEAD (см. _sane_handle_offset). Перед использованием
+    дескриптор сверяется с get_parameters() самого python-sane.
+    """
+    def __init__(self, device):
+        self.device = device
+        dev = device.dev
+        offset = _sane_handle_offset(dev)
+        self.lib = _get_libsane()
+        self.handle = ctypes.c_void_p.from_address(id(dev) + offset).value
+        self._verify()
+    
+    def _check(self, status: int, what: str):
+        if status != _SANE_STATUS_GOOD:
+            message = self.lib.sane_strstatus(status).decode(errors='replace')
+            raise ScannerError(f"{what}: {message}")
+    
+    def _verify(self):
+        if not self.handle:
+            raise ScannerError("Устройство SANE закрыто")
+        params = self.parameters()
+        _, _, (pixels, lines), depth, bytes_per_line = self.device.get_parameters()
+        if (params.pixels_per_line, params.lines, params.depth, params.bytes_per_line) != (pixels, lines, depth, bytes_per_line):
+            raise ScannerError("Дескриптор SANE не совпадает с python-sane")
+    
+    def parameters(self) -> _SaneParameters:
+        params = _SaneParameters()
+        self._check(self.lib.sane_get_parameters(self.handle, ctypes.byref(params)), "sane_get_parameters")
+        return params
+    
+    def start(self) -> _SaneParameters:
+        self._check(self.lib.sane_start(self.handle), "sane_start")
+        return self.parameters()
+    
+    def read_strips(self, bytes_per_line: int, lines_per_strip: int) -> Iterator[bytes]:
+        """Чтение кадра полосами по lines_per_strip строк (последняя полоса может быть короче)"""
+        strip_size = bytes_per_line * lines_per_strip
+        buf = (ctypes.c_ubyte * strip_size)()
+        length = ctypes.c_int()
+        pending = bytearray()
+        while True:
+            status = self.lib.sane_read(self.handle, buf, strip_size, ctypes.byref(length))
+            if status == _SANE_STATUS_EOF:
+                break
+            self._check(status, "sane_read")
+            pending += ctypes.string_at(buf, length.value)
+            while len(pending) >= strip_size:
+                yield bytes(pending[:strip_size])
+                del pending[:strip_size]
+        tail = len(pending) - len(pending) % bytes_per_line
+        if tail:
+            yield bytes(pending[:tail])
+
+def _is_streamable(params: _SaneParameters, started: bool = True) -> bool:
+    """
+    Кадр можно кодировать на лету: один кадр Gray/RGB, 8 бит или 1 бит Gray, известная высота.
+    
+    До sane_start высота может быть ещё неизвестна (автоподатчик), поэтому
+    при started=False проверяются только формат и глубина.
+    """
+    if not params.last_frame or (started and params.lines <= 0):
+        return False
+    if params.format == _SANE_FRAME_RGB:
+        return params.depth == 8
+    if params.format == _SANE_FRAME_GRAY:
+        return params.depth in (1, 8)
+    return False
+
+def _raw_mode(params: _SaneParameters) -> Tuple[str, str]:
+    """Режим PIL и raw-режим декодера для строк SANE (1 бит в SANE — это чёрный)"""
+    if params.depth == 1:
+        return '1', '1;I'
+    if params.format == _SANE_FRAME_RGB:
+        return 'RGB', 'RGB'
+    return 'L', 'L'
+
+class PngStripEncoder:
+    """PNG, собираемый из полос строк: фильтр Up через NumPy и потоковый zlib"""
+    def __init__(self, fileobj, width: int, height: int, params: _SaneParameters):
+        self.file = fileobj
+        self.invert = params.depth == 1
+        if params.depth == 1:
+            bit_depth, color_type, self.row_bytes = 1, 0, (width + 7) // 8
+        elif params.format == _SANE_FRAME_RGB:
+            bit_depth, color_type, self.row_bytes = 8, 2, width * 3
+        else:
+            bit_depth, color_type, self.row_bytes = 8, 0, width
+        self.bytes_per_line = params.bytes_per_line
+        self.prev = np.zeros(self.row_bytes, dtype=np.uint8)
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+    
+    def _chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    
+    def write(self, strip: bytes):
+        rows = np.frombuffer(strip, dtype=np.uint8).reshape(-1, self.bytes_per_line)[:, :self.row_bytes]
+        if self.invert:
+            rows = ~rows
+        filtered = np.empty((rows.shape[0], self.row_bytes + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # фильтр Up
+        filtered[0, 1:] = rows[0] - self.prev
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self.prev = rows[-1].copy()
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+    
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+
+class PdfStripEncoder:
+    """Одна страница PDF из горизонтальных полос: JPEG для Gray/RGB, Flate для 1 бита"""
+    def __init__(self, writer: PdfWriter, width: int, height: int, params: _SaneParameters,
+                 dpi: int, quality: int = 85):
+        self.writer = writer
+        self.width = width
+        self.height = height
+        self.params = params
+        self.scale = 72.0 / (dpi or 72)
+        self.quality = quality
+        self.mode, self.raw_mode = _raw_mode(params)
+        self.row_bytes = (width + 7) // 8 if params.depth == 1 else width * (3 if self.mode == 'RGB' else 1)
+        self.y = 0
+        self.writer.begin_page(width * self.scale, height * self.scale)
+    
+    def write(self, strip: bytes):
+        lines = len(strip) // self.params.bytes_per_line
+        if self.params.depth == 1:
+            rows = np.frombuffer(strip, dtype=np.uint8).reshape(lines, -1)[:, :self.row_bytes]
+            obj = self.writer.add_image(
+                zlib.compress(rows.tobytes()), self.width, lines, '/DeviceGray', 1,
+                '/FlateDecode', decode='[1 0]'
+            )
+        else:
+            image = Image.frombuffer(self.mode, (self.width, lines), strip, 'raw',
+                                     self.raw_mode, self.params.bytes_per_line, 1)
+            buf = io.BytesIO()
+            image.save(buf, 'JPEG', quality=self.quality)
+            colorspace = '/DeviceRGB' if self.mode == 'RGB' else '/DeviceGray'
+            obj = self.writer.add_image(buf.getvalue(), self.width, lines, colorspace)
+        top = self.height - self.y - lines
+        self.writer.draw_image(obj, 0, top * self.scale, self.width * self.scale, lines * self.scale)
+        self.y += lines
+    
+    def close(self):
+        self.writer.end_page()
+
+# Постоянный поток кодирования: полосы кодируются, пока сканер читает следующие
+_encoder_executor = None
+
+def _get_encoder_executor() -> ThreadPoolExecutor:
+    global _encoder_executor
+    if _encoder_executor is None:
+        _encoder_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan-encoder")
+    return _encoder_executor
+
+def _stream_encode(strips: Iterator[bytes], encoder, max_pending: int):
+    """Передача полос кодировщику через ограниченную очередь с перекрытием чтения и кодирования"""
+    pending = queue.Queue(maxsize=max_pending)
+    done = object()
+    
+    def consume():
+        while True:
+            strip = pending.get()
+            if strip is done:
+                break
+            encoder.write(strip)
+        encoder.close()
+    
+    future = _get_encoder_executor().submit(consume)
+    try:
+        for strip in strips:
+            while True:
+                if future.done():
+                    # Кодировщик упал — прекращаем чтение и пробрасываем ошибку
+                    future.result()
+                    raise ScannerError("Кодировщик остановился раньше времени")
+                try:
+                    pending.put(strip, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    finally:
+        while not future.done():
+            try:
+                pending.put(done, timeout=1)
+                break
+            except queue.Full:
+                continue
+    future.result()
+
+def _is_feeder_empty(error: Exception) -> bool:
+    """Ошибка SANE_STATUS_NO_DOCS: в автоподатчике закончилась бумага"""
+    text = str(error).lower()
+    return 'out of documents' in text or 'no docs' in text or 'no documents' in text
+
+# Пресеты области сканирования: ключ -> (подпись, ширина и высота в мм)
+AREA_PRESETS = {
+    'a4': ("A4", 210.0, 297.0),
+    'a5': ("A5", 148.0, 210.0),
+    'receipt': ("Чек (8 x 20 см)", 80.0, 200.0),
+    'id_card': ("Удостоверение / карта", 86.0, 54.0),
+    'business_card': ("Визитка", 90.0, 50.0),
+}
+
+def _custom_area() -> Optional[Tuple[float, float]]:
+    """Размер из SCAN_CUSTOM_AREA_MM вида '100x150' или None"""
+    value = (config.SCAN_CUSTOM_AREA_MM or '').lower().replace('х', 'x').replace('*', 'x')
+    try:
+        width, height = (float(part) for part in value.split('x'))
+    except ValueError:
+        return None
+    return (width, height) if width > 0 and height > 0 else None
+
+def area_size_mm(area: str) -> Optional[Tuple[float, float]]:
+    """Ширина и высота пресета в мм; None — весь планшет"""
+    if area == 'custom':
+        return _custom_area()
+    preset = AREA_PRESETS.get(area)
+    return (preset[1], preset[2]) if preset else None
+
+def area_presets() -> List[Tuple[str, str]]:
+    """Включённые пресеты области [(ключ, подпись)] в порядке SCAN_AREA_PRESETS"""
+    result = []
+    for key in config.SCAN_AREA_PRESETS:
+        if key in AREA_PRESETS:
+            result.append((key, AREA_PRESETS[key][0]))
+    custom = _custom_area()
+    if custom:
+        result.append(('custom', f"Свой размер ({custom[0]:g} x {custom[1]:g} мм)"))
+    return result
+
+class ScannerOptionCache:
+    """
+    Дисковый кэш выбранного устройства SANE и ограничений его опций.
+    
+    sane.get_devices() с сетевым hpaio занимает несколько секунд, поэтому
+    после перезапуска устройство из кэша открывается напрямую, а полный
+    поиск выполняется только если такое открытие не удалось.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._data = None
+        self._mtime = None
+        self._lock = threading.Lock()
+    
+    def _load(self) -> dict:
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            mtime = None
+        if self._data is None or mtime != self._mtime:
+            data = {}
+            if mtime is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning("Кэш сканера %s повреждён, игнорирую: %s", self.path, e)
+            self._data = data if isinstance(data, dict) else {}
+            self._mtime = mtime
+        return self._data
+    
+    def _save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+            self._mtime = self.path.stat().st_mtime
+        except OSError as e:
+            logger.warning("Не удалось сохранить кэш сканера %s: %s", self.path, e)
+    
+    @property
+    def last_device(self) -> Optional[str]:
+        with self._lock:
+            return self._load().get("last_device")
+    
+    def get(self, device_name: Optional[str]) -> Optional[dict]:
+        """Запись кэша для устройства: {'optlist': [...], 'constraints': {имя: ограничение}}"""
+        if not device_name:
+            return None
+        with self._lock:
+            return self._load().get("devices", {}).get(device_name)
+    
+    def update(self, device_name: str, device):
+        """Сохранение optlist и ограничений опций только что открытого устройства"""
+        constraints = {}
+        for name, opt in (getattr(device, 'opt', None) or {}).items():
+            constraint = getattr(opt, 'constraint', None)
+            if isinstance(constraint, (list, tuple)):
+                constraints[name] = list(constraint)
+        entry = {
+            "optlist": list(getattr(device, 'optlist', None) or []),
+            "constraints": constraints,
+            "updated": datetime.now().isoformat(timespec='seconds'),
+        }
+        with self._lock:
+            data = self._load()
+            data["last_device"] = device_name
+            data.setdefault("devices", {})[device_name] = entry
+            self._save()
+    
+    def forget(self, device_name: str):
+        with self._lock:
+            data = self._load()
+            data.get("devices", {}).pop(device_name, None)
+            if data.get("last_device") == device_name:
+                data.pop("last_device", None)
+            self._save()
+
+class ScannerWorker:
+    """
+    Постоянный однопоточный исполнитель для всех вызовов SANE.
+    
+    Дескриптором устройства владеет один долгоживущий поток, поэтому
+    одновременные нажатия кнопок выстраиваются в очередь, а не вызывают
+    device.scan параллельно.
+    """
     def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._busy_since = None
+        self._busy_total = 0.0
+        self._operations = 0
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sane-worker")
+        return self._executor
+    
+    def _call(self, func, args, kwargs):
+        with self._lock:
+            self._busy_since = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._busy_total += time.monotonic() - self._busy_since
+                self._busy_since = None
+                self._pending -= 1
+                self._operations += 1
+    
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Поставить вызов в очередь потока сканера"""
+        with self._lock:
+            self._pending += 1
+        try:
+            return self._get_executor().submit(self._call, func, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнить вызов в потоке сканера и дождаться результата"""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+    
+    @property
+    def is_busy(self) -> bool:
+        return self._busy_since is not None
+    
+    def stats(self) -> dict:
+        """Глубина очереди и время занятости потока сканера"""
+        with self._lock:
+            current = time.monotonic() - self._busy_since if self._busy_since is not None else 0.0
+            busy = self._busy_since is not None
+            return {
+                "queue_depth": max(self._pending - (1 if busy else 0), 0),
+                "busy": busy,
+                "current_operation_seconds": round(current, 1),
+                "busy_seconds": round(self._busy_total + current, 1),
+                "operations": self._operations,
+            }
+    
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+def _export_scan_result(result: Union[str, Image.Image]) -> dict:
+    if isinstance(result, Image.Image):
+        return _export_image_to_shared_memory(result)
+    return {"path": result}
+
+# --- Пул процессов кодирования ---
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _page_pool_size() -> int:
+    if config.SCAN_ENCODE_PROCESSES > 0:
+        return config.SCAN_ENCODE_PROCESSES
+    # Одно ядро остаётся боту и чтению со сканера
+    return max((os.cpu_count() or 1) - 1, 1)
+
+def _get_page_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Общий пул процессов для кодирования страниц (создаётся при первом обращении).
+    
+    Кодирование и обработка кадра упираются в CPU и GIL, поэтому уходят в
+    отдельные процессы; пиксели передаются через shared memory. В дочернем
+    процессе SANE (daemon) свои процессы создавать нельзя — там None.
+    """
+    global _page_pool
+    if multiprocessing.current_process().daemon or config.SCAN_ENCODE_PROCESSES < 0:
+        return None
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(
+                max_workers=_page_pool_size(), mp_context=multiprocessing.get_context('spawn')
+            )
+            logger.info("Запущен пул кодирования: %s процессов", _page_pool_size())
+        return _page_pool
+
+def _reset_page_pool(wait: bool = False):
+    """Остановка пула (при завершении или если пул сломался)"""
+    global _page_pool
+    with _page_pool_lock:
+        pool, _page_pool = _page_pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+def _submit_page(func, image: Image.Image, *args) -> Future:
+    """
+    Отправка кадра в пул процессов; без пула — в поток кодировщика.
+    
+    В пул кадр уходит через shared memory. Сегмент удаляет задача после
+    чтения, а если она до него не дошла (пул сломался, задача отменена) —
+    обработчик завершения future. В поток кодировщика кадр передаётся как есть.
+    """
+    pool = _get_page_pool()
+    if pool is not None:
+        meta = _export_image_to_shared_memory(image)
+        try:
+            future = pool.submit(_run_shared_task, func, meta, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            _unlink_shared_memory(meta["shm"])
+            logger.warning("Пул кодирования недоступен (%s), кодирую в потоке", e)
+            _reset_page_pool()
+        else:
+            future.add_done_callback(lambda f, name=meta["shm"]: _unlink_shared_memory(name))
+            return future
+    return _get_encoder_executor().submit(func, image, *args)
+
+async def _process_page(func, image: Image.Image, *args):
+    """
+    Обработка одиночного кадра через _submit_page с ожиданием из цикла событий.
+    
+    Если пул сломался уже во время задачи, кадр обрабатывается ещё раз в потоке кодировщика.
+    """
+    try:
+        return await asyncio.wrap_future(_submit_page(func, image, *args))
+    except BrokenProcessPool as e:
+        logger.warning("Пул кодирования сломался (%s), обрабатываю кадр в потоке", e)
+        _reset_page_pool()
+        return await asyncio.wrap_future(_get_encoder_executor().submit(func, image, *args))
+
+def _sane_process_main(conn):
+    """
+    Точка входа дочернего процесса, владеющего устройством SANE.
+    
+    Протокол: запрос (id, op, args) -> ответ (id, ok, payload); до ответа
+    могут прийти промежуточные события (id, None, payload), например номер
+    готовой страницы пакетного сканирования. Операции выполняются в потоке
+    сканера дочернего процесса, а 'cancel' обрабатывается сразу, чтобы
+    прервать идущее чтение.
+    """
+    local = HPScanner(isolation='thread')
+    send_lock = threading.Lock()
+    ops = {
+        'initialize': local._initialize_sync,
+        'get_scan_sources': local._get_scan_sources_sync,
+        'scan': lambda source=None, area=None: _export_image_to_shared_memory(local._scan_sync(source, area)),
+        'scan_preview': lambda source=None, area=None: _export_image_to_shared_memory(
+            local._scan_preview_sync(source, area)
+        ),
+        'scan_to_file': lambda source, filepath, fmt, area=None: _export_scan_result(
+            local._scan_to_file_sync(source, filepath, fmt, area)
+        ),
+        'scan_batch': local._scan_batch_sync,
+        'cleanup': local._cleanup_sync,
+        'ping': os.getpid,
+    }
+    
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (BrokenPipeError, OSError):
+                pass
+    
+    def reply(request_id, future):
+        try:
+            send((request_id, True, future.result()))
+        except Exception as e:
+            send((request_id, False, str(e)))
+    
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        request_id, op, args = request
+        if op == 'cancel':
+            try:
+                if local.device:
+                    local.device.cancel()
+            except Exception as e:
+                logger.warning("Ошибка отмены сканирования в процессе SANE: %s", e)
+            continue
+        func = ops.get(op)
+        if func is None:
+            send((request_id, False, f"Неизвестная операция: {op}"))
+            continue
+        if op == 'scan_batch':
+            args = tuple(args) + (lambda event, rid=request_id: send((rid, None, event)),)
+        future = local.worker.submit(func, *args)
+        future.add_done_callback(lambda f, rid=request_id: reply(rid, f))
+    
+    try:
+        local.worker.submit(local._cleanup_sync).result(timeout=10)
+    except Exception:
+        pass
+    local.worker.shutdown(wait=False)
+
+class SaneProcessClient:
+    """
+    Клиент дочернего процесса SANE с таймаутами и автоматическим перезапуском.
+    
+    Зависание бэкенда hpaio больше не блокирует бота: по истечении таймаута
+    процесс убивается, а следующая операция поднимает его заново и повторно
+    открывает устройство.
+    """
+    def __init__(self, op_timeout: float = None, scan_timeout: float = None):
+        self.op_timeout = op_timeout or config.SCANNER_OP_TIMEOUT
+        self.scan_timeout = scan_timeout or config.SCANNER_SCAN_TIMEOUT
+        self._ctx = multiprocessing.get_context('spawn')
+        self._process = None
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._next_id = 0
+        self._opened = False
+        self.device_name = None
+        self.restarts = 0
+    
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+    
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+    
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(
+            target=_sane_process_main, args=(child_conn,), name="sane-backend", daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self._opened = False
+        logger.info("Запущен процесс SANE (pid %s)", self._process.pid)
+    
+    def _kill(self):
+        """Принудительная остановка процесса SANE"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(2)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join(2)
+            logger.warning("Процесс SANE (pid %s) остановлен", self._process.pid)
+            # Кадры, созданные процессом, но не переданные родителю, удаляются здесь
+            _unlink_process_segments(self._process.pid)
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+        self._opened = False
+    
+    def _ensure_started(self):
+        """Сторож: поднять процесс и открыть устройство, если процесс умер или ещё не запущен"""
+        if self._process is not None and not self._process.is_alive():
+            logger.warning("Процесс SANE завершился (код %s), перезапускаю", self._process.exitcode)
+            self.restarts += 1
+            self._kill()
+        if self._process is None:
+            self._start()
+        if not self._opened:
+            self.device_name = self._request('initialize', timeout=self.op_timeout)
+            self._opened = True
+    
+    def _request(self, op: str, *args, timeout: float, on_event=None):
+        """Запрос к процессу SANE; таймаут отсчитывается заново после каждого промежуточного события"""
+        self._next_id += 1
+        request_id = self._next_id
+        try:
+            with self._send_lock:
+                self._conn.send((request_id, op, args))
+            while True:
+                if not self._conn.poll(timeout):
+                    self._kill()
+                    self.restarts += 1
+                    raise ScannerError(f"Сканер не ответил за {timeout:.0f} с (операция {op}), процесс SANE перезапущен")
+                reply_id, ok, payload = self._conn.recv()
+                if reply_id != request_id:
+                    # Опоздавший ответ на прерванный запрос: его кадр никто не заберёт
+                    logger.warning("Отброшен ответ процесса SANE на запрос %s (ожидался %s)", reply_id, request_id)
+                    if ok and isinstance(payload, dict) and "shm" in payload:
+                        _unlink_shared_memory(payload["shm"])
+                    continue
+                if ok is not None:
+                    break
+                if on_event:
+                    on_event(payload)
+        except (EOFError, BrokenPipeError, OSError) as e:
+            self._kill()
+            self.restarts += 1
+            raise ScannerError(f"Процесс SANE неожиданно завершился: {e}")
+        if not ok:
+            raise ScannerError(payload)
+        return payload
+    
+    def _call(self, op: str, *args, on_event=None):
+        self._ensure_started()
+        timeout = self.scan_timeout if op.startswith('scan') else self.op_timeout
+        return self._request(op, *args, timeout=timeout, on_event=on_event)
+    
+    def initialize(self) -> str:
+        self._ensure_started()
+        return self.device_name
+    
+    def get_scan_sources(self) -> List[Tuple[str, str]]:
+        return [tuple(item) for item in self._call('get_scan_sources')]
+    
+    def scan(self, source: Optional[str] = None, area: Optional[str] = None) -> Image.Image:
+        return _import_image_from_shared_memory(self._call('scan', source, area))
+    
+    def scan_preview(self, source: Optional[str] = None, area: Optional[str] = None) -> Image.Image:
+        return _import_image_from_shared_memory(self._call('scan_preview', source, area))
+    
+    def scan_batch(self, source: Optional[str], filepath: str, on_page=None) -> int:
+        return self._call('scan_batch', source, filepath, on_event=on_page)
+    
+    def scan_to_file(self, source: Optional[str], filepath: str, fmt: str,
+                     area: Optional[str] = None) -> Union[str, Image.Image]:
+        result = self._call('scan_to_file', source, filepath, fmt, area)
+        if "path" in result:
+            return result["path"]
+        return _import_image_from_shared_memory(result)
+    
+    def cancel(self):
+        """Отмена сканирования; можно вызывать из любого потока, ответа не ждёт"""
+        if not self.is_alive():
+            return
+        with self._send_lock:
+            self._conn.send((None, 'cancel', ()))
+    
+    def cleanup(self):
+        if self._process is None:
+            return
+        try:
+            if self.is_alive():
+                with self._send_lock:
+                    self._conn.send(None)
+                self._process.join(10)
+        except Exception as e:
+            logger.warning("Ошибка остановки процесса SANE: %s", e)
+        if self.is_alive():
+            self._kill()
+        self._process = None
+        self._conn = None
+        self._opened = False
+
+class HPScanner:
+    def __init__(self, isolation: Optional[str] = None):
         self.device = None
+        self.device_name = None
         self.is_initialized = False
+        # Установленная область: (пресет, разрешение); None — геометрия устройства по умолчанию
+        self._area_key = None
+        self.worker = ScannerWorker()
+        self.option_cache = ScannerOptionCache(config.SCANNER_CACHE_FILE)
+        # В режиме 'process' устройством владеет дочерний процесс, а поток
+        # сканера только обменивается с ним сообщениями
+        isolation = (isolation or config.SCANNER_ISOLATION).lower()
+        self.process = SaneProcessClient() if isolation == 'process' else None
         
     async def initialize(self):
         """Инициализация сканера"""
+        try:
+            if self.process:
+                await self.worker.run(self.process.initialize)
+                self.is_initialized = True
+            else:
+                await self.worker.run(self._initialize_sync)
+        except ScannerError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка инициализации сканера: {e}")
+            raise ScannerError(f"Не удалось инициализировать сканер: {e}")
+    
+    def _initialize_sync(self):
+        """Инициализация SANE и открытие устройства (выполняется в потоке сканера)"""
+        if self.is_initialized:
+            # Повторный вызов из очереди, пока шла первая инициализация
+            return self.device_name
         try:
             # Инициализация SANE
             sane.init()
             logger.info("SANE инициализирован")
             
-            # Получение списка устройств
-            devices = sane.get_devices()
-            logger.info(f"Найдены устройства: {devices}")
-            
-            # Поиск HP принтера
-            hp_device = None
-            for device in devices:
-                device_name = device[0]
-                if 'hp' in device_name.lower() and 'm177' in device_name.lower():
-                    hp_device = device_name
-                    break
-                elif config.SCANNER_DEVICE and device_name == config.SCANNER_DEVICE:
-                    hp_device = device_name
-                    break
-            
-            if not hp_device and devices:
-                # Берем первое доступное устройство
-                hp_device = devices[0][0]
-                logger.warning(f"HP M177fw не найден, используем: {hp_device}")
-            
-            if not hp_device:
-                raise ScannerError("Сканер не найден")
+            # Сначала пробуем открыть устройство из конфигурации или кэша без поиска
+            self.device = None
+            cached_device = config.SCANNER_DEVICE or self.option_cache.last_device
+            if cached_device:
+                try:
+                    self.device = sane.open(cached_device)
+                    hp_device = cached_device
+                    logger.info(f"Сканер открыт без поиска устройств: {hp_device}")
+                except Exception as open_error:
+                    logger.warning(f"Не удалось открыть {cached_device} напрямую ({open_error}), выполняю поиск")
+                    if cached_device != config.SCANNER_DEVICE:
+                        self.option_cache.forget(cached_device)
             
-            # Открытие устройства
-            self.device = sane.open(hp_device)
-            logger.info(f"Сканер открыт: {hp_device}")
+            if self.device is None:
+                hp_device = self._discover_device_sync()
+                # Открытие устройства
+                self.device = sane.open(hp_device)
+                logger.info(f"Сканер открыт: {hp_device}")
+            self.device_name = hp_device
             
             # Настройка параметров сканирования
-            await self._configure_scanner()
+            self._configure_scanner()
+            self.option_cache.update(hp_device, self.device)
             
             self.is_initialized = True
             logger.info("Сканер успешно инициализирован")
+            return self.device_name
             
         except Exception as e:
             logger.error(f"Ошибка инициализации сканера: {e}")
             raise ScannerError(f"Не удалось инициализировать сканер: {e}")
     
-    async def _configure_scanner(self):
-        """Настройка параметров сканера"""
+    def _discover_device_sync(self) -> str:
+        """Полный поиск устройств SANE (медленно для сетевого hpaio)"""
+        # Получение списка устройств
+        devices = sane.get_devices()
+        logger.info(f"Найдены устройства: {devices}")
+        
+        # Поиск HP принтера
+        hp_device = None
+        for device in devices:
+            device_name = device[0]
+            if 'hp' in device_name.lower() and 'm177' in device_name.lower():
+                hp_device = device_name
+                break
+            elif config.SCANNER_DEVICE and device_name == config.SCANNER_DEVICE:
+                hp_device = device_name
+                break
+        
+        if not hp_device and devices:
+            # Берем первое доступное устройство
+            hp_device = devices[0][0]
+            logger.warning(f"HP M177fw не найден, используем: {hp_device}")
+        
+        if not hp_device:
+            raise ScannerError("Сканер не найден")
+        return hp_device
+    
+    def _configure_scanner(self):
+        """Настройка параметров сканера (выполняется в потоке сканера)"""
+        self._area_key = None
         try:
             # Установка разрешения
             if hasattr(self.device, 'resolution'):
@@ -111,120 +1047,378 @@ class HPScanner:
             return "Автоподача (фидер)"
         return sane_value
 
+    def _sources_from_options(self, optlist: List[str], constraints: dict) -> List[Tuple[str, str]]:
+        """Источники сканирования по optlist и ограничениям опций"""
+        source_opt_name = None
+        for name in ('source', 'scan-source', 'source-name'):
+            if name in optlist:
+                source_opt_name = name
+                break
+        if not source_opt_name:
+            logger.debug("Опция выбора источника не найдена в optlist: %s", optlist)
+            return []
+        constraint = constraints.get(source_opt_name)
+        if not constraint or not isinstance(constraint, (list, tuple)):
+            return []
+        result = []
+        for val in constraint:
+            if isinstance(val, str) and val.strip():
+                label = self._source_display_label(val)
+                result.append((val, label))
+        return result
+    
     def _get_scan_sources_sync(self) -> List[Tuple[str, str]]:
-        """Синхронное получение списка источников сканирования из SANE (вызывать из executor)."""
+        """Синхронное получение списка источников сканирования из SANE (выполняется в потоке сканера)."""
         if not self.device:
             return []
         try:
             optlist = getattr(self.device, 'optlist', None) or []
-            source_opt_name = None
-            for name in ('source', 'scan-source', 'source-name'):
-                if name in optlist:
-                    source_opt_name = name
-                    break
-            if not source_opt_name:
-                logger.debug("Опция выбора источника не найдена в optlist: %s", optlist)
-                return []
-            opt = self.device.opt.get(source_opt_name)
-            if opt is None:
-                return []
-            constraint = getattr(opt, 'constraint', None)
-            if not constraint or not isinstance(constraint, (list, tuple)):
-                return []
-            result = []
-            for val in constraint:
-                if isinstance(val, str) and val.strip():
-                    label = self._source_display_label(val)
-                    result.append((val, label))
-            return result
+            constraints = {
+                name: getattr(opt, 'constraint', None)
+                for name, opt in (getattr(self.device, 'opt', None) or {}).items()
+            }
+            return self._sources_from_options(optlist, constraints)
         except Exception as e:
             logger.warning("Не удалось получить источники сканирования: %s", e)
             return []
+    
+    def _cached_options(self) -> Optional[dict]:
+        """Опции текущего (или последнего известного) устройства из дискового кэша"""
+        device_name = self.device_name or (self.process.device_name if self.process else None)
+        return self.option_cache.get(device_name or config.SCANNER_DEVICE or self.option_cache.last_device)
 
     async def get_scan_sources(self) -> List[Tuple[str, str]]:
         """Список доступных источников сканирования: [(sane_value, display_label), ...]."""
+        # Из кэша список доступен сразу: без инициализации и без ожидания идущего сканирования
+        cached = self._cached_options()
+        if cached:
+            sources = self._sources_from_options(cached.get("optlist", []), cached.get("constraints", {}))
+            if sources:
+                return sources
         if not self.is_initialized:
             await self.initialize()
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            return await loop.run_in_executor(executor, self._get_scan_sources_sync)
+        if self.process:
+            return await self.worker.run(self.process.get_scan_sources)
+        return await self.worker.run(self._get_scan_sources_sync)
     
-    async def scan_document(self, source: Optional[str] = None) -> Optional[Path]:
-        """Сканирование документа. source — значение SANE для выбора источника (планшет/фидер)."""
-        if not self.is_initialized:
-            await self.initialize()
+    def _set_source_sync(self, source: str):
+        """Переключение источника сканирования (выполняется в потоке сканера)"""
+        try:
+            optlist = getattr(self.device, 'optlist', None) or []
+            for name in ('source', 'scan-source', 'source-name'):
+                if name not in optlist:
+                    continue
+                attr = name.replace('-', '_')
+                if hasattr(self.device, attr):
+                    setattr(self.device, attr, source)
+                    logger.info("Установлен источник сканирования: %s", source)
+                    break
+        except Exception as e:
+            logger.warning("Не удалось установить источник сканирования %s: %s", source, e)
+    
+    def _set_area_sync(self, area: Optional[str]):
+        """
+        Установка области сканирования по пресету (выполняется в потоке сканера).
+        
+        Границы берутся из ограничений опций tl_x/tl_y/br_x/br_y устройства;
+        каретка проходит только нужную длину, поэтому малые области быстрее.
+        None — весь планшет; пока пресеты не выбирались, геометрия устройства не трогается.
+        Если геометрия задаётся в пикселях, она зависит от разрешения, поэтому
+        при его смене область пересчитывается.
+        """
+        key = (area, getattr(self.device, 'resolution', None))
+        if key == self._area_key or (area is None and self._area_key is None):
+            return
+        size = area_size_mm(area) if area else None
+        try:
+            options = getattr(self.device, 'opt', None) or {}
+            ranges = {}
+            for name in ('tl_x', 'tl_y', 'br_x', 'br_y'):
+                opt = options.get(name)
+                constraint = getattr(opt, 'constraint', None)
+                if not isinstance(constraint, tuple) or len(constraint) < 2:
+                    logger.warning("Устройство не сообщает границы %s, область не изменена", name)
+                    return
+                scale = 1.0
+                if getattr(opt, 'unit', None) == _SANE_UNIT_PIXEL:
+                    # Геометрия в пикселях: переводим миллиметры по текущему разрешению
+                    scale = (getattr(self.device, 'resolution', None) or config.SCAN_DPI) / 25.4
+                ranges[name] = (constraint[0], constraint[1], scale)
+            
+            x_min, x_max, x_scale = ranges['br_x']
+            y_min, y_max, y_scale = ranges['br_y']
+            left, top = ranges['tl_x'][0], ranges['tl_y'][0]
+            self.device.tl_x = left
+            self.device.tl_y = top
+            if size:
+                self.device.br_x = min(left + size[0] * x_scale, x_max)
+                self.device.br_y = min(top + size[1] * y_scale, y_max)
+            else:
+                self.device.br_x = x_max
+                self.device.br_y = y_max
+            self._area_key = key
+            logger.info("Установлена область сканирования: %s", area or "весь планшет")
+        except Exception as e:
+            logger.warning("Не удалось установить область сканирования %s: %s", area, e)
+    
+    def _select_sync(self, source: Optional[str], area: Optional[str]):
+        if source:
+            self._set_source_sync(source)
+        self._set_area_sync(area)
+    
+    def _scan_sync(self, source: Optional[str] = None, area: Optional[str] = None) -> Image.Image:
+        """Выбор источника, области и сканирование одной задачей, чтобы чужой запрос не вклинился между ними"""
+        self._select_sync(source, area)
+        logger.info("Начало сканирования...")
+        return _scan_to_image(self.device)
+    
+    def _scan_preview_sync(self, source: Optional[str] = None, area: Optional[str] = None) -> Image.Image:
+        """Быстрый предпросмотр в SCAN_PREVIEW_DPI; рабочее разрешение восстанавливается сразу после"""
+        if not hasattr(self.device, 'resolution'):
+            self._select_sync(source, area)
+            return _scan_to_image(self.device)
+        if source:
+            self._set_source_sync(source)
+        logger.info(f"Предпросмотр в {config.SCAN_PREVIEW_DPI} DPI...")
+        self.device.resolution = config.SCAN_PREVIEW_DPI
+        try:
+            # Область задаётся уже при разрешении предпросмотра
+            self._set_area_sync(area)
+            return _scan_to_image(self.device)
+        finally:
+            self.device.resolution = config.SCAN_DPI
+    
+    def _scan_to_file_sync(self, source: Optional[str], filepath: str, fmt: str,
+                           area: Optional[str] = None) -> Union[str, Image.Image]:
+        """
+        Потоковое сканирование: полосы строк идут из sane_read прямо в кодировщик.
         
+        Возвращает путь к записанному файлу или, если кадр не подходит для
+        потоковой записи, PIL Image для обычного пути сохранения.
+        """
+        self._select_sync(source, area)
         try:
-            if source:
+            reader = SaneStreamReader(self.device)
+        except Exception as e:
+            logger.warning("Потоковое чтение недоступно (%s), сканирую кадр целиком", e)
+            return _scan_to_image(self.device)
+        
+        # Параметры до sane_start — оценка бэкенда; 16 бит и покадровый RGB сразу идут обычным путём
+        params = reader.parameters()
+        if not _is_streamable(params, started=False):
+            logger.info("Кадр не подходит для потоковой записи (формат %s, %s бит), сканирую кадр целиком",
+                        params.format, params.depth)
+            return _scan_to_image(self.device)
+        
+        logger.info("Начало потокового сканирования...")
+        params = reader.start()
+        if not _is_streamable(params):
+            logger.info("После запуска кадр не подходит для потоковой записи (формат %s, %s бит), "
+                        "сканирую кадр целиком", params.format, params.depth)
+            self.device.cancel()
+            return _scan_to_image(self.device)
+        # Файл пишется под временным именем: оборванное чтение или сбой кодировщика не оставят в SCAN_DIR обрезок
+        partial = Path(f"{filepath}.part")
+        try:
+            strips = reader.read_strips(params.bytes_per_line, config.SCAN_STREAM_STRIP_LINES)
+            width, height = params.pixels_per_line, params.lines
+            with open(partial, 'wb') as f:
+                if fmt == 'PDF':
+                    writer = PdfWriter(f)
+                    _stream_encode(strips, PdfStripEncoder(writer, width, height, params, config.SCAN_DPI,
+                                                           config.SCAN_JPEG_QUALITY),
+                                   config.SCAN_STREAM_QUEUE)
+                    writer.close()
+                else:
+                    _stream_encode(strips, PngStripEncoder(f, width, height, params), config.SCAN_STREAM_QUEUE)
+            os.replace(partial, filepath)
+            logger.info("Потоковое сканирование завершено: %sx%s, %s", width, height, filepath)
+            return filepath
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        finally:
+            self.device.cancel()
+    
+    def _snap_feeder_page_sync(self) -> Optional[Image.Image]:
+        """Следующая страница из автоподатчика или None, если бумага закончилась"""
+        try:
+            self.device.start()
+        except Exception as e:
+            if _is_feeder_empty(e):
+                return None
+            raise
+        return _snap_to_image(self.device, no_cancel=True)
+    
+    def _scan_batch_sync(self, source: Optional[str], filepath: str, on_page=None) -> int:
+        """
+        Пакетное сканирование из автоподатчика в один PDF.
+        
+        Конвейер: сканер тянет следующую страницу, пока пул процессов
+        обрабатывает и кодирует предыдущие, а готовые страницы по порядку
+        дописываются в PDF. Страниц в работе не больше SCAN_BATCH_MAX_PENDING —
+        при заполнении сканер ждёт кодировщик и не выбирает всю память.
+        Пустые страницы (SCAN_SKIP_BLANK) отбрасываются до кодирования.
+        """
+        self._select_sync(source, None)
+        max_pending = max(config.SCAN_BATCH_MAX_PENDING, 1)
+        max_bytes = config.MAX_FILE_SIZE_MB * 1024 * 1024
+        pending = deque()
+        pages = 0
+        skipped = 0
+        
+        def write_page(page: dict):
+            _write_pdf_page(writer, page, config.SCAN_DPI)
+            # PDF больше лимита Telegram не отправить — прерываем подачу сразу, а не после всего фидера
+            if f.tell() > max_bytes:
+                raise ScannerError(
+                    f"PDF превысил {config.MAX_FILE_SIZE_MB} МБ на странице {pages - len(pending)}. "
+                    f"Отсканируйте документ частями или уменьшите SCAN_DPI/SCAN_JPEG_QUALITY"
+                )
+        
+        logger.info("Начало пакетного сканирования из автоподатчика...")
+        try:
+            with open(filepath, 'wb') as f:
+                writer = PdfWriter(f)
                 try:
-                    optlist = getattr(self.device, 'optlist', None) or []
-                    for name in ('source', 'scan-source', 'source-name'):
-                        if name not in optlist:
-                            continue
-                        attr = name.replace('-', '_')
-                        if hasattr(self.device, attr):
-                            setattr(self.device, attr, source)
-                            logger.info("Установлен источник сканирования: %s", source)
+                    while True:
+                        image = self._snap_feeder_page_sync()
+                        if image is None:
                             break
-                except Exception as e:
-                    logger.warning("Не удалось установить источник сканирования %s: %s", source, e)
-            
-            logger.info("Начало сканирования...")
-            
-            # Выполнение сканирования (совместимость с Python 3.7)
+                        # Сводка для анализа собирается один раз и уходит в пул вместе с кадром
+                        page_stats = PageStats.collect(image)
+                        if config.SCAN_SKIP_BLANK:
+                            blank, info = detect_blank_page(image, stats=page_stats)
+                            if blank:
+                                skipped += 1
+                                logger.info("Пустая страница пропущена (чернила %.4f%%)", info["ink"] * 100)
+                                del image
+                                continue
+                        pages += 1
+                        logger.info("Отсканирована страница %s", pages)
+                        pending.append(_submit_page(_encode_batch_page, image, config.SCAN_JPEG_QUALITY,
+                                                    page_stats))
+                        del image
+                        if on_page:
+                            on_page(pages)
+                        # Готовые страницы пишутся сразу, а ждём кодировщик только при полной очереди
+                        while pending and (len(pending) >= max_pending or pending[0].done()):
+                            write_page(pending.popleft().result())
+                    while pending:
+                        write_page(pending.popleft().result())
+                except BrokenProcessPool:
+                    _reset_page_pool()
+                    raise
+                finally:
+                    # При ошибке невыполненные страницы снимаются; их сегменты удалит обработчик завершения
+                    for future in pending:
+                        future.cancel()
+                writer.close()
+        except ScannerError:
+            Path(filepath).unlink(missing_ok=True)
+            raise
+        finally:
+            self.device.cancel()
+        
+        if pages == 0:
+            if Path(filepath).exists():
+                Path(filepath).unlink()
+            if skipped:
+                raise ScannerError(f"Все страницы из автоподатчика пустые ({skipped} шт.)")
+            raise ScannerError("В автоподатчике нет документов")
+        logger.info("Пакетное сканирование завершено: %s стр. (пустых пропущено: %s), %s",
+                    pages, skipped, filepath)
+        return pages
+    
+    def is_feeder_source(self, sane_value: str) -> bool:
+        """Источник — автоподатчик (для него доступно пакетное сканирование)"""
+        return self._source_display_label(sane_value) == "Автоподача (фидер)"
+    
+    async def scan_preview(self, source: Optional[str] = None, area: Optional[str] = None) -> bytes:
+        """Предпросмотр в низком разрешении как JPEG для отправки фотографией"""
+        if not self.is_initialized:
+            await self.initialize()
+        
+        try:
+            scan_preview = self.process.scan_preview if self.process else self._scan_preview_sync
+            image = await self.worker.run(scan_preview, source, area)
             loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                scan_data = await loop.run_in_executor(executor, self.device.scan)
-            
-            if not scan_data:
-                raise ScannerError("Не удалось получить данные сканирования")
+            return await loop.run_in_executor(None, _encode_image, image.convert('RGB'), 'JPEG', 75)
+        except Exception as e:
+            logger.error(f"Ошибка предпросмотра: {e}")
+            raise ScannerError(f"Не удалось получить предпросмотр: {e}")
+    
+    async def scan_batch(self, source: Optional[str] = None, progress=None) -> Tuple[Path, int]:
+        """
+        Сканирование всех страниц из автоподатчика в один PDF.
+        
+        progress — корутина progress(pages), вызывается после каждой страницы;
+        к возврату все её вызовы завершены, так что следующее сообщение
+        вызывающего кода они не перезапишут. Возвращает (путь к PDF, число страниц).
+        """
+        if not self.is_initialized:
+            await self.initialize()
+        
+        loop = asyncio.get_event_loop()
+        progress_tasks = []
+        
+        def on_page(pages: int):
+            if progress:
+                loop.call_soon_threadsafe(lambda: progress_tasks.append(asyncio.ensure_future(progress(pages))))
+        
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filepath = config.SCAN_DIR / f"scan_{timestamp}.pdf"
+            scan_batch = self.process.scan_batch if self.process else self._scan_batch_sync
+            pages = await self.worker.run(scan_batch, source, str(filepath), on_page)
+            return filepath, pages
+        except Exception as e:
+            logger.error(f"Ошибка пакетного сканирования: {e}")
+            raise ScannerError(f"Не удалось отсканировать документы из автоподатчика: {e}")
+        finally:
+            # Обновления прогресса, поставленные до завершения сканирования, уже в списке
+            await asyncio.gather(*progress_tasks, return_exceptions=True)
+    
+    async def scan_document(self, source: Optional[str] = None, area: Optional[str] = None) -> Optional[Path]:
+        """
+        Сканирование документа. source — значение SANE для выбора источника (планшет/фидер),
+        area — ключ пресета области сканирования (AREA_PRESETS), None — весь планшет.
+        """
+        if not self.is_initialized:
+            await self.initialize()
+        
+        try:
+            stats = self.worker.stats()
+            if stats["busy"] or stats["queue_depth"]:
+                logger.info("Сканер занят, запрос поставлен в очередь (впереди: %s)",
+                            stats["queue_depth"] + (1 if stats["busy"] else 0))
             
-            logger.info(f"Тип данных сканирования: {type(scan_data)}")
+            filepath = config.SCAN_DIR / self._new_scan_filename()
+            fmt = config.SCAN_FORMAT.upper()
             
-            # Обработка разных типов данных от SANE
-            if isinstance(scan_data, Image.Image):
-                # Если уже PIL Image
-                image = scan_data
-                logger.info("Получен PIL Image напрямую")
-            elif hasattr(scan_data, 'save'):
-                # Если это PIL-подобный объект
-                image = scan_data
-                logger.info("Получен PIL-подобный объект")
+            if config.SCAN_STREAMING and fmt in STREAMING_FORMATS:
+                # Кодирование идёт параллельно с чтением, кадр целиком в памяти не собирается
+                scan_to_file = self.process.scan_to_file if self.process else self._scan_to_file_sync
+                result = await self.worker.run(scan_to_file, source, str(filepath), fmt, area)
+                image = result if isinstance(result, Image.Image) else None
+            elif self.process:
+                image = await self.worker.run(self.process.scan, source, area)
             else:
-                try:
-                    # Попытка создать PIL Image из массива
-                    import numpy as np
-                    if isinstance(scan_data, np.ndarray):
-                        image = Image.fromarray(scan_data)
-                        logger.info("Создан PIL Image из numpy array")
-                    else:
-                        # Попытка конвертации в массив
-                        scan_array = np.array(scan_data)
-                        image = Image.fromarray(scan_array)
-                        logger.info("Создан PIL Image через numpy.array()")
-                except Exception as conv_error:
-                    logger.error(f"Ошибка конвертации данных: {conv_error}")
-                    # Последняя попытка - сохранить как есть
-                    if hasattr(scan_data, 'mode') and hasattr(scan_data, 'size'):
-                        image = scan_data
-                        logger.info("Используем данные как есть")
-                    else:
-                        raise ScannerError(f"Неподдерживаемый тип данных сканирования: {type(scan_data)}")
+                image = await self.worker.run(self._scan_sync, source, area)
             
-            # Генерация имени файла
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"scan_{timestamp}.{config.SCAN_FORMAT.lower()}"
-            filepath = config.SCAN_DIR / filename
-            
-            # Сохранение файла (совместимость с Python 3.7)
-            with ThreadPoolExecutor() as executor:
-                await loop.run_in_executor(executor, lambda: image.save(filepath, config.SCAN_FORMAT))
-            
-            # Проверка размера файла
-            file_size_mb = filepath.stat().st_size / (1024 * 1024)
-            if file_size_mb > config.MAX_FILE_SIZE_MB:
-                logger.warning(f"Файл больше {config.MAX_FILE_SIZE_MB}MB, сжимаем...")
-                await self._compress_image(filepath)
+            loop = asyncio.get_event_loop()
+            if image is not None:
+                # Обработка и кодирование под лимит размера идут в пуле процессов,
+                # файл записывается один раз; поток сканера при этом свободен
+                data, tag, fmt = await _process_page(_finish_scan, image, fmt)
+                filepath = filepath.with_name(self._new_scan_filename(fmt, tag, filepath.stem))
+                await loop.run_in_executor(None, _write_bytes, filepath, data)
+            else:
+                # Потоковая запись не знает итогового размера заранее
+                file_size_mb = filepath.stat().st_size / (1024 * 1024)
+                if file_size_mb > config.MAX_FILE_SIZE_MB:
+                    logger.warning(f"Файл больше {config.MAX_FILE_SIZE_MB}MB, сжимаем...")
+                    await loop.run_in_executor(None, self._compress_image, filepath)
             
             logger.info(f"Документ отсканирован: {filepath}")
             return filepath
@@ -233,25 +1427,71 @@ class HPScanner:
             logger.error(f"Ошибка сканирования: {e}")
             raise ScannerError(f"Не удалось отсканировать документ: {e}")
     
-    async def _compress_image(self, filepath: Path):
-        """Сжатие изображения если оно слишком большое"""
+    @staticmethod
+    def _new_scan_filename(fmt: Optional[str] = None, tag: Optional[str] = None, stem: Optional[str] = None) -> str:
+        """Имя файла скана: scan_<время>[_<метка>].<расширение формата>"""
+        fmt = (fmt or config.SCAN_FORMAT).upper()
+        stem = stem or f"scan_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        if tag:
+            stem = f"{stem}_{tag}"
+        return f"{stem}.{FORMAT_EXTENSIONS.get(fmt, fmt.lower())}"
+    
+    async def scan_to_memory(self, source: Optional[str] = None, area: Optional[str] = None) -> Tuple[str, bytes]:
+        """
+        Сканирование с кодированием в память, без записи на диск.
+        
+        Возвращает (имя файла, закодированные данные). Сохранить копию
+        в SCAN_DIR можно потом через archive_scan, уже после отправки.
+        Потоковая запись здесь не используется: результат всё равно
+        собирается в памяти, а лимит размера требует видеть кадр целиком.
+        """
+        if not self.is_initialized:
+            await self.initialize()
+        
         try:
-            image = Image.open(filepath)
-            
-            # Уменьшение качества для JPEG
-            if config.SCAN_FORMAT.upper() == 'JPEG':
-                image.save(filepath, 'JPEG', quality=70, optimize=True)
+            filename = self._new_scan_filename()
+            if self.process:
+                image = await self.worker.run(self.process.scan, source, area)
             else:
-                # Для PNG - уменьшение размера
-                width, height = image.size
-                new_size = (int(width * 0.8), int(height * 0.8))
-                # Совместимость со старыми версиями Pillow
-                try:
-                    image = image.resize(new_size, Image.Resampling.LANCZOS)
-                except AttributeError:
-                    image = image.resize(new_size, Image.LANCZOS)
-                image.save(filepath, config.SCAN_FORMAT)
+                image = await self.worker.run(self._scan_sync, source, area)
             
+            data, tag, fmt = await _process_page(_finish_scan, image, config.SCAN_FORMAT.upper())
+            filename = self._new_scan_filename(fmt, tag, filename.rsplit('.', 1)[0])
+            logger.info(f"Документ отсканирован в память: {filename}, {len(data)} байт")
+            return filename, data
+            
+        except Exception as e:
+            logger.error(f"Ошибка сканирования: {e}")
+            raise ScannerError(f"Не удалось отсканировать документ: {e}")
+    
+    def archive_scan(self, filename: str, data: bytes) -> asyncio.Future:
+        """Фоновая запись уже отправленного скана в SCAN_DIR"""
+        filepath = config.SCAN_DIR / filename
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, _write_bytes, filepath, data)
+        
+        def done(fut):
+            if fut.cancelled():
+                logger.warning(f"Запись скана в архив отменена: {filepath}")
+                return
+            error = fut.exception()
+            if error:
+                logger.error(f"Не удалось сохранить скан {filepath}: {error}")
+            else:
+                logger.info(f"Скан сохранён в архив: {filepath}")
+        
+        future.add_done_callback(done)
+        return future
+    
+    def _compress_image(self, filepath: Path):
+        """Пережатие уже записанного файла под лимит размера (для потоковой записи)"""
+        try:
+            if filepath.suffix.lower() == '.pdf':
+                logger.warning(f"PDF не пережимается: {filepath}")
+                return
+            with Image.open(filepath) as image:
+                image.load()
+                _write_encoded(image, filepath, config.SCAN_FORMAT.upper())
             logger.info(f"Изображение сжато: {filepath}")
             
         except Exception as e:
@@ -273,24 +1513,68 @@ class HPScanner:
                 "format": config.SCAN_FORMAT
             }
             
+            if self.process:
+                status["device"] = self.process.device_name or "Неизвестно"
+                status["backend_pid"] = self.process.pid
+                status["backend_restarts"] = self.process.restarts
+                if not self.process.is_alive():
+                    status["status"] = "error"
+                    status["message"] = "Процесс SANE не запущен, будет перезапущен при следующем сканировании"
+                    return status
+            
+            # Загрузка потока сканера
+            worker_stats = self.worker.stats()
+            status.update(worker_stats)
+            if worker_stats["busy"]:
+                status["status"] = "busy"
+                status["message"] = "Сканер занят"
+            
             return status
             
         except Exception as e:
             logger.error(f"Ошибка получения статуса: {e}")
             return {"status": "error", "message": f"Ошибка: {e}"}
     
+    async def cancel_scan(self):
+        """Отмена текущего сканирования"""
+        if self.process:
+            self.process.cancel()
+            logger.info("Отправлена отмена сканирования процессу SANE")
+            return
+        if not self.device:
+            return
+        if self.worker.is_busy:
+            # Поток сканера занят чтением, а sane_cancel по спецификации SANE
+            # можно вызывать из другого потока во время sane_read
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.device.cancel)
+        else:
+            await self.worker.run(self.device.cancel)
+        logger.info("Сканирование отменено")
+    
+    def _cleanup_sync(self):
+        if self.device:
+            self.device.close()
+            self.device = None
+            logger.info("Устройство сканера закрыто")
+        
+        sane.exit()
+        self.is_initialized = False
+        logger.info("SANE завершен")
+    
     def cleanup(self):
         """Очистка ресурсов"""
         try:
-            if self.device:
-                self.device.close()
-                logger.info("Устройство сканера закрыто")
-            
-            sane.exit()
-            logger.info("SANE завершен")
-            
+            if self.process:
+                self.worker.submit(self.process.cleanup).result(timeout=30)
+                self.is_initialized = False
+            else:
+                self.worker.submit(self._cleanup_sync).result(timeout=30)
         except Exception as e:
             logger.error(f"Ошибка при очистке ресурсов: {e}")
+        finally:
+            self.worker.shutdown(wait=False)
+            _reset_page_pool()
 
 # Глобальный экземпляр сканера
 scanner = HPScanner() 
\ No newline at end of file
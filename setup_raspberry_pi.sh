@@ -65,7 +65,9 @@ sudo apt install -y hplip hplip-gui
 
 # Установка LibreOffice для конвертации DOCX в PDF
 print_status "Установка LibreOffice для конвертации документов..."
-sudo apt install -y libreoffice --no-install-recommends
+sudo apt install -y libreoffice python3-uno --no-install-recommends
+# Шрифт с кириллицей для печати текстовых файлов
+sudo apt install -y fonts-dejavu-core
 
 # Установка HPLIP плагина (автоматически, без интерактивного режима)
 print_status "Установка HPLIP плагина..."
@@ -0,0 +1,81 @@
+import os
+
+from printer import ConversionCache
+
+def _source(path, size: int, fill: bytes = b'x'):
+    path.write_bytes(fill * size)
+    return path
+
+def _age(path, seconds: float):
+    stat = path.stat()
+    os.utime(path, (stat.st_atime - seconds, stat.st_mtime - seconds))
+
+def test_disabled_cache(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 0)
+    assert not cache.enabled
+    assert not (tmp_path / 'cache').exists()
+    assert cache.get('abc') is None
+    assert cache.lookup('file-id') is None
+    assert not cache.owns(tmp_path / 'cache' / 'abc.pdf')
+
+def test_put_copy_and_move(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 1024 * 1024)
+    original = _source(tmp_path / 'photo.JPG', 100)
+    stored = cache.put('d1', original, move=False)
+    
+    assert stored == tmp_path / 'cache' / 'd1.jpg'
+    assert original.exists() and stored.read_bytes() == original.read_bytes()
+    assert cache.owns(stored)
+    
+    converted = _source(tmp_path / 'doc.pdf', 200)
+    stored = cache.put('d2', converted, move=True)
+    assert not converted.exists()
+    assert stored.stat().st_size == 200
+    assert not list((tmp_path / 'cache').glob('*.tmp'))
+
+def test_put_existing_target_is_a_hit(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 1024 * 1024)
+    first = cache.put('d1', _source(tmp_path / 'a.pdf', 100), move=True)
+    second = _source(tmp_path / 'b.pdf', 100, b'y')
+    
+    assert cache.put('d1', second, move=True) == first
+    assert not second.exists()
+    assert first.read_bytes() == b'x' * 100
+
+def test_lookup_by_unique_id_survives_restart(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 1024 * 1024)
+    stored = cache.put('d1', _source(tmp_path / 'a.pdf', 100), move=False)
+    cache.remember('file-id', 'd1')
+    assert cache.lookup('file-id') == stored
+    assert cache.lookup('other-id') is None
+    assert cache.lookup(None) is None
+    
+    reopened = ConversionCache(tmp_path / 'cache', 1024 * 1024)
+    assert reopened.lookup('file-id') == stored
+    assert reopened.get('d1') == stored
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 1000)
+    old = cache.put('old', _source(tmp_path / 'old.pdf', 400), move=True)
+    used = cache.put('used', _source(tmp_path / 'used.pdf', 400), move=True)
+    cache.remember('old-id', 'old')
+    cache.remember('used-id', 'used')
+    _age(old, 100)
+    _age(used, 50)
+    # Обращение через get продлевает жизнь файлу
+    assert cache.get('used') == used
+    
+    new = cache.put('new', _source(tmp_path / 'new.pdf', 400), move=True)
+    assert not old.exists()
+    assert used.exists() and new.exists()
+    assert cache.lookup('old-id') is None
+    assert cache.lookup('used-id') == used
+    assert ConversionCache(tmp_path / 'cache', 1000).lookup('old-id') is None
+
+def test_new_entry_is_kept_even_if_over_limit(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', 100)
+    small = cache.put('small', _source(tmp_path / 'small.pdf', 50), move=True)
+    _age(small, 100)
+    big = cache.put('big', _source(tmp_path / 'big.pdf', 500), move=True)
+    assert big.exists()
+    assert not small.exists()
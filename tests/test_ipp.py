@@ -0,0 +1,173 @@
+import asyncio
+import http.server
+import socketserver
+import struct
+import threading
+
+import pytest
+
+import config
+from printer import (Printer, IppClient, IppResponse, DocumentStream, PrinterError, encode_ipp_request,
+                     parse_printer_state, IPP_GET_PRINTER_ATTRIBUTES, IPP_PRINT_JOB, IPP_TAG_OPERATION,
+                     IPP_TAG_JOB, IPP_TAG_PRINTER, IPP_CHARSET, IPP_INTEGER, IPP_ENUM, IPP_BOOLEAN,
+                     IPP_KEYWORD, IPP_TEXT, IPP_PRINTER_IDLE)
+
+class _CupsHandler(http.server.BaseHTTPRequestHandler):
+    """Заглушка cupsd: отвечает на Get-Printer-Attributes и Print-Job, запросы складывает в server.requests"""
+    protocol_version = 'HTTP/1.1'
+    
+    def address_string(self):
+        return 'unix'
+    
+    def log_message(self, *args):
+        pass
+    
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        body = bytearray()
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return bytes(body)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+    
+    def do_POST(self):
+        body = self._read_body()
+        operation = struct.unpack('>H', body[2:4])[0]
+        # Документ Print-Job идёт сразу за концом атрибутов; разбор его не касается
+        request = IppResponse.decode(body)
+        self.server.requests.append((operation, request, body, self.headers.get('Transfer-Encoding')))
+        groups = [(IPP_TAG_OPERATION, [(IPP_CHARSET, 'attributes-charset', 'utf-8')])]
+        if operation == IPP_GET_PRINTER_ATTRIBUTES:
+            groups.append((IPP_TAG_PRINTER, [
+                (IPP_ENUM, 'printer-state', IPP_PRINTER_IDLE),
+                (IPP_KEYWORD, 'printer-state-reasons', ['media-low-warning', 'none']),
+                (IPP_TEXT, 'printer-state-message', 'Ready'),
+                (IPP_BOOLEAN, 'printer-is-accepting-jobs', True),
+                (IPP_INTEGER, 'queued-job-count', 2),
+            ]))
+        elif operation == IPP_PRINT_JOB:
+            groups.append((IPP_TAG_JOB, [(IPP_INTEGER, 'job-id', 42)]))
+        response = encode_ipp_request(0, request.request_id, groups)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/ipp')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+class _CupsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+@pytest.fixture
+def cups(tmp_path):
+    server = _CupsServer(str(tmp_path / 'cups.sock'), _CupsHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = IppClient(server.server_address)
+    yield server, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+def _assert_document(body: bytes, document: bytes):
+    """Тело Print-Job — атрибуты до тега конца и сразу за ними документ целиком"""
+    assert body.endswith(document)
+    header = body[:len(body) - len(document)]
+    assert header.endswith(b'\x03')
+    IppResponse.decode(header)
+
+def test_printer_state_from_get_printer_attributes(cups):
+    server, client = cups
+    response = asyncio.run(client.get_printer_attributes('HP M177'))
+    state = parse_printer_state(response)
+    
+    assert state == {
+        "enabled": True, "accepting": True, "idle": True, "offline": False, "jobs": 2,
+        "reasons": ['media-low-warning'], "message": 'Ready',
+    }
+    operation, request, _, _ = server.requests[0]
+    assert operation == IPP_GET_PRINTER_ATTRIBUTES
+    assert request.get('printer-uri') == 'ipp://localhost/printers/HP%20M177'
+    assert 'printer-state' in request.values('requested-attributes')
+
+def test_print_job_from_file(cups, tmp_path):
+    server, client = cups
+    document = tmp_path / 'doc.pdf'
+    document.write_bytes(b'%PDF-1.4 ' + bytes(range(256)) * 1000)
+    job_id = asyncio.run(client.print_job('HP', document, job_attributes=[(IPP_INTEGER, 'copies', 2)]))
+    
+    assert job_id == 42
+    operation, request, _, encoding = server.requests[-1]
+    assert operation == IPP_PRINT_JOB
+    assert encoding is None
+    assert request.get('job-name') == 'doc.pdf'
+    assert request.get('copies', group=IPP_TAG_JOB) == 2
+    _assert_document(server.requests[-1][2], document.read_bytes())
+
+def test_print_job_from_stream(cups):
+    server, client = cups
+    payload = [b'%PDF-1.4 ', b'x' * 100_000, b'y' * 7]
+    
+    async def chunks():
+        for chunk in payload:
+            await asyncio.sleep(0)
+            yield chunk
+    
+    async def main():
+        stream = DocumentStream('doc.pdf', chunks(), 1024 * 1024)
+        stream.start()
+        try:
+            return await client.print_job('HP', stream)
+        finally:
+            await stream.close()
+    
+    assert asyncio.run(main()) == 42
+    assert server.requests[-1][3] == 'chunked'
+    _assert_document(server.requests[-1][2], b''.join(payload))
+
+def test_decode_rejects_truncated_response():
+    data = encode_ipp_request(0, 7, [
+        (IPP_TAG_OPERATION, [(IPP_CHARSET, 'attributes-charset', 'utf-8')]),
+        (IPP_TAG_PRINTER, [(IPP_ENUM, 'printer-state', IPP_PRINTER_IDLE)]),
+    ])
+    assert IppResponse.decode(data).get('printer-state') == IPP_PRINTER_IDLE
+    for length in range(len(data)):
+        with pytest.raises(PrinterError):
+            IppResponse.decode(data[:length])
+
+def test_decode_rejects_attribute_outside_group():
+    data = struct.pack('>BBHI', 2, 0, 0, 1) + struct.pack('>BH', IPP_TEXT, 1) + b'a' + struct.pack('>H', 0) + b'\x03'
+    with pytest.raises(PrinterError):
+        IppResponse.decode(data)
+
+def test_print_stream_records_document_in_cache(cups, tmp_path, monkeypatch):
+    server, client = cups
+    monkeypatch.setattr(config, 'PRINT_TEMP_DIR', tmp_path / 'queue')
+    monkeypatch.setattr(config, 'PRINT_CACHE_MAX_MB', 10)
+    printer = Printer()
+    printer.ipp.close()
+    printer.ipp = client
+    payload = [b'%PDF-1.4 ', b'z' * 200_000]
+    
+    async def chunks(fail=False):
+        for chunk in payload:
+            await asyncio.sleep(0)
+            yield chunk
+        if fail:
+            raise OSError("обрыв")
+    
+    with pytest.raises(PrinterError):
+        asyncio.run(printer.print_stream('doc.pdf', chunks(fail=True), unique_id='uid'))
+    assert printer.cache.lookup('uid') is None
+    
+    assert asyncio.run(printer.print_stream('doc.pdf', chunks(), unique_id='uid'))
+    cached = printer.cache.lookup('uid')
+    assert cached is not None and cached.suffix == '.pdf'
+    assert cached.read_bytes() == b''.join(payload)
+    # Временных копий потока не остаётся ни после ошибки, ни после успеха
+    assert sorted(p.name for p in (tmp_path / 'queue').iterdir()) == ['cache']
+    assert sorted(p.suffix for p in (tmp_path / 'queue' / 'cache').iterdir()) == ['.json', '.pdf']
@@ -0,0 +1,80 @@
+import io
+import re
+from pathlib import Path
+
+import pytest
+
+from pdf_writer import PdfWriter, TrueTypeFont, CATALOG_OBJ
+
+FONT_PATH = Path("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+def _xref(data: bytes) -> dict:
+    """Разбор таблицы xref: номер объекта -> смещение"""
+    startxref = int(re.search(rb"startxref\n(\d+)\n%%EOF\n$", data).group(1))
+    assert data[startxref:].startswith(b"xref\n")
+    lines = data[startxref:].split(b"\n")
+    first, count = map(int, lines[1].split())
+    offsets = {}
+    for i, line in enumerate(lines[2:2 + count]):
+        offset, _, kind = line.split()[:3]
+        if kind == b"n" and first + i:
+            offsets[first + i] = int(offset)
+    return offsets
+
+def _write_image_page(writer: PdfWriter):
+    image = writer.add_image(b"\x00\xff" * 8, 4, 4, colorspace='/DeviceGray', filter_name=None)
+    writer.begin_page(200, 100)
+    writer.draw_image(image, 0, 0, 200, 100)
+    writer.end_page()
+
+def test_structure_and_xref_offsets():
+    buffer = io.BytesIO()
+    writer = PdfWriter(buffer)
+    _write_image_page(writer)
+    _write_image_page(writer)
+    writer.close()
+    data = buffer.getvalue()
+    
+    assert data.startswith(b"%PDF-1.4\n")
+    assert writer.page_count == 2
+    assert b"/Type /Pages" in data and b"/Count 2" in data
+    
+    offsets = _xref(data)
+    for num, offset in offsets.items():
+        assert data[offset:].startswith(f"{num} 0 obj\n".encode())
+    size = int(re.search(rb"/Size (\d+)", data).group(1))
+    assert size == max(offsets) + 1
+    assert f"/Root {CATALOG_OBJ} 0 R".encode() in data
+    assert data.count(b"/MediaBox [0 0 200 100]") == 2
+
+def test_begin_page_requires_end_page():
+    writer = PdfWriter(io.BytesIO())
+    writer.begin_page(100, 100)
+    with pytest.raises(RuntimeError):
+        writer.begin_page(100, 100)
+
+def test_close_is_idempotent():
+    buffer = io.BytesIO()
+    writer = PdfWriter(buffer)
+    _write_image_page(writer)
+    writer.close()
+    size = len(buffer.getvalue())
+    writer.close()
+    assert len(buffer.getvalue()) == size
+
+@pytest.mark.skipif(not FONT_PATH.exists(), reason="нет шрифта DejaVuSans")
+def test_text_font_written_on_close():
+    buffer = io.BytesIO()
+    writer = PdfWriter(buffer)
+    font = writer.add_font(TrueTypeFont(FONT_PATH))
+    writer.begin_page(595, 842)
+    writer.draw_text(font, 12, 50, 800, "Привет")
+    writer.end_page()
+    writer.close()
+    data = buffer.getvalue()
+    
+    assert b"/FontFile2" in data
+    assert b"/ToUnicode" in data
+    offsets = _xref(data)
+    for num, offset in offsets.items():
+        assert data[offset:].startswith(f"{num} 0 obj\n".encode())
@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+
+# bot.py импортирует scanner, а тот — python-sane
+pytest.importorskip("sane")
+
+import bot
+import config
+from printer import ConversionCache
+
+class _FakePrinter:
+    """Принтер без CUPS: печать записывается, кэш настоящий (как в Printer._prepare_file_for_printing)"""
+    def __init__(self, cache_dir):
+        self.cache = ConversionCache(cache_dir, 1024 * 1024)
+        self.printed = []
+        self.streamed = []
+        self.stream = False
+    
+    def can_stream(self, file_name):
+        return self.stream
+    
+    async def print_file(self, file_path, printer_name=None, unique_id=None):
+        digest = hashlib.sha256(file_path.read_bytes()).hexdigest()
+        if not self.cache.owns(file_path):
+            self.cache.put(digest, file_path, move=False)
+        self.cache.remember(unique_id, digest)
+        self.printed.append(file_path)
+        return True
+    
+    async def print_stream(self, file_name, chunks, size=None, printer_name=None, unique_id=None):
+        self.streamed.append((file_name, size, unique_id))
+        return True
+
+class _StatusMessage:
+    def __init__(self):
+        self.texts = []
+    
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+class _Document:
+    def __init__(self, data, get_file_error=None):
+        self.file_name = 'report.pdf'
+        self.file_unique_id = 'unique-1'
+        self.data = data
+        self.get_file_error = get_file_error
+        self.get_file_calls = 0
+    
+    async def get_file(self):
+        self.get_file_calls += 1
+        if self.get_file_error:
+            raise self.get_file_error
+        
+        async def download_to_drive(path):
+            path.write_bytes(self.data)
+        
+        return SimpleNamespace(file_path='https://api.telegram.org/file/botTOKEN/documents/report.pdf',
+                               file_size=len(self.data), download_to_drive=download_to_drive)
+
+class _Message:
+    def __init__(self, document):
+        self.document = document
+        self.photo = self.sticker = None
+        self.text = self.entities = self.caption = self.caption_entities = None
+        self.status = _StatusMessage()
+    
+    async def reply_text(self, text, **kwargs):
+        return self.status
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    fake_printer = _FakePrinter(tmp_path / 'cache')
+    monkeypatch.setattr(bot, 'printer', fake_printer)
+    monkeypatch.setattr(config, 'PRINT_TEMP_DIR', tmp_path)
+    monkeypatch.setattr(config, 'TELEGRAM_CHAT_IDS', [])
+    scan_bot = bot.ScanBot()
+    
+    async def get_me():
+        return SimpleNamespace(username='scanbot')
+    
+    scan_bot.bot = SimpleNamespace(get_me=get_me)
+    
+    def send(document):
+        message = _Message(document)
+        update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1),
+                                 effective_chat=SimpleNamespace(id=1))
+        context = SimpleNamespace(user_data={'waiting_for_print': True})
+        asyncio.run(scan_bot.handle_print_request(update, context))
+        return message.status.texts
+    
+    return fake_printer, send
+
+def test_downloaded_file_is_removed_and_cache_kept(handler, tmp_path):
+    fake_printer, send = handler
+    document = _Document(b'%PDF-1.4 test')
+    
+    texts = send(document)
+    assert texts[-1].startswith("✅")
+    assert fake_printer.printed == [tmp_path / 'report.pdf']
+    assert not (tmp_path / 'report.pdf').exists()
+    
+    # Повторная печать берёт файл из кэша; обработчик не должен его удалить
+    texts = send(document)
+    assert texts[-1].startswith("✅")
+    assert document.get_file_calls == 1
+    cached = fake_printer.printed[-1]
+    assert fake_printer.cache.owns(cached)
+    assert cached.exists()
+    assert fake_printer.cache.lookup('unique-1') == cached
+
+def test_get_file_error_is_reported(handler):
+    fake_printer, send = handler
+    texts = send(_Document(b'', get_file_error=RuntimeError("сеть недоступна")))
+    assert "сеть недоступна" in texts[-1]
+    assert fake_printer.printed == []
+
+def test_streamed_print_does_not_fail_on_cleanup(handler, tmp_path):
+    fake_printer, send = handler
+    fake_printer.stream = True
+    texts = send(_Document(b'%PDF-1.4 stream'))
+    assert texts[-1].startswith("✅")
+    assert fake_printer.streamed == [('report.pdf', 15, 'unique-1')]
+    assert list(tmp_path.iterdir()) == [tmp_path / 'cache']
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from process_runner import ProcessRunner, ProcessTimeout, ToolNotFound
+
+def _alive(pid: int) -> bool:
+    """Жив ли процесс (зомби, которого ещё не забрал init, считается завершённым)"""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return False
+    return stat.rsplit(')', 1)[1].split()[0] != 'Z'
+
+def _wait_pid_file(path: Path) -> int:
+    for _ in range(100):
+        if path.exists() and path.read_text().strip():
+            return int(path.read_text())
+        time.sleep(0.02)
+    raise AssertionError("дочерний процесс не записал pid")
+
+def test_run_captures_output_and_stats():
+    runner = ProcessRunner()
+    result = asyncio.run(runner.run(['cat'], timeout=5, input=b'hello'))
+    assert result.ok
+    assert result.stdout == b'hello'
+    
+    result = asyncio.run(runner.run(['sh', '-c', 'echo oops >&2; exit 3'], timeout=5))
+    assert not result.ok
+    assert result.returncode == 3
+    assert result.error_text() == 'oops'
+    
+    stats = runner.stats()
+    assert stats['cat']['calls'] == 1 and stats['cat']['failures'] == 0
+    assert stats['sh']['calls'] == 1 and stats['sh']['failures'] == 1
+
+def test_missing_tool():
+    runner = ProcessRunner()
+    assert runner.path('no-such-tool-scan2telegram') is None
+    with pytest.raises(ToolNotFound):
+        asyncio.run(runner.run(['no-such-tool-scan2telegram'], timeout=5))
+    assert runner.stats() == {}
+
+def test_timeout_kills_whole_group(tmp_path):
+    runner = ProcessRunner()
+    pid_file = tmp_path / 'pid'
+    started = time.monotonic()
+    with pytest.raises(ProcessTimeout):
+        asyncio.run(runner.run(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], timeout=0.5))
+    assert time.monotonic() - started < 5
+    # Внук (sleep) в той же группе, что и sh, поэтому остановлен вместе с ним
+    assert not _alive(_wait_pid_file(pid_file))
+    assert runner.stats()['sh']['timeouts'] == 1
+
+def test_timeout_escalates_to_sigkill(tmp_path):
+    runner = ProcessRunner()
+    pid_file = tmp_path / 'pid'
+    with pytest.raises(ProcessTimeout):
+        asyncio.run(runner.run(['sh', '-c', f'trap "" TERM; sleep 30 & echo $! > {pid_file}; wait'], timeout=0.3))
+    assert not _alive(_wait_pid_file(pid_file))
+
+def test_cancel_kills_group(tmp_path):
+    runner = ProcessRunner()
+    pid_file = tmp_path / 'pid'
+    
+    async def main():
+        task = asyncio.ensure_future(runner.run(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], timeout=30))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    
+    asyncio.run(main())
+    assert not _alive(_wait_pid_file(pid_file))
+    assert runner.stats()['sh']['failures'] == 1
+
+def test_concurrency_limit_per_tool():
+    runner = ProcessRunner({'sleep': 1})
+    
+    async def main():
+        await asyncio.gather(runner.run(['sleep', '0.3'], timeout=5), runner.run(['sleep', '0.3'], timeout=5))
+    
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started >= 0.6
+    stats = runner.stats()['sleep']
+    assert stats['calls'] == 2
+    assert stats['queued_seconds'] >= 0.25
@@ -0,0 +1,132 @@
+import io
+import struct
+import numpy as np
+from PIL import Image, ImageDraw
+
+import config
+from scan_processing import (PageStats, detect_blank_page, estimate_skew, detect_content_bounds, _encode_g4,
+                             _encode_mrc_page, _rotate_to_box, _rotation_transform)
+
+
+def _page(size=(1240, 1754), noise=0, seed=0) -> Image.Image:
+    """Белый лист A4 на 150 dpi с шумом сканера"""
+    pixels = np.full((size[1], size[0]), 235, dtype=np.int16)
+    if noise:
+        pixels += np.random.default_rng(seed).normal(0, noise, pixels.shape).astype(np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).convert('RGB')
+
+def _text_page(**kwargs) -> Image.Image:
+    image = _page(**kwargs)
+    draw = ImageDraw.Draw(image)
+    for y in range(200, 1500, 40):
+        draw.rectangle((150, y, 1090, y + 12), fill=(20, 20, 20))
+    return image
+
+
+def test_page_stats_matches_whole_frame_reduction():
+    image = _text_page(noise=6)
+    stats = PageStats.collect(image)
+    factor = image.size[0] // 640
+    expected = np.asarray(image.convert('L').reduce(factor))
+    
+    assert stats.size == image.size
+    assert stats.gray.shape == expected.shape
+    # Полосы кратны factor, поэтому блоки усреднения совпадают с полным кадром
+    assert np.array_equal(stats.gray, expected)
+    assert stats.sample.shape[:2] == expected.shape
+    assert stats.sample.shape[2] == 3
+
+def test_page_stats_crop_keeps_proportions():
+    stats = PageStats.collect(_page())
+    cropped = stats.crop((0, 0, 620, 877))
+    assert cropped.size == (620, 877)
+    assert abs(cropped.gray.shape[1] - stats.gray.shape[1] / 2) <= 1
+    assert abs(cropped.gray.shape[0] - stats.gray.shape[0] / 2) <= 1
+
+def test_noisy_blank_page_is_blank():
+    blank, info = detect_blank_page(_page(noise=8), threshold=0.0005)
+    assert blank
+    assert info["ink"] < 0.0005
+    assert info["noise"] > 0
+
+def test_text_page_is_not_blank():
+    blank, info = detect_blank_page(_text_page(noise=8), threshold=0.0005)
+    assert not blank
+    assert info["ink"] > 0.05
+
+def test_dark_margins_are_ignored():
+    image = _page()
+    draw = ImageDraw.Draw(image)
+    # Тень от края листа в поле страницы
+    draw.rectangle((0, 0, 30, image.size[1]), fill=(40, 40, 40))
+    assert detect_blank_page(image, threshold=0.0005)[0]
+
+def test_blank_detection_reuses_stats():
+    image = _text_page()
+    stats = PageStats.collect(image)
+    assert detect_blank_page(image, threshold=0.0005, stats=stats) == detect_blank_page(image, threshold=0.0005)
+
+def test_estimate_skew_finds_rotation():
+    image = _text_page()
+    for angle in (2.0, -3.0):
+        rotated = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=(235, 235, 235))
+        assert abs(estimate_skew(rotated, max_angle=5.0) - angle) <= 0.3
+
+def test_estimate_skew_straight_and_blank_pages():
+    assert abs(estimate_skew(_text_page(), max_angle=5.0)) <= 0.25
+    assert estimate_skew(_page(noise=8), max_angle=5.0) == 0.0
+
+def test_detect_content_bounds_on_glass():
+    # Лист A5 на тёмной крышке сканера
+    glass = Image.new('RGB', (1240, 1754), (60, 60, 60))
+    glass.paste(_text_page(size=(600, 800)), (100, 150))
+    left, top, right, bottom = detect_content_bounds(glass)
+    tolerance = 1240 // 320 * 2
+    assert abs(left - 100) <= tolerance and abs(top - 150) <= tolerance
+    assert abs(right - 700) <= tolerance and abs(bottom - 950) <= tolerance
+
+def test_detect_content_bounds_uniform_frame():
+    assert detect_content_bounds(Image.new('RGB', (640, 480), (60, 60, 60))) is None
+
+def _g4_tiff(data: bytes, size) -> bytes:
+    """Однополосный TIFF вокруг «голого» потока G4 с теми же тегами, что пишет Pillow"""
+    tags = [(256, 3, size[0]), (257, 3, size[1]), (258, 3, 1), (259, 3, 4), (262, 3, 1),
+            (273, 4, 0), (277, 3, 1), (278, 3, size[1]), (279, 4, len(data))]
+    ifd_size = 2 + len(tags) * 12 + 4
+    data_offset = 8 + ifd_size
+    ifd = struct.pack('<H', len(tags))
+    for tag, kind, value in tags:
+        if tag == 273:
+            value = data_offset
+        ifd += struct.pack('<HHIHH' if kind == 3 else '<HHII', tag, kind, 1, value, *([0] if kind == 3 else []))
+    return b'II*\x00' + struct.pack('<I', 8) + ifd + struct.pack('<I', 0) + data
+
+def test_encode_g4_is_single_strip():
+    # Страница A4 на 300 dpi: Pillow по умолчанию разбил бы её на много полос,
+    # а склеенные полосы G4 не декодируются как один поток /CCITTFaxDecode
+    image = _text_page(size=(2480, 3508)).convert('L').point(lambda v: 255 if v > 128 else 0).convert('1')
+    data = _encode_g4(image)
+    decoded = Image.open(io.BytesIO(_g4_tiff(data, image.size)))
+    decoded.load()
+    assert decoded.size == image.size
+    assert np.array_equal(np.asarray(decoded), np.asarray(image))
+
+def test_rotate_to_box_matches_rotate_and_crop():
+    image = _text_page(size=(400, 560)).resize((400, 560))
+    for angle in (2.5, -3.7):
+        rotated = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=(235, 235, 235))
+        size = _rotation_transform(image.size, angle)[0]
+        assert size == rotated.size
+        for box in ((0, 0) + size, (13, 27, 301, 444)):
+            part = _rotate_to_box(image, angle, box, (235, 235, 235))
+            assert np.array_equal(np.asarray(part), np.asarray(rotated.crop(box)))
+
+def test_mrc_layers_do_not_depend_on_strip_height(monkeypatch):
+    image = _text_page(size=(1003, 1401), noise=6)
+    ImageDraw.Draw(image).ellipse((600, 900, 900, 1200), outline=(200, 30, 30), width=12)
+    monkeypatch.setattr(config, 'SCAN_TILE_MEMORY_MB', 1024)
+    whole = _encode_mrc_page(image)
+    # Бюджет 1 МБ: полосы по 72 строки, неполные блоки на краях кадра
+    monkeypatch.setattr(config, 'SCAN_TILE_MEMORY_MB', 0)
+    strips = _encode_mrc_page(image)
+    assert whole == strips